@@ -0,0 +1,102 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Compares the time and memory used to open a database eagerly and lazily.
+Each open runs in a fresh process so the RSS numbers are not shared.
+
+    python benchmarks/bench_open.py --keys 100000
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hyperloglogdb import HyperLogLogDB
+
+
+def rss_kb():
+    # current resident set size from /proc, falling back to the peak
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def build(path, keys, error_rate):
+    db = HyperLogLogDB(file_path=path, error_rate=error_rate)
+    db.create_many(['key%d' % i for i in range(keys)])
+    db.add('key0', 'value')
+    db.flush()
+
+
+def open_db(path, lazy):
+    before = rss_kb()
+    start = time.time()
+    db = HyperLogLogDB(file_path=path, lazy=lazy)
+    open_time = time.time() - start
+    start = time.time()
+    db.count('key0')
+    first_count = time.time() - start
+    return {
+        'lazy': lazy,
+        'open_seconds': open_time,
+        'first_count_seconds': first_count,
+        'rss_kb': rss_kb() - before,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--keys', type='int', default=100000)
+    parser.add_option('--error-rate', type='float', default=0.05)
+    parser.add_option('--open', dest='open_path', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--lazy', action='store_true', default=False, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.open_path:
+        print json.dumps(open_db(options.open_path, options.lazy))
+        return
+
+    fd, path = tempfile.mkstemp(suffix='.hlldb')
+    os.close(fd)
+    os.remove(path)
+    try:
+        build(path, options.keys, options.error_rate)
+        results = {'keys': options.keys, 'error_rate': options.error_rate, 'runs': []}
+        for lazy in (False, True):
+            cmd = [sys.executable, os.path.abspath(__file__), '--open', path]
+            if lazy:
+                cmd.append('--lazy')
+            results['runs'].append(json.loads(subprocess.check_output(cmd)))
+        print json.dumps(results, indent=2)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
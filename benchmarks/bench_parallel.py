@@ -0,0 +1,86 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Measures ingest throughput of parallel_ingest with a growing number of
+worker processes, against serial add_pairs on the same input.
+
+    python benchmarks/bench_parallel.py --workers 1,2,4,8 --hash mix64
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hyperloglogdb import HyperLogLogDB, parallel_ingest, hll
+
+HASHES = {'sha1': hll.HASH_SHA1, 'mix64': hll.HASH_MIX64}
+
+
+def pairs(keys, values):
+    for i in xrange(values):
+        yield 'key%d' % (i % keys), 'v%d' % i
+
+
+def run(workers, keys, values, hash_id, error_rate):
+    f = tempfile.NamedTemporaryFile(mode='r+b')
+    db = HyperLogLogDB(fileobj=f, error_rate=error_rate, hash_id=hash_id)
+    start = time.time()
+    if workers:
+        parallel_ingest(db, pairs(keys, values), workers=workers)
+    else:
+        batch = []
+        for pair in pairs(keys, values):
+            batch.append(pair)
+            if len(batch) >= 50000:
+                db.add_pairs(batch)
+                batch = []
+        db.add_pairs(batch)
+    db.flush()
+    elapsed = time.time() - start
+    f.close()
+
+    return {
+        'workers': workers,
+        'values': values,
+        'seconds': elapsed,
+        'values_per_second': values / elapsed,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--workers', default='1,2,4,8', help='worker counts to run, 0 is serial add_pairs')
+    parser.add_option('--keys', type='int', default=1000)
+    parser.add_option('--values', type='int', default=2000000)
+    parser.add_option('--hash', default='mix64', choices=sorted(HASHES))
+    parser.add_option('--error-rate', type='float', default=0.01)
+    options, args = parser.parse_args()
+
+    results = {'hash': options.hash, 'keys': options.keys, 'runs': []}
+    for workers in [0] + [int(w) for w in options.workers.split(',')]:
+        results['runs'].append(run(workers, options.keys, options.values, HASHES[options.hash], options.error_rate))
+    print json.dumps(results, indent=2)
+
+
+if __name__ == '__main__':
+    main()
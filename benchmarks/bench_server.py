@@ -0,0 +1,130 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Load generator for the server. Each client thread sends PFADD commands in
+pipelined rounds of --pipeline commands and waits for the replies of each
+round before sending the next. Reports the latency percentiles of the
+rounds and the commands per second.
+
+Without --port a server is started on a temporary database in this process.
+
+    python benchmarks/bench_server.py --clients 1,4,16 --pipeline 1,16,64
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hyperloglogdb import HyperLogLogDB
+from hyperloglogdb.server import HyperLogLogServer, encode_command
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run(host, port, clients, pipeline, rounds, values_per_command, keys):
+    latencies = [[] for n in range(clients)]
+
+    def client(n):
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for r in range(rounds):
+            commands = []
+            for c in range(pipeline):
+                i = r * pipeline + c
+                values = ['c%d-%d-%d' % (n, i, v) for v in range(values_per_command)]
+                commands.append(encode_command('PFADD', 'key%d' % (i % keys), *values))
+            data = ''.join(commands)
+            start = time.time()
+            sock.sendall(data)
+            replies = 0
+            while replies < pipeline:
+                replies += sock.recv(65536).count('\n')
+            latencies[n].append(time.time() - start)
+        sock.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    all_latencies = sorted(l for client_latencies in latencies for l in client_latencies)
+    commands = clients * rounds * pipeline
+    return {
+        'clients': clients,
+        'pipeline': pipeline,
+        'commands': commands,
+        'seconds': elapsed,
+        'commands_per_second': commands / elapsed,
+        'p50_ms': percentile(all_latencies, 0.5) * 1000,
+        'p95_ms': percentile(all_latencies, 0.95) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', help='an already running server')
+    parser.add_option('--clients', default='1,4,16')
+    parser.add_option('--pipeline', default='1,16,64')
+    parser.add_option('--commands', type='int', default=20000,
+                      help='commands sent by each client in each run')
+    parser.add_option('--values', type='int', default=4, help='values per PFADD')
+    parser.add_option('--keys', type='int', default=1000)
+    parser.add_option('--error-rate', type='float', default=0.01)
+    options, args = parser.parse_args()
+
+    server = None
+    port = options.port
+    if port is None:
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        db = HyperLogLogDB(fileobj=f, error_rate=options.error_rate)
+        server = HyperLogLogServer(db, options.host, 0)
+        port = server.port
+        thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.001})
+        thread.start()
+
+    results = {'values_per_command': options.values, 'keys': options.keys, 'runs': []}
+    try:
+        for clients in [int(c) for c in options.clients.split(',')]:
+            for pipeline in [int(p) for p in options.pipeline.split(',')]:
+                rounds = max(1, options.commands // pipeline)
+                results['runs'].append(run(options.host, port, clients, pipeline, rounds,
+                                           options.values, options.keys))
+    finally:
+        if server is not None:
+            server.shutdown()
+            thread.join()
+            results['server'] = server.stats
+    print json.dumps(results, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Performance baselines for ingest, count, merge, open, resize and flush,
+across key counts, error rates and synthetic key distributions:
+
+    uniform - values spread evenly over the keys
+    zipf    - a few keys get most of the values
+    sparse  - a few values for each of many keys, in a sparse database
+
+The data is generated from a fixed seed, so runs are comparable. Results
+are written as JSON, and --compare prints the ratio of each timing to a
+previous run.
+
+    python benchmarks/bench_suite.py --keys 1000,10000 --output baseline.json
+    python benchmarks/bench_suite.py --keys 1000,10000 --compare baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import optparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hyperloglogdb import HyperLogLogDB, HyperLogLog, MmapSlice, hll
+
+DISTRIBUTIONS = ('uniform', 'zipf', 'sparse')
+HASHES = {'sha1': hll.HASH_SHA1, 'mix64': hll.HASH_MIX64}
+
+
+def generate(distribution, keys, values, seed=0):
+    """
+    Returns parallel lists of keys and values. The sparse distribution has
+    about 4 values per key whatever the number of keys.
+    """
+    rng = numpy.random.RandomState(seed)
+    if distribution == 'uniform':
+        codes = rng.randint(0, keys, values)
+    elif distribution == 'zipf':
+        codes = (rng.zipf(1.2, values) - 1) % keys
+    elif distribution == 'sparse':
+        codes = rng.randint(0, keys, keys * 4)
+    else:
+        raise ValueError("Unknown distribution %r" % distribution)
+    return ['key%d' % c for c in codes.tolist()], ['value%d' % v for v in rng.randint(0, 2**62, len(codes)).tolist()]
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+def percentiles(latencies):
+    latencies = numpy.array(latencies) * 1000
+    return dict(('p%d_ms' % p, float(numpy.percentile(latencies, p))) for p in (50, 95, 99))
+
+
+def bench_ingest(path, keys, values, error_rate, hash_id, sparse, add_values):
+    """
+    Times add for a prefix of the pairs, then add_pairs and add_many for
+    all of them into fresh databases
+    """
+    results = {}
+    db = HyperLogLogDB(file_path=path + '.add', error_rate=error_rate, hash_id=hash_id, sparse=sparse)
+    n = min(add_values, len(values))
+    seconds, _ = timed(lambda: [db.add(k, v) for k, v in zip(keys[:n], values[:n])])
+    results['add'] = {'values': n, 'seconds': seconds, 'values_per_second': n / seconds}
+
+    db = HyperLogLogDB(file_path=path + '.add_many', error_rate=error_rate, hash_id=hash_id, sparse=sparse)
+    grouped = {}
+    for k, v in zip(keys, values):
+        grouped.setdefault(k, []).append(v)
+    seconds, _ = timed(lambda: [db.add_many(k, vs) for k, vs in grouped.iteritems()])
+    results['add_many'] = {'values': len(values), 'seconds': seconds, 'values_per_second': len(values) / seconds}
+
+    db = HyperLogLogDB(file_path=path, error_rate=error_rate, hash_id=hash_id, sparse=sparse)
+    seconds, _ = timed(db.add_pairs, keys, values)
+    results['add_pairs'] = {'values': len(values), 'seconds': seconds, 'values_per_second': len(values) / seconds}
+    return db, results
+
+
+def bench_count(db, keys, queries, seed=1):
+    # latency of cold estimates, then of cached counts
+    rng = numpy.random.RandomState(seed)
+    distinct = sorted(set(keys))
+    sample = [distinct[i] for i in rng.randint(0, len(distinct), queries).tolist()]
+    results = {}
+    for name in ('uncached', 'cached'):
+        if name == 'uncached':
+            db.cache_size = 0
+        else:
+            db.cache_size = len(distinct)
+            for key in sample:
+                db.count(key)
+        latencies = []
+        for key in sample:
+            start = time.time()
+            db.count(key)
+            latencies.append(time.time() - start)
+        results[name] = percentiles(latencies)
+    seconds, _ = timed(db.count_union, distinct)
+    results['count_union_seconds'] = seconds
+    return results
+
+
+def bench_hll_update(error_rate, hash_id, sources, repeat=20):
+    # merging in-memory HyperLogLogs into one
+    m = HyperLogLog._get_size(error_rate)
+    others = []
+    for i in range(sources):
+        h = HyperLogLog(error_rate, MmapSlice(bytearray(m), m), hash_id=hash_id)
+        h.add_many(['value%d-%d' % (i, v) for v in range(1000)])
+        others.append(h)
+    target = HyperLogLog(error_rate, MmapSlice(bytearray(m), m), hash_id=hash_id)
+    seconds, _ = timed(lambda: [target.update(others) for r in range(repeat)])
+    return {'sources': sources, 'update_seconds': seconds / repeat}
+
+
+def bench_merge(path, db, keys, values, error_rate, hash_id, sparse):
+    # merging a second database with the same keys and new values
+    other = HyperLogLogDB(file_path=path + '.other', error_rate=error_rate, hash_id=hash_id, sparse=sparse)
+    other.add_pairs(keys, [v + 'x' for v in values])
+    shutil.copy(path, path + '.target')
+    db.flush()
+    target = HyperLogLogDB(file_path=path + '.target')
+    seconds, stats = timed(target.merge, other)
+    empty = HyperLogLogDB(file_path=path + '.empty', error_rate=error_rate, hash_id=hash_id, sparse=sparse)
+    copy_seconds, _ = timed(empty.merge, other)
+    return {'keys': stats['keys'], 'seconds': seconds, 'keys_per_second': stats['keys'] / seconds,
+            'into_empty_seconds': copy_seconds}
+
+
+def bench_open(path):
+    # opening goes through read_idx, which lazy mode skips
+    results = {}
+    for lazy in (False, True):
+        seconds, db = timed(HyperLogLogDB, file_path=path, lazy=lazy)
+        results['lazy' if lazy else 'eager'] = {'seconds': seconds}
+    return results
+
+
+def bench_resize(path, size, error_rate, growth_factor=2.0):
+    # remapping a new file as it grows to size bytes
+    db = HyperLogLogDB(file_path=path + '.resize', error_rate=error_rate, growth_factor=growth_factor,
+                       growth_step=0)
+    times = []
+    while db.file_size < size:
+        seconds, _ = timed(db.resize, db.file_size + 1)
+        times.append(seconds)
+    return {'bytes': db.file_size, 'resizes': len(times), 'seconds': sum(times),
+            'max_seconds': max(times) if times else 0.0}
+
+
+def bench_flush(db, keys, touch=0.01, seed=2):
+    # a full flush, then a sync after writing to a fraction of the keys
+    distinct = sorted(set(keys))
+    seconds, _ = timed(db.flush)
+    rng = numpy.random.RandomState(seed)
+    for i in rng.randint(0, len(distinct), max(1, int(len(distinct) * touch))).tolist():
+        db.add(distinct[i], 'touched%d' % i)
+    sync_seconds, pages = timed(db.sync)
+    return {'flush_seconds': seconds, 'sync_seconds': sync_seconds, 'sync_pages': pages,
+            'file_bytes': db.file_size}
+
+
+def run(tmp_dir, distribution, keys, error_rate, options):
+    path = os.path.join(tmp_dir, '%s-%d-%s.hlldb' % (distribution, keys, error_rate))
+    hash_id = HASHES[options.hash]
+    sparse = distribution == 'sparse'
+    key_list, values = generate(distribution, keys, options.values)
+
+    result = {'distribution': distribution, 'keys': keys, 'error_rate': error_rate, 'values': len(values)}
+    db, result['ingest'] = bench_ingest(path, key_list, values, error_rate, hash_id, sparse, options.add_values)
+    result['count'] = bench_count(db, key_list, options.queries)
+    result['hll_update'] = bench_hll_update(error_rate, hash_id, options.sources)
+    result['merge'] = bench_merge(path, db, key_list, values, error_rate, hash_id, sparse)
+    result['flush'] = bench_flush(db, key_list)
+    result['open'] = bench_open(path)
+    result['resize'] = bench_resize(path, db.file_size, error_rate)
+    return result
+
+
+def timings(value, prefix=''):
+    # flattens the seconds and milliseconds of a result into name -> value
+    flat = {}
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            flat.update(timings(v, prefix + '.' + k if prefix else k))
+    elif prefix.endswith('seconds') or prefix.endswith('_ms'):
+        flat[prefix] = value
+    return flat
+
+
+def compare(results, baseline):
+    """
+    Prints the ratio of each timing to the same timing in baseline, for the
+    runs with the same distribution, keys and error rate
+    """
+    def run_key(run):
+        return run['distribution'], run['keys'], run['error_rate']
+
+    old_runs = dict((run_key(run), run) for run in baseline['runs'])
+    for run in results['runs']:
+        old = old_runs.get(run_key(run))
+        if old is None:
+            continue
+        print '%s keys=%d error_rate=%s' % run_key(run)
+        new_times, old_times = timings(run), timings(old)
+        for name in sorted(new_times):
+            if old_times.get(name):
+                print '    %-40s %10.6f %7.2fx' % (name, new_times[name], new_times[name] / old_times[name])
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--keys', default='1000,10000')
+    parser.add_option('--error-rates', default='0.01,0.05')
+    parser.add_option('--distributions', default=','.join(DISTRIBUTIONS))
+    parser.add_option('--values', type='int', default=100000, help='values per run for uniform and zipf')
+    parser.add_option('--add-values', type='int', default=20000, help='values timed with single adds')
+    parser.add_option('--queries', type='int', default=1000, help='count calls timed per run')
+    parser.add_option('--sources', type='int', default=8, help='HyperLogLogs merged by update')
+    parser.add_option('--hash', default='sha1', choices=sorted(HASHES))
+    parser.add_option('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_option('--compare', help='a previous JSON output to compare the timings with')
+    options, args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'hash': options.hash,
+        'runs': [],
+    }
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for distribution in options.distributions.split(','):
+            for keys in [int(k) for k in options.keys.split(',')]:
+                for error_rate in [float(e) for e in options.error_rates.split(',')]:
+                    results['runs'].append(run(tmp_dir, distribution, keys, error_rate, options))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
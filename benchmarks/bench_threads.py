@@ -0,0 +1,83 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Measures add_many throughput of a thread safe database shared by a
+number of threads. Each thread ingests batches into its own set of keys.
+
+    python benchmarks/bench_threads.py --threads 1,2,4,8 --hash mix64
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hyperloglogdb import HyperLogLogDB, hll
+
+HASHES = {'sha1': hll.HASH_SHA1, 'mix64': hll.HASH_MIX64}
+
+
+def run(threads, batches, batch_size, hash_id, error_rate):
+    f = tempfile.NamedTemporaryFile(mode='r+b')
+    db = HyperLogLogDB(fileobj=f, error_rate=error_rate, hash_id=hash_id, thread_safe=True)
+    data = [['v%d-%d' % (b, i) for i in range(batch_size)] for b in range(batches)]
+
+    def worker(n):
+        for b, values in enumerate(data):
+            db.add_many('thread%d-key%d' % (n, b % 16), values)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    f.close()
+
+    values = threads * batches * batch_size
+    return {
+        'threads': threads,
+        'values': values,
+        'seconds': elapsed,
+        'values_per_second': values / elapsed,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--threads', default='1,2,4,8')
+    parser.add_option('--batches', type='int', default=50)
+    parser.add_option('--batch-size', type='int', default=20000)
+    parser.add_option('--hash', default='mix64', choices=sorted(HASHES))
+    parser.add_option('--error-rate', type='float', default=0.01)
+    options, args = parser.parse_args()
+
+    results = {'hash': options.hash, 'batch_size': options.batch_size, 'runs': []}
+    for threads in [int(t) for t in options.threads.split(',')]:
+        results['runs'].append(run(threads, options.batches, options.batch_size, HASHES[options.hash], options.error_rate))
+    print json.dumps(results, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,5 @@
 from hlldb import HyperLogLogDB
 from hll import HyperLogLog, MmapSlice
+from parallel import parallel_ingest
+from sharded import ShardedHyperLogLogDB
+from rollup import RollupDB
@@ -0,0 +1,157 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+A portable stream of (key, registers) records, used to move keys between
+databases without the slack of the database file.
+
+Stream structure:
+4 bytes         - magic 'HLLX'
+uint16          - stream format version
+uint8           - hash function id (from hll)
+uint8           - b, where m = 2**b
+followed by a zlib stream of records:
+    uint32      - key length (bytes), END_OF_RECORDS after the last record
+    key bytes
+    uint8       - encoding of the registers, DENSE or SPARSE
+    uint32      - length of the registers (bytes)
+    registers, either m bytes or a list of uint32 register index << 8 |
+    register value for the registers which are not 0
+
+All integers are little-endian. Reading and writing hold one record and one
+chunk of the stream in memory at a time.
+"""
+
+import struct
+import zlib
+import numpy
+
+MAGIC = 'HLLX'
+STREAM_VERSION = 1
+
+DENSE = 0
+SPARSE = 1
+
+END_OF_RECORDS = 0xffffffff
+
+# bytes read from or written to the underlying stream at a time
+CHUNK_SIZE = 1024 * 1024
+
+_header_struct = struct.Struct('<4sHBB')
+
+_key_struct = struct.Struct('<I')
+_registers_struct = struct.Struct('<BI')
+
+
+def encode_record(key_bytes, M):
+    """
+    Returns the record for key_bytes and the uint8 register array M, with
+    the zero registers left out if that is smaller
+    """
+    j = numpy.flatnonzero(M)
+    if len(j) * 4 < len(M):
+        encoding = SPARSE
+        data = ((j << 8) | M[j]).astype('<u4').tobytes()
+    else:
+        encoding = DENSE
+        data = M.tobytes()
+    return _key_struct.pack(len(key_bytes)) + key_bytes + _registers_struct.pack(encoding, len(data)) + data
+
+
+def write_stream(stream, m, hash_id, records):
+    """
+    Writes the (key bytes, registers) pairs from the iterable records to the
+    file like object stream. Returns the number of records written.
+    """
+    stream.write(_header_struct.pack(MAGIC, STREAM_VERSION, hash_id, m.bit_length() - 1))
+
+    compressor = zlib.compressobj()
+    buf = []
+    buf_size = 0
+    count = 0
+    for key_bytes, M in records:
+        record = encode_record(key_bytes, M)
+        buf.append(record)
+        buf_size += len(record)
+        count += 1
+        if buf_size >= CHUNK_SIZE:
+            stream.write(compressor.compress(''.join(buf)))
+            buf = []
+            buf_size = 0
+
+    buf.append(_key_struct.pack(END_OF_RECORDS))
+    stream.write(compressor.compress(''.join(buf)))
+    stream.write(compressor.flush())
+    return count
+
+
+def read_header(stream):
+    """
+    Reads the stream header and returns (m, hash_id)
+    """
+    header = stream.read(_header_struct.size)
+    if len(header) != _header_struct.size:
+        raise ValueError("Truncated stream header")
+    magic, version, hash_id, b = _header_struct.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not a HyperLogLogDB stream")
+    if version > STREAM_VERSION:
+        raise ValueError("Unsupported stream version %d" % version)
+    return 1 << b, hash_id
+
+
+def read_records(stream, m):
+    """
+    Generates (key bytes, registers) pairs from stream after its header.
+    The registers are a new uint8 array of m bytes for each record.
+    """
+    decompressor = zlib.decompressobj()
+    state = {'buf': '', 'pos': 0}
+
+    def read(size):
+        # the next size bytes of decompressed data
+        buf, pos = state['buf'], state['pos']
+        while len(buf) - pos < size:
+            # decompress at most CHUNK_SIZE bytes at a time
+            chunk = decompressor.unconsumed_tail
+            if not chunk:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    raise ValueError("Truncated stream")
+            buf = buf[pos:] + decompressor.decompress(chunk, CHUNK_SIZE)
+            pos = 0
+        state['buf'], state['pos'] = buf, pos + size
+        return buf[pos:pos+size]
+
+    while True:
+        key_len, = _key_struct.unpack(read(_key_struct.size))
+        if key_len == END_OF_RECORDS:
+            return
+        key_bytes = read(key_len)
+        encoding, length = _registers_struct.unpack(read(_registers_struct.size))
+        data = read(length)
+        if encoding == DENSE:
+            if length != m:
+                raise ValueError("Dense registers of %d bytes, expected %d" % (length, m))
+            M = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+        elif encoding == SPARSE:
+            entries = numpy.frombuffer(data, dtype='<u4')
+            M = numpy.zeros(m, dtype=numpy.uint8)
+            M[entries >> 8] = entries & 0xff
+        else:
+            raise ValueError("Unknown register encoding %d" % encoding)
+        yield key_bytes, M
@@ -28,20 +28,174 @@ http://citeseerx.ist.psu.edu/viewdoc/summary?doi=10.1.1.76.4286
 """
 
 import math
+import struct
 from hashlib import sha1
-from bisect import bisect_right
 import numpy
 
+# number of leading zero bits in each byte value
+_CLZ8 = numpy.array([8 - i.bit_length() for i in range(256)], dtype=numpy.uint8)
+
+# 2.0 ** -k for every register value
+_POW2_NEG = 2.0 ** -numpy.arange(256)
+
+# Hash functions. The id is stored in the HyperLogLogDB header, so the
+# values must never change.
+HASH_SHA1 = 0
+HASH_MIX64 = 1
+
+# Register layouts, also stored in the HyperLogLogDB header. Packed registers
+# take 6 bits each, 4 registers to 3 bytes, and are capped at PACKED_MAX_RHO.
+LAYOUT_BYTES = 0
+LAYOUT_PACKED = 1
+PACKED_MAX_RHO = 63
+
+_MASK64 = (1 << 64) - 1
+_P1 = 0x9E3779B185EBCA87
+_P2 = 0xC2B2AE3D27D4EB4F
+_P3 = 0x165667B19E3779F9
+_P4 = 0x85EBCA77C2B2AE63
+_P5 = 0x27D4EB2F165667C5
+
+
+def _sha1(value):
+    return long(sha1(value).hexdigest(), 16)
+
+
+def _sha1_digests(values):
+    digests = numpy.frombuffer(''.join([sha1(v).digest() for v in values]), dtype=numpy.uint8)
+    return digests.reshape(-1, sha1().digest_size)
+
+
+def _rotl64(x, r):
+    return ((x << r) | (x >> (64 - r))) & _MASK64
+
+
+def _mix64(value):
+    """
+    64-bit hash in the style of xxhash64. The value is consumed in 8 byte
+    little-endian words, with the last word padded with zeros.
+    """
+    value = str(value)
+    n = len(value)
+    h = (_P5 + n) & _MASK64
+    padded = value + '\x00' * (-n % 8)
+    for k in struct.unpack('<%dQ' % (len(padded) // 8), padded):
+        k = _rotl64(k * _P2 & _MASK64, 31) * _P1 & _MASK64
+        h = (_rotl64(h ^ k, 27) * _P1 + _P4) & _MASK64
+    h ^= h >> 33
+    h = h * _P2 & _MASK64
+    h ^= h >> 29
+    h = h * _P3 & _MASK64
+    h ^= h >> 32
+    return h
+
+
+def _mix64_array(values):
+    """
+    Vectorized version of _mix64 which hashes a batch of values one word
+    column at a time
+    """
+    values = [str(v) for v in values]
+    lengths = numpy.fromiter((len(v) for v in values), dtype=numpy.uint64, count=len(values))
+    words = (lengths + 7) // 8
+    width = int(words.max()) if len(values) else 0
+
+    # trailing NULs are dropped by the 'S' dtype, which is the same as padding
+    data = numpy.zeros(len(values), dtype='S%d' % max(width * 8, 8))
+    data[:] = values
+    data = data.view('<u8').reshape(len(values), -1)
+
+    u = numpy.uint64
+    h = lengths + u(_P5)
+    for i in range(width):
+        k = data[:, i] * u(_P2)
+        k = ((k << u(31)) | (k >> u(33))) * u(_P1)
+        x = h ^ k
+        x = ((x << u(27)) | (x >> u(37))) * u(_P1) + u(_P4)
+        h = numpy.where(words > i, x, h)
+    h ^= h >> u(33)
+    h *= u(_P2)
+    h ^= h >> u(29)
+    h *= u(_P3)
+    h ^= h >> u(32)
+    return h
+
+
+def _mix64_digests(values):
+    return _mix64_array(values).astype('>u8').view(numpy.uint8).reshape(-1, 8)
+
+
+def packed_size(m):
+    # bytes taken by m packed registers
+    return m * 3 // 4
+
+def pack_registers(M):
+    """
+    Packs a uint8 array of registers, or a 2-d array of rows of registers,
+    into 6 bits per register. Each group of 4 registers is stored as 3
+    bytes holding r0 | r1 << 6 | r2 << 12 | r3 << 18 little-endian.
+    Registers above PACKED_MAX_RHO are capped.
+    """
+    M = numpy.minimum(M, PACKED_MAX_RHO).astype(numpy.uint8)
+    r = M.reshape(M.shape[:-1] + (-1, 4))
+    P = numpy.empty(r.shape[:-1] + (3,), dtype=numpy.uint8)
+    # the uint8 shifts drop the bits which belong to the next byte
+    P[..., 0] = r[..., 0] | (r[..., 1] << 6)
+    P[..., 1] = (r[..., 1] >> 2) | (r[..., 2] << 4)
+    P[..., 2] = (r[..., 2] >> 4) | (r[..., 3] << 2)
+    return P.reshape(M.shape[:-1] + (-1,))
+
+def unpack_registers(P):
+    """
+    Unpacks a uint8 array of packed registers, or a 2-d array of rows of
+    them, into one byte per register
+    """
+    P = numpy.asarray(P, dtype=numpy.uint8)
+    p = P.reshape(P.shape[:-1] + (-1, 3))
+    M = numpy.empty(p.shape[:-1] + (4,), dtype=numpy.uint8)
+    M[..., 0] = p[..., 0] & 0x3f
+    M[..., 1] = (p[..., 0] >> 6) | ((p[..., 1] & 0x0f) << 2)
+    M[..., 2] = (p[..., 1] >> 4) | ((p[..., 2] & 0x03) << 4)
+    M[..., 3] = p[..., 2] >> 2
+    return M.reshape(P.shape[:-1] + (-1,))
+
+def raise_packed(data, offset, j, rho):
+    """
+    Raises packed register j of the registers at offset in data to rho,
+    touching only its 3 bytes. Returns True if it was raised.
+    """
+    pos = offset + (j >> 2) * 3
+    shift = (j & 3) * 6
+    group = ord(data[pos]) | ord(data[pos+1]) << 8 | ord(data[pos+2]) << 16
+    if rho <= (group >> shift) & 0x3f:
+        return False
+    group = group & ~(0x3f << shift) | rho << shift
+    data[pos:pos+3] = chr(group & 0xff) + chr(group >> 8 & 0xff) + chr(group >> 16)
+    return True
+
+# hash_id -> (bits, scalar hash, batch hash returning big-endian digest bytes)
+HASHES = {
+    HASH_SHA1: (160, _sha1, _sha1_digests),
+    HASH_MIX64: (64, _mix64, _mix64_digests),
+}
+
 class HyperLogLog(object):
     """
     HyperLogLog cardinality counter
     """
 
-    def __init__(self, error_rate, data, bitcount_arr=None):
+    __slots__ = ('alpha', 'b', 'm', 'M', 'hash_id', 'hash_bits', 'packed')
+
+    def __init__(self, error_rate, data, bitcount_arr=None, hash_id=HASH_SHA1, packed=False):
         """
         Implementes a HyperLogLog
 
         error_rate = abs_err / cardinality
+
+        bitcount_arr is no longer used and is only accepted for compatibility
+
+        With packed=True data holds packed_size(m) bytes of 6-bit registers
+        instead of m bytes
         """
 
         if not (0 < error_rate < 1):
@@ -60,8 +214,28 @@ class HyperLogLog(object):
         if not isinstance(data, MmapSlice):
             raise ValueError("data must be of type MmapSlice")
 
+        if hash_id not in HASHES:
+            raise ValueError("Unknown hash_id %r" % hash_id)
+
         self.M = data
-        self.bitcount_arr = bitcount_arr or self._get_bitcount_arr(error_rate, b)
+        self.hash_id = hash_id
+        self.hash_bits = HASHES[hash_id][0]
+        self.packed = packed
+
+    def _with_data(self, data):
+        """
+        Returns a new HyperLogLog with the same parameters over the
+        MmapSlice data, without recomputing them
+        """
+        other = HyperLogLog.__new__(HyperLogLog)
+        other.alpha = self.alpha
+        other.b = self.b
+        other.m = self.m
+        other.M = data
+        other.hash_id = self.hash_id
+        other.hash_bits = self.hash_bits
+        other.packed = self.packed
+        return other
 
     @staticmethod
     def _get_size(error_rate):
@@ -69,12 +243,6 @@ class HyperLogLog(object):
         m = 1 << b
         return m
 
-    @staticmethod
-    def _get_bitcount_arr(error_rate, b=None):
-        if not b:
-            b = int(math.ceil(math.log((1.04 / error_rate) ** 2, 2)))
-        return [ 1L << i for i in range(160 - b + 1) ]
-
     @staticmethod
     def _get_alpha(b):
         if not (4 <= b <= 16):
@@ -92,28 +260,118 @@ class HyperLogLog(object):
         return 0.7213 / (1.0 + 1.079 / (1 << b))
 
     @staticmethod
-    def _get_rho(w, arr):
-        rho = len(arr) - bisect_right(arr, w)
-        if rho == 0:
+    def _get_rho(w, width):
+        # number of leading zeros of w in a width-bit word, plus one
+        rho = width - w.bit_length() + 1
+        if rho <= 0:
             raise ValueError('w overflow')
         return rho
 
     def add(self, value):
         """
-        Adds the item to the HyperLogLog
+        Adds the item to the HyperLogLog. Returns True if a register was
+        raised.
         """
-        # h: D -> {0,1} ** 160
+        # h: D -> {0,1} ** hash_bits
         # x = h(v)
         # j = <x_1x_2..x_b>
         # w = <x_{b+1}x_{b+2}..>
         # M[j] = max(M[j], rho(w))
 
-        x = long(sha1(value).hexdigest(), 16)
-        j = x & ((1 << self.b) - 1)
-        w = x >> self.b
+        j, rho = self._index_rho(value)
+
+        if self.packed:
+            return raise_packed(self.M.data, self.M.offset, j, min(rho, PACKED_MAX_RHO))
+
+        rho = chr(rho)
+        if rho > self.M[j]:
+            self.M[j] = rho
+            return True
+        return False
+
+    def _index_rho(self, value):
+        # the register index and rho of a single value
+        x = HASHES[self.hash_id][1](value)
+        return x & ((1 << self.b) - 1), self._get_rho(x >> self.b, self.hash_bits - self.b)
+
+    @staticmethod
+    def _get_index_rho(values, b, hash_id=HASH_SHA1):
+        """
+        Hashes a batch of values and returns numpy arrays of the register
+        indexes and rho values, matching what add() computes for each value
+        """
+        digests = HASHES[hash_id][2](values)
+        bits = digests.shape[1] * 8
+
+        # j is the low b bits of the big-endian digest (b <= 16)
+        j = (digests[:, -2].astype(numpy.int64) << 8 | digests[:, -1]) & ((1 << b) - 1)
+
+        # rho(w) is the number of leading zeros of the digest plus one,
+        # capped at the width of w
+        nonzero = digests != 0
+        first = nonzero.argmax(axis=1)
+        clz = first * 8 + _CLZ8[digests[numpy.arange(len(digests)), first]]
+        clz[~nonzero.any(axis=1)] = bits
+        rho = numpy.minimum(clz + 1, bits - b + 1).astype(numpy.uint8)
+
+        return j, rho
 
-        self.M[j] = max(self.M[j], chr(self._get_rho(w, self.bitcount_arr)))
+    def add_many(self, values):
+        """
+        Adds a batch of items to the HyperLogLog. The result is identical
+        to calling add() for each item. Returns the number of registers
+        raised.
+        """
+        values = list(values)
+        if not values:
+            return 0
+
+        j, rho = self._get_index_rho(values, self.b, self.hash_id)
+        return self._update_registers(j, rho)
 
+    def _update_registers(self, j, rho):
+        """
+        Raises the registers at indexes j to rho where rho is larger and
+        writes the block back in one pass. Returns the number of registers
+        raised.
+        """
+        if not self.packed:
+            return HyperLogLog._raise_registers(self.M.view(), j, rho)
+
+        M = self.registers()
+        raised = HyperLogLog._raise_registers(M, j, numpy.minimum(rho, PACKED_MAX_RHO).astype(numpy.uint8))
+        if raised:
+            self.M.view()[:] = pack_registers(M)
+        return raised
+
+    def registers(self):
+        """
+        Returns the registers as a uint8 array. For one byte registers it is
+        a view of the data, for packed registers an unpacked copy.
+        """
+        if self.packed:
+            return unpack_registers(self.M.view())
+        return self.M.view()
+
+    def _set_registers(self, M):
+        # overwrites the registers with those of the uint8 array M
+        if self.packed:
+            self.M.view()[:] = pack_registers(M)
+        else:
+            self.M.view()[:] = M
+
+    @staticmethod
+    def _raise_registers(current, j, rho):
+        """
+        Raises the registers at indexes j of the uint8 array current to rho
+        where rho is larger. Returns the number of registers raised.
+        """
+        M1 = numpy.zeros(len(current), dtype=numpy.uint8)
+        numpy.maximum.at(M1, j, rho)
+
+        raised = M1 > current
+        current[raised] = M1[raised]
+        return int(numpy.count_nonzero(raised))
 
     def update(self, others):
         """
@@ -126,12 +384,14 @@ class HyperLogLog(object):
         for other in others:
             if self.m != other.m:
                 raise ValueError('Counters precisions should be equal')
+            if self.hash_id != other.hash_id:
+                raise ValueError('Counters hash functions should be equal')
 
-        arr = numpy.array(map(lambda other: bytearray(other.M.read(other.m)), others) + [bytearray(self.M.read(self.m))])
-
-        M1 = bytearray(numpy.amax(arr,axis=0))
-
-        self.M.write(str(M1))
+        M1 = self.registers()
+        for other in others:
+            numpy.maximum(M1, other.registers(), out=M1)
+        if self.packed:
+            self._set_registers(M1)
 
 
     # def __eq__(self, other):
@@ -153,30 +413,57 @@ class HyperLogLog(object):
         """
         Returns the estimate of the cardinality
         """
-        M1 = self.M.read(self.m)
-        E = self.alpha * float(self.m ** 2) / sum([2.0 ** -x for x in bytearray(M1)])
+        return self._estimate(self.registers())
+
+    def _estimate(self, M1):
+        """
+        Returns the estimate of the cardinality for the register array M1
+        """
+        hist = numpy.bincount(M1)
+        E = self.alpha * float(self.m ** 2) / numpy.dot(hist, _POW2_NEG[:len(hist)])
 
         if E <= 2.5 * self.m:             # Small range correction
             #print 'Small corr'
-            V = M1.count('\x00') #count number or registers equal to 0
+            V = hist[0] #count number or registers equal to 0
             return self.m * math.log(self.m / float(V)) if V > 0 else E
-        elif E <= float(1L << 160) / 30.0:  #intermidiate range correction -> No correction
+        elif E <= float(1L << self.hash_bits) / 30.0:  #intermidiate range correction -> No correction
             #print 'No corr'
             return E
         else:
             # print 'Large corr'
-            return -(1L << 160) * math.log(1.0 - E / (1L << 160))
+            return -(1L << self.hash_bits) * math.log(1.0 - E / (1L << self.hash_bits))
+
+class MmapRef(object):
+    """
+    A shared reference to an mmap. Slices created over the same MmapRef all
+    follow it when the mmap is replaced, e.g. after the file grows.
+    """
+    __slots__ = ('mmap',)
+
+    def __init__(self, mmap_file):
+        self.mmap = mmap_file
 
 class MmapSlice(object):
-    data = None
-    length = None
-    offset = None
+    __slots__ = ('_data', 'length', 'offset')
 
     def __init__(self, mmap_file, length, offset=0):
-        self.data = mmap_file
+        """
+        mmap_file is either an mmap or an MmapRef
+        """
+        self._data = mmap_file
         self.length = length
         self.offset = offset
 
+    @property
+    def data(self):
+        if type(self._data) is MmapRef:
+            return self._data.mmap
+        return self._data
+
+    @data.setter
+    def data(self, mmap_file):
+        self._data = mmap_file
+
     # def __iter__(self):
     #   for x in self.data[self.offset:self.offset+self.length]:
     #       yield x
@@ -197,6 +484,8 @@ class MmapSlice(object):
     def __eq__(self, other):
         if self.length != len(other):
             return False
+        if isinstance(other, MmapSlice):
+            return numpy.array_equal(self.view(), other.view())
         for i in range(self.length):
             if self[i] != other[i]:
                 return False
@@ -205,17 +494,22 @@ class MmapSlice(object):
     def __ne__(self, other):
         return not self == other
 
+    def view(self):
+        """
+        Returns a numpy uint8 array sharing memory with the slice. It keeps
+        the mmap it was created from, so it doesn't follow an MmapRef which
+        is pointed at a new mmap.
+        """
+        return numpy.frombuffer(self.data, dtype=numpy.uint8, count=self.length, offset=self.offset)
+
     def count(self, val):
-        self.data.seek(self.offset)
-        return self.data.read(self.length).count(val)
+        return int(numpy.count_nonzero(self.view() == ord(val)))
 
     def write(self, data):
-        self.data.seek(self.offset)
-        return self.data.write(data)
+        self.data[self.offset:self.offset+len(data)] = data
 
     def read(self, length):
-        self.data.seek(self.offset)
-        return self.data.read(length)
+        return self.data[self.offset:self.offset+length]
 
     def seek(self, index):
         return
@@ -17,98 +17,542 @@ along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
 import struct
+import collections
 import mmap
 import os
+import zlib
+import array
+import threading
+import time
+import itertools
+import contextlib
+import numpy
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc_madvise = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).madvise
+    _libc_madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+except (ImportError, OSError, AttributeError, TypeError):
+    _libc_madvise = None
 
 import hll
+import export
+
+# Version of the on-disk format written by this module. Files written before
+# the version was stored in the header read as version 0.
+#
+# 0, 1 - JSON index
+# 2    - binary hash table index
+# 3    - sparse blocks
+# 4    - packed 6-bit registers
+FORMAT_VERSION = 4
+
+# sparse blocks have room for 2**k - 1 registers, starting from this many
+SPARSE_MIN_ENTRIES = 15
+# a sparse block is promoted to a dense one past m / SPARSE_DIVISOR registers
+SPARSE_DIVISOR = 16
+
+# initial number of slots in the index hash table
+INDEX_CAPACITY = 64
+
+# initial number of entries in the free list
+FREE_LIST_CAPACITY = 64
+
+# keys copied per chunk by compact
+COMPACT_CHUNK_KEYS = 10000
+
+# keys read per batch by import_
+IMPORT_BATCH_KEYS = 1000
+
+# number of locks guarding register updates in thread safe mode
+LOCK_STRIPES = 64
+
+class NoLock(object):
+    """
+    Stands in for a lock when the database is not thread safe
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+NO_LOCK = NoLock()
+
+class MultiLock(object):
+    """
+    Holds a list of locks at once, taken in order
+    """
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
+
+# working memory for the register blocks of one merge chunk
+MERGE_CHUNK_BYTES = 64 * 1024 * 1024
+
+# durability policies: only flush() makes writes durable, or a background
+# thread syncs every flush_interval seconds or after every flush_ops writes
+DURABILITY_NONE = 'none'
+DURABILITY_INTERVAL = 'interval'
+DURABILITY_OPS = 'ops'
+
+# madvise hints, with the values shared by Linux and the BSDs
+MADV_NORMAL = getattr(mmap, 'MADV_NORMAL', 0)
+MADV_RANDOM = getattr(mmap, 'MADV_RANDOM', 1)
+MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', 2)
+
+def madvise(mfile, advice, offset=0, length=None):
+    """
+    Tells the kernel how the pages of mfile from offset will be read, with
+    mmap.madvise where Python has it and libc madvise otherwise. Returns
+    False where neither is available. The hint is only advice, so errors
+    are ignored.
+    """
+    if length is None:
+        length = len(mfile) - offset
+    # madvise takes a page aligned start
+    length += offset % mmap.PAGESIZE
+    offset -= offset % mmap.PAGESIZE
+    if length <= 0:
+        return True
+    if hasattr(mfile, 'madvise'):
+        mfile.madvise(advice, offset, length)
+        return True
+    if _libc_madvise is None:
+        return False
+    address = numpy.frombuffer(mfile, dtype=numpy.uint8, count=1).ctypes.data
+    _libc_madvise(address + offset, length, advice)
+    return True
+
+# counters returned by stats(). Timed operations have a _count, _seconds and
+# the totals of the amounts they report.
+STATS = ('values_added', 'registers_changed', 'keys_created', 'keys_deleted',
+         'resize_count', 'resize_bytes', 'resize_seconds',
+         'flush_count', 'flush_bytes', 'flush_seconds',
+         'index_flush_count', 'index_flush_keys', 'index_flush_bytes', 'index_flush_seconds',
+         'merge_count', 'merge_keys', 'merge_seconds',
+         'compact_count', 'compact_keys', 'compact_seconds')
+
+class Flusher(threading.Thread):
+    """
+    Calls db.sync() every interval seconds, or whenever wake is set if
+    interval is None. Writes made while a sync runs are picked up by the
+    next one, so a single sync covers every write since the last.
+    """
+    def __init__(self, db, interval):
+        threading.Thread.__init__(self, name='hlldb-flusher')
+        self.daemon = True
+        self.db = db
+        self.interval = interval
+        self.wake = threading.Event()
+        self.stopped = False
+        self.error = None
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.db.sync()
+            except Exception, e:
+                # raised to the caller of close()
+                self.error = e
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        self.join()
 
 class HyperLogLogDB(object):
     fobj = None
+    owns_fobj = False
     mfile = None
+    mref = None
     idx = None
+    offsets = None
+    lengths = None
+    records = None
+    hll_template = None
     f_header = None
     f_idx = None
     header_struct = None
+    idx_header_struct = None
+    record_struct = None
     idx_offset = 0
     idx_length = 0
     last_pos = 0
     file_size = 0
+    idx_capacity = 0
+    idx_count = 0
+    free = None
+    freed = None
+    free_used = None
+    free_entries = None
+    free_pos = None
+    free_slots = None
+    free_offset = 0
+    free_capacity = 0
+    lazy = False
+    growth_factor = 2.0
+    growth_step = mmap.PAGESIZE*1000
+    thread_safe = False
+    sparse = False
+    layout = hll.LAYOUT_BYTES
     m = 0
+    block_size = 0
     error_rate = 0.01
-    bitcount_arr = None
+    version = FORMAT_VERSION
+    hash_id = hll.HASH_SHA1
 
-    def __init__(self, file_path=None, fileobj=None, error_rate=0.01):
+    cache_size = 0
+    cache_hits = 0
+    cache_misses = 0
+    cache_generation = 0
+
+    durability = DURABILITY_NONE
+    flush_ops = 0
+    flusher = None
+    track_dirty = False
+    dirty = None
+    dirty_ops = 0
+    sync_count = 0
+    sync_pages = 0
+    sync_ranges = 0
+    sync_last_seconds = 0.0
+    sync_max_seconds = 0.0
+    sync_total_seconds = 0.0
+    counters = None
+    hooks = ()
+    readonly = False
+    advice = MADV_NORMAL
+
+    def __init__(self, file_path=None, fileobj=None, error_rate=0.01, hash_id=hll.HASH_SHA1, cache_size=100000, lazy=False,
+                 expected_keys=0, growth_factor=2.0, growth_step=mmap.PAGESIZE*1000, thread_safe=False, sparse=False,
+                 packed=False, durability=DURABILITY_NONE, flush_interval=1.0, flush_ops=1000, readonly=False):
         """
         Header structure:
         unsigned long   - index offset
         unsigned long   - index length (bytes)
         unsigned long   - last position
         float           - error_rate
+        unsigned short  - format version
+        unsigned char   - hash function id (from hll)
+        unsigned char   - register layout (from hll, version 4)
         unsigned long   - m value for this error_rate (from hll)
+
+        The version, hash id and layout occupy what was the alignment padding
+        after error_rate in version 0 files, so those read as version 0 with
+        the sha1 hash and one byte registers. That padding only exists where
+        longs are 64 bits (LP64, as on 64 bit Linux and macOS); elsewhere a
+        version 0 file raises a ValueError.
+
+        Index structure (version 2), stored at the index offset:
+        uint64          - capacity of the hash table (slots)
+        uint64          - number of keys in the hash table
+        uint64          - offset of the free list, 0 if there is none
+        uint64          - capacity of the free list (entries)
+        uint64          - number of entries in the free list
+        24 bytes        - reserved
+        capacity slots of:
+            uint64      - crc32 of the key
+            uint64      - offset of the key record, 0 if the slot is empty
+
+        Free list structure, stored anywhere after the header:
+        capacity entries of:
+            uint64      - offset of a free block
+            uint64      - length of the block (bytes)
+
+        Key record structure, stored anywhere after the header:
+        uint64          - offset of the HLL data
+        uint32          - length of the HLL data (bytes)
+        uint32          - key length (bytes)
+        key bytes
+
+        HLL data of block_size bytes is a dense block with one byte per
+        register, or with the LAYOUT_PACKED layout 4 registers packed in 3
+        bytes. Any other length is a sparse block (added in version 3):
+        uint32          - number of entries
+        entries sorted by register index of:
+            uint32      - register index << 8 | register value
+
+        In memory the index maps each key to a slot number. The block
+        offsets and lengths and the record offsets of the slots are kept in
+        arrays, and HyperLogLog objects are only created when a key is used.
+
+        With lazy=True the index is not read when the file is opened. Keys
+        are looked up in the hash table in the mmap the first time they are
+        used, so opening takes the same time for any number of keys. Files
+        with a JSON index are always read eagerly.
+
+        The file grows by growth_factor, and by at least growth_step bytes,
+        each time it runs out of space. expected_keys preallocates the file
+        and the index for that many more keys.
+
+        With thread_safe=True the database can be shared by threads. Creating
+        keys, growing the file and flushing are serialized by one lock, and
+        register updates take one of LOCK_STRIPES locks picked by the key.
+        Counts read the registers without locking. Batches are hashed before
+        any lock is taken, and the numpy work in add_many and add_pairs
+        releases the GIL for large batches, most of all with HASH_MIX64.
+
+        With sparse=True keys created by adding values start as sparse
+        blocks holding only the registers which are set. They are promoted
+        to dense blocks once more than m / SPARSE_DIVISOR registers are set,
+        or when get_hll hands out the registers. Blocks left behind by a
+        move go on the free list. Error rates with fewer than 256 registers
+        always use dense blocks.
+
+        With packed=True a new database stores dense blocks with 6-bit
+        registers, a quarter smaller. Registers are capped at
+        hll.PACKED_MAX_RHO, which only matters for 1 in 2**63 values. The
+        layout of an existing file is read from its header.
+
+        flush() writes the index, syncs the whole mapping and fsyncs the
+        file on the calling thread. With durability=DURABILITY_INTERVAL a
+        background thread calls sync() every flush_interval seconds instead,
+        and with DURABILITY_OPS after every flush_ops writes. sync() only
+        msyncs the pages written since the last sync, one range per run of
+        pages, and writes made during a sync are committed by the next one.
+        A background flusher makes the database thread safe. Call close() to
+        stop it.
+
+        With readonly=True an existing file is opened in mode 'rb' and
+        mapped with mmap.ACCESS_READ, and nothing is ever written, so any
+        number of processes can read a file while one process writes it.
+        Methods which would write raise an IOError. refresh() picks up the
+        keys the writer has flushed since. Read-only mappings are advised
+        for random access, and full scans advise sequential access while
+        they run.
         """
 
-        self.header_struct = struct.Struct('LLLfL')
+        self.header_struct = struct.Struct('LLLfHBBL')
+        self.idx_header_struct = struct.Struct('<QQQQQ24x')
+        self.record_struct = struct.Struct('<QII')
         # self.header_struct = struct.Struct('iiifi')
         self.error_rate = error_rate
 
+        if hash_id not in hll.HASHES:
+            raise ValueError("Unknown hash_id %r" % hash_id)
+        self.hash_id = hash_id
+        self.lazy = lazy
+        self.growth_factor = growth_factor
+        self.growth_step = growth_step
+        self.sparse = sparse
+
+        if durability not in (DURABILITY_NONE, DURABILITY_INTERVAL, DURABILITY_OPS):
+            raise ValueError("Unknown durability %r" % durability)
+        if readonly and durability != DURABILITY_NONE:
+            raise ValueError("A read-only database has nothing to flush")
+        self.readonly = readonly
+        self.advice = MADV_RANDOM if readonly else MADV_NORMAL
+        self.durability = durability
+        self.flush_ops = flush_ops
+        # the pages written are only tracked for a flusher, or once sync()
+        # has been called
+        self.track_dirty = durability != DURABILITY_NONE
+
+        # the flusher thread syncs while the caller writes
+        self.thread_safe = thread_safe = thread_safe or durability != DURABILITY_NONE
+        if thread_safe:
+            self.lock = threading.RLock()
+            self.cache_lock = threading.Lock()
+            self.dirty_lock = threading.Lock()
+            self.stripes = [threading.Lock() for i in range(LOCK_STRIPES)]
+        else:
+            self.lock = self.cache_lock = self.dirty_lock = NO_LOCK
+
+        # numbers of the pages written since the last sync
+        self.dirty = set()
+
+        self.counters = collections.defaultdict(int, dict.fromkeys(STATS, 0))
+        self.hooks = ()
+
+        # LRU of key -> cached count, invalidated when the registers change
+        self.cache_size = cache_size
+        self.count_cache = collections.OrderedDict()
+        # keys whose HyperLogLog get_hll has handed out. They can change
+        # without the database seeing it, so their counts aren't cached.
+        self.handed_out = set()
+
         if fileobj:
             self.fobj = fileobj
+        elif file_path and readonly:
+            self.fobj = open(file_path, 'rb')
+            self.owns_fobj = True
         elif file_path:
             if not os.access(file_path, os.R_OK | os.W_OK):
                 self.fobj = open(file_path, 'wb')
                 self.fobj.close()
             self.fobj = open(file_path, 'r+b')
+            self.owns_fobj = True
         else:
             raise ValueError("Must include either file_path or fileobj")
 
-        if self.fobj.mode != 'r+b':
+        if readonly:
+            if self.fobj.mode not in ('rb', 'r+b'):
+                raise ValueError("fileobj must be opened in mode rb or r+b")
+        elif self.fobj.mode != 'r+b':
             raise ValueError("fileobj must be opened in mode w+b")
 
         self.fobj.seek(0)
         data = self.fobj.read(mmap.PAGESIZE)
-        self.bitcount_arr = hll.HyperLogLog._get_bitcount_arr(error_rate)
 
-        if not data:
+        if not data and readonly:
+            raise ValueError("Can't open an empty file read-only")
+        elif not data:
             # print "Writing blank header"
             self.write_bytes(0, self.header_struct.size)
             self.file_size = self.header_struct.size
-            self.mfile = mmap.mmap(self.fobj.fileno(), 0)
-            self.f_header = hll.MmapSlice(self.mfile, self.header_struct.size, 0)
+            self.mfile = self._map()
+            self.mref = hll.MmapRef(self.mfile)
+            self.f_header = hll.MmapSlice(self.mref, self.header_struct.size, 0)
+            self.m = hll.HyperLogLog._get_size(error_rate)
+            self.layout = hll.LAYOUT_PACKED if packed else hll.LAYOUT_BYTES
             self.write_header()
-            self.idx = {}
+            self._reset_slots()
+            self.pending = []
             self.idx_length = 0
-            self.idx_offset = self.header_struct.size
+            self.idx_offset = 0
             self.last_pos = self.header_struct.size
             self.error_rate = error_rate
-            self.m = hll.HyperLogLog._get_size(error_rate)
+            self._init_template()
             self.flush_idx()
         else:
-            self.fobj.seek(0, os.SEEK_END)
-            self.file_size = self.fobj.tell()
-            self.mfile = mmap.mmap(self.fobj.fileno(), 0)
-            self.f_header = hll.MmapSlice(self.mfile, self.header_struct.size, 0)
-            self.read_header()
-            self.f_idx = hll.MmapSlice(self.mfile, self.idx_length, offset=self.idx_offset)
-            self.read_idx()
+            self._open_file()
 
-    def resize(self, new_size):
-        blocksize = mmap.PAGESIZE*1000
+        if expected_keys:
+            self.reserve(expected_keys)
+
+        if durability != DURABILITY_NONE:
+            self.flusher = Flusher(self, flush_interval if durability == DURABILITY_INTERVAL else None)
+            self.flusher.start()
+
+    def _open_file(self):
+        # maps an existing file and reads its header and index
+        self.fobj.seek(0, os.SEEK_END)
+        self.file_size = self.fobj.tell()
+        self.mfile = self._map()
+        self.mref = hll.MmapRef(self.mfile)
+        self.f_header = hll.MmapSlice(self.mref, self.header_struct.size, 0)
+        self.read_header()
+        self._init_template()
+        self.f_idx = hll.MmapSlice(self.mref, self.idx_length, offset=self.idx_offset)
+        self.read_idx()
+
+    def _map(self):
+        # maps the whole file, read only in readonly mode
+        if self.readonly:
+            mfile = mmap.mmap(self.fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            mfile = mmap.mmap(self.fobj.fileno(), 0)
+        if self.advice != MADV_NORMAL:
+            madvise(mfile, self.advice)
+        return mfile
+
+    @contextlib.contextmanager
+    def _scan(self, offset=0, length=None):
+        # advises sequential access to a range of the file while it is read
+        # through, then restores the usual advice
+        madvise(self.mfile, MADV_SEQUENTIAL, offset, length)
+        try:
+            yield
+        finally:
+            madvise(self.mfile, self.advice, offset, length)
+
+    def _check_writable(self):
+        if self.readonly:
+            raise IOError("The database is open read-only")
+
+    def refresh(self):
+        """
+        Picks up what the writer has flushed since the file was opened or
+        last refreshed: the file is remapped at its new size and the header
+        and index are read again. A file replaced by compact is reopened.
+        The count cache is cleared, since registers may have changed.
+        Only for databases opened read-only.
+
+        Returns True if the index or the file size changed.
+        """
+        if not self.readonly:
+            raise ValueError("refresh is only for databases opened read-only")
+        with self.lock:
+            path = getattr(self.fobj, 'name', None)
+            if self.owns_fobj and isinstance(path, basestring):
+                try:
+                    replaced = os.stat(path).st_ino != os.fstat(self.fobj.fileno()).st_ino
+                except OSError:
+                    replaced = False
+                if replaced:
+                    self.fobj.close()
+                    self.fobj = open(path, 'rb')
 
+            before = (self.file_size, self.idx_offset, self.last_pos, self.idx_count)
+            self._open_file()
+            with self.cache_lock:
+                self.cache_generation += 1
+                self.count_cache.clear()
+            return (self.file_size, self.idx_offset, self.last_pos, self.idx_count) != before
+
+    def _init_template(self):
+        packed = self.layout == hll.LAYOUT_PACKED
+        self.block_size = hll.packed_size(self.m) if packed else self.m
+        self.hll_template = hll.HyperLogLog(self.error_rate, hll.MmapSlice(None, self.block_size), hash_id=self.hash_id,
+                                            packed=packed)
+
+    def reserve(self, keys):
+        """
+        Preallocates the file and the index for keys more keys, assuming
+        keys of about 32 bytes
+        """
+        self._check_writable()
+        with self.lock:
+            if self.version >= 2:
+                self.grow_idx(self.idx_count + len(self.pending) + keys)
+            self.resize(self.last_pos + keys * (self.block_size + self.record_struct.size + 32))
+
+    def allocate(self, size, align=8):
+        """
+        Reserves size bytes at the end of the data and returns the offset
+        """
+        offset = self.last_pos + (-self.last_pos % align)
+        self.resize(offset+size)
+        self.last_pos = offset + size
+        return offset
+
+    def resize(self, new_size):
+        """
+        Grows the file to at least new_size bytes. Growing geometrically
+        keeps the number of remaps logarithmic in the size of the file, and
+        all slices follow the new mmap through self.mref.
+        """
         if self.file_size >= new_size:
             return
 
-        expand_to = new_size + blocksize - new_size % blocksize
-        self.mfile.flush()
-        self.write_bytes(self.file_size, expand_to-self.file_size)
+        start = time.time()
+        expand_to = max(new_size, int(self.file_size * self.growth_factor), self.file_size + self.growth_step)
+        expand_to += -expand_to % mmap.PAGESIZE
+        # ftruncate, so the new space is sparse until it is written
+        self.fobj.truncate(expand_to)
+        grown = expand_to - self.file_size
         self.file_size = expand_to
-        self.mfile = mmap.mmap(self.fobj.fileno(), 0)
-
-        if self.f_header:
-            self.f_header.data = self.mfile
-        if self.f_idx:
-            self.f_idx.data = self.mfile
-        for obj in self.idx.itervalues():
-            obj['mmap'].data = self.mfile
+        self.mfile = self._map()
+        self.mref.mmap = self.mfile
+        self._timed('resize', start, bytes=grown)
 
     def write_bytes(self, start, length):
         self.fobj.seek(start+length-1)
@@ -116,101 +560,1389 @@ class HyperLogLogDB(object):
         self.fobj.flush()
 
     def read_header(self):
-        data = self.header_struct.unpack(self.f_header.read(self.header_struct.size))
-        self.idx_offset, self.idx_length, self.last_pos, self.error_rate, self.m = data
+        raw = self.f_header.read(self.header_struct.size)
+        data = self.header_struct.unpack(raw)
+        self.idx_offset, self.idx_length, self.last_pos, self.error_rate, self.version, self.hash_id, self.layout, self.m = data
+
+        if self.version > FORMAT_VERSION:
+            # without padding after error_rate the m of a version 0 header
+            # is where the version is now
+            legacy = struct.Struct('LLLfL')
+            error_rate, m = legacy.unpack_from(raw)[3:]
+            if legacy.size < self.header_struct.size and 0 < error_rate < 1 and m == hll.HyperLogLog._get_size(error_rate):
+                raise ValueError("Version 0 files can only be opened on platforms with 64 bit longs")
+            raise ValueError("Unsupported file format version %d" % self.version)
+        if self.hash_id not in hll.HASHES:
+            raise ValueError("Unknown hash_id %r" % self.hash_id)
+        if self.layout not in (hll.LAYOUT_BYTES, hll.LAYOUT_PACKED):
+            raise ValueError("Unknown register layout %r" % self.layout)
 
     def write_header(self):
-        data = self.header_struct.pack(self.idx_offset, self.idx_length, self.last_pos, self.error_rate, self.m)
+        data = self.header_struct.pack(self.idx_offset, self.idx_length, self.last_pos, self.error_rate, self.version, self.hash_id,
+                                       self.layout, self.m)
         self.f_header.write(data)
-        self.mfile.flush()
+        self._mark_dirty(0, self.header_struct.size)
 
     def flush_idx(self):
-        idx_str = json.dumps(dict([(k, v['offset']) for k,v in self.idx.items()]))
-        if len(idx_str) > self.idx_length:
-            #move the index to a new location
-            self.idx_length = len(idx_str)
-            self.idx_offset = self.last_pos
-            self.resize(self.idx_offset+self.idx_length)
-            self.last_pos = self.idx_offset + self.idx_length
-            self.write_header()
-            self.f_idx = hll.MmapSlice(self.mfile, self.idx_length, offset=self.idx_offset)
+        """
+        Writes the keys created since the last flush to the index. A JSON
+        index from an older version is converted the first time it is
+        flushed.
+        """
+        if self.version < 2:
+            # the space used by the JSON index is left behind
+            self.version = FORMAT_VERSION
+            self.idx_offset = self.idx_length = 0
+            self.idx_capacity = self.idx_count = 0
+            self.f_idx = None
+            self.pending = list(self.idx)
+            self.records = array.array('L', [0] * len(self.offsets))
+
+        if self.f_idx is not None and not self.pending and not self.freed and not self.free_used:
+            return
+
+        start = time.time()
+        # a key may have been created more than once, or deleted, since the
+        # last flush
+        self.pending = [key for key in collections.OrderedDict.fromkeys(self.pending) if key in self.idx]
+        new_keys = [key for key in self.pending if not self.records[self.idx[key]]]
+        self.grow_idx(self.idx_count + len(new_keys))
 
-        self.f_idx.write(idx_str)
-        self.mfile.flush()
+        # keys which were created again only need their record updated
+        for key in self.pending:
+            slot = self.idx[key]
+            if self.records[slot]:
+                self.record_struct.pack_into(self.mfile, self.records[slot], self.offsets[slot], self.lengths[slot], len(self._key_bytes(key)))
+                self._mark_dirty(self.records[slot], self.record_struct.size)
+
+        # write the records for all of the new keys in one block. Readers
+        # may probe the table at any time, so the records are written
+        # before the table entries pointing at them, and the headers last.
+        key_bytes = [self._key_bytes(key) for key in new_keys]
+        size = sum([self.record_struct.size + len(kb) for kb in key_bytes])
+        pos = self.allocate(size)
+        records = []
+        entries = []
+        for key, kb in zip(new_keys, key_bytes):
+            slot = self.idx[key]
+            self.records[slot] = pos
+            records.append(self.record_struct.pack(self.offsets[slot], self.lengths[slot], len(kb)) + kb)
+            entries.append((zlib.crc32(kb) & 0xffffffff, pos))
+            pos += self.record_struct.size + len(kb)
+        records = ''.join(records)
+        self.mfile[pos-len(records):pos] = records
+        self._mark_dirty(pos-len(records), len(records))
+
+        table = self._idx_table()
+        for key_hash, record in entries:
+            self._idx_insert(table, key_hash, record)
+
+        self.idx_count += len(new_keys)
+        written = len(records) + (len(self.pending) - len(new_keys)) * self.record_struct.size
+        self.pending = []
+
+        # no record points at the blocks freed since the last flush any more
+        for offset, length in self.freed:
+            self.free.setdefault(length, []).append(offset)
+        self._write_free_list()
+        self.freed = []
+
+        self._write_idx_header()
+        self.write_header()
+        self._timed('index_flush', start, keys=len(new_keys), bytes=written)
+
+    def _write_idx_header(self):
+        self.f_idx.write(self.idx_header_struct.pack(self.idx_capacity, self.idx_count, self.free_offset,
+                                                     self.free_capacity, len(self.free_entries)))
+        self._mark_dirty(self.idx_offset, self.idx_header_struct.size)
+
+    def _write_free_list(self):
+        """
+        Updates the free list in the file with the blocks reused and freed
+        since the last flush. The entry of a reused block is replaced by the
+        last entry and freed blocks are appended, so only those entries are
+        written. The list moves to a new region twice the size when it
+        outgrows its region.
+        """
+        entries, positions = self.free_entries, self.free_pos
+        changed = set()
+        for offset in self.free_used:
+            i = positions.pop(offset)
+            last = entries.pop()
+            if i < len(entries):
+                entries[i] = last
+                positions[last[0]] = i
+                changed.add(i)
+        self.free_used = []
+        for offset, length in self.freed:
+            positions[offset] = len(entries)
+            changed.add(len(entries))
+            entries.append((offset, length))
+
+        if len(entries) > self.free_capacity:
+            capacity = max(self.free_capacity, FREE_LIST_CAPACITY)
+            while len(entries) > capacity:
+                capacity *= 2
+            self.free_offset = self.allocate(capacity * 16)
+            self.free_capacity = capacity
+            changed = xrange(len(entries))
+        if not entries:
+            return
+        view = numpy.frombuffer(self.mref.mmap, dtype='<u8', count=2*len(entries), offset=self.free_offset)
+        for i in changed:
+            if i < len(entries):
+                view[2*i:2*i+2] = entries[i]
+                self._mark_dirty(self.free_offset + i * 16, 16)
+
+    def _read_free_list(self, count):
+        self.free = {}
+        self.freed = []
+        self.free_used = []
+        self.free_entries = []
+        self.free_pos = {}
+        if not count:
+            return
+        view = numpy.frombuffer(self.mref.mmap, dtype='<u8', count=2*count, offset=self.free_offset)
+        self.free_entries = [tuple(entry) for entry in view.reshape(-1, 2).tolist()]
+        for i, (offset, length) in enumerate(self.free_entries):
+            self.free.setdefault(length, []).append(offset)
+            self.free_pos[offset] = i
+
+    def grow_idx(self, count):
+        """
+        Makes sure the index hash table can hold count keys at a load
+        factor of at most 1/2. The table doubles in size when it has to
+        move, so the space left behind is bounded by the size of the table.
+        """
+        if self.f_idx is not None and count * 2 <= self.idx_capacity:
+            return
+
+        capacity = max(self.idx_capacity, INDEX_CAPACITY)
+        while count * 2 > capacity:
+            capacity *= 2
+
+        old = None
+        if self.f_idx is not None:
+            old = self._idx_table()
+            old = old[old[:, 1] != 0].tolist()
+
+        self.idx_capacity = capacity
+        self.idx_length = self.idx_header_struct.size + capacity * 16
+        self.idx_offset = self.allocate(self.idx_length)
+        self.f_idx = hll.MmapSlice(self.mref, self.idx_length, offset=self.idx_offset)
+        self._write_idx_header()
+
+        if old:
+            table = self._idx_table()
+            for key_hash, record in old:
+                self._idx_insert(table, key_hash, record)
+
+    def _idx_table(self):
+        # (key hash, record offset) pairs over the hash table slots
+        return self.f_idx.view()[self.idx_header_struct.size:].view('<u8').reshape(-1, 2)
+
+    def _idx_find(self, key):
+        """
+        Looks up key in the hash table in the mmap and returns the offset of
+        its record, or None
+        """
+        if self.f_idx is None or self.version < 2:
+            return None
+
+        kb = self._key_bytes(key)
+        key_hash = zlib.crc32(kb) & 0xffffffff
+        table = self._idx_table()
+        mask = self.idx_capacity - 1
+        i = key_hash & mask
+        while True:
+            slot_hash, record = table[i].tolist()
+            if not record:
+                return None
+            if slot_hash == key_hash and self._read_record(record)[0] == kb:
+                return record
+            i = (i + 1) & mask
+
+    def _mark_idx_entry(self, i):
+        self._mark_dirty(self.idx_offset + self.idx_header_struct.size + i * 16, 16)
+
+    def _read_record(self, record):
+        # returns the key, block offset and block length of the record at
+        # offset record
+        offset, length, key_len = self.record_struct.unpack_from(self.mfile, record)
+        key_start = record + self.record_struct.size
+        return self.mfile[key_start:key_start+key_len], offset, length
+
+    def _reset_slots(self):
+        # empties the in-memory index and the free list
+        self.idx = {}
+        self.offsets = array.array('L')
+        self.lengths = array.array('L')
+        self.records = array.array('L')
+        self.free_slots = []
+        self.free = {}
+        self.freed = []
+        self.free_used = []
+        self.free_entries = []
+        self.free_pos = {}
+
+    def _add_slot(self, key, offset, record, length=None):
+        if self.free_slots:
+            # reuse the slot of a deleted key
+            slot = self.free_slots.pop()
+            self.offsets[slot] = offset
+            self.lengths[slot] = length or self.block_size
+            self.records[slot] = record
+        else:
+            slot = len(self.offsets)
+            self.offsets.append(offset)
+            self.lengths.append(length or self.block_size)
+            self.records.append(record)
+        self.idx[key] = slot
+        return slot
+
+    def _get(self, key):
+        """
+        Returns the slot number for key or None. In lazy mode the slot is
+        loaded from the hash table the first time the key is used.
+        """
+        slot = self.idx.get(key)
+        if slot is None and self.lazy:
+            with self.lock:
+                slot = self.idx.get(key)
+                if slot is None:
+                    record = self._idx_find(key)
+                    if record is not None:
+                        key_bytes, offset, length = self._read_record(record)
+                        slot = self._add_slot(key, offset, record, length)
+        return slot
+
+    def _stripe(self, key):
+        # the lock guarding the registers of key
+        if not self.thread_safe:
+            return NO_LOCK
+        return self.stripes[hash(key) % LOCK_STRIPES]
+
+    def _hll(self, slot):
+        # a HyperLogLog over the block of slot in the current mmap
+        return self.hll_template._with_data(hll.MmapSlice(self.mref, self.block_size, self.offsets[slot]))
+
+    def keys(self):
+        """
+        Returns a list of all keys in the database
+        """
+        if not self.lazy or self.f_idx is None or self.version < 2:
+            return self.idx.keys()
+
+        with self.lock, self._scan(self.idx_offset, self.idx_length):
+            keys = set(self.idx)
+            records = self._idx_table()[:, 1]
+            for record in records[records != 0].tolist():
+                keys.add(self._read_record(record)[0])
+        return list(keys)
+
+    def _idx_insert(self, table, key_hash, record):
+        mask = self.idx_capacity - 1
+        i = key_hash & mask
+        while table[i, 1]:
+            i = (i + 1) & mask
+        table[i] = (key_hash, record)
+        self._mark_idx_entry(i)
+
+    def _idx_remove(self, record):
+        """
+        Removes the record at offset record from the hash table. The entries
+        after it in the same run are shifted back, so lookups never need
+        tombstones.
+        """
+        table = self._idx_table()
+        mask = self.idx_capacity - 1
+        i = (zlib.crc32(self._read_record(record)[0]) & 0xffffffff) & mask
+        while table[i, 1] != record:
+            i = (i + 1) & mask
+
+        j = i
+        while True:
+            table[i] = (0, 0)
+            self._mark_idx_entry(i)
+            while True:
+                j = (j + 1) & mask
+                if not table[j, 1]:
+                    return
+                # the entry at j can fill the hole at i unless its home slot
+                # is cyclically in (i, j]
+                home = int(table[j, 0]) & mask
+                if not (i < home <= j if i <= j else home > i or home <= j):
+                    break
+            table[i] = table[j]
+            i = j
+
+    @staticmethod
+    def _key_bytes(key):
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return str(key)
 
     def read_idx(self):
-        new_idx = json.loads(self.f_idx.read(self.idx_length))
+        self.pending = []
+        if self.version < 2:
+            self.read_json_idx()
+            return
+
+        header = self.idx_header_struct.unpack(self.f_idx.read(self.idx_header_struct.size))
+        self.idx_capacity, self.idx_count, self.free_offset, self.free_capacity, free_count = header
 
-        self.idx = dict([(k,{'offset':v}) for k,v in new_idx.iteritems()])
-        for k, obj in self.idx.iteritems():
-            obj['mmap'] = hll.MmapSlice(self.mfile, self.m, obj['offset'])
-            obj['hll'] = hll.HyperLogLog(self.error_rate, obj['mmap'], bitcount_arr=self.bitcount_arr)
+        self._reset_slots()
+        self._read_free_list(free_count)
+        if self.lazy:
+            return
 
+        records = self._idx_table()[:, 1]
+        for record in records[records != 0].tolist():
+            key, offset, length = self._read_record(record)
+            self._add_slot(key, offset, record, length)
+
+    def read_json_idx(self):
+        new_idx = json.loads(self.f_idx.read(self.idx_length))
 
+        self._reset_slots()
+        for k, v in new_idx.iteritems():
+            self._add_slot(k, v, 0)
 
     def flush(self):
-        self.flush_idx()
-        self.write_header()
-        self.mfile.flush()
-        os.fsync(self.fobj)
+        if self.readonly:
+            return
+        with self.lock:
+            start = time.time()
+            self.flush_idx()
+            self.write_header()
+            with self.dirty_lock:
+                pages = len(self.dirty)
+                self.dirty = set()
+                self.dirty_ops = 0
+            self.mfile.flush()
+            os.fsync(self.fobj)
+            # without page tracking the whole file is written back
+            self._timed('flush', start, bytes=pages * mmap.PAGESIZE if self.track_dirty else self.file_size)
+
+    def _mark_dirty(self, offset, length):
+        # records the pages of [offset, offset + length) as written
+        if not self.track_dirty:
+            return
+        with self.dirty_lock:
+            self.dirty.update(xrange(offset // mmap.PAGESIZE, (offset + length - 1) // mmap.PAGESIZE + 1))
+
+    def _touch(self, slot):
+        """
+        Marks the block of slot as written by one operation. With
+        DURABILITY_OPS the flusher is woken every flush_ops operations.
+        """
+        if not self.track_dirty:
+            return
+        offset = self.offsets[slot]
+        with self.dirty_lock:
+            self.dirty.update(xrange(offset // mmap.PAGESIZE, (offset + self.lengths[slot] - 1) // mmap.PAGESIZE + 1))
+            self.dirty_ops += 1
+            wake = self.durability == DURABILITY_OPS and self.dirty_ops >= self.flush_ops
+        if wake:
+            self.flusher.wake.set()
+
+    def sync(self):
+        """
+        Writes the index and msyncs only the pages written since the last
+        sync or flush, one ranged flush per run of consecutive pages. The
+        lock is only held to write the index, so writes carry on during the
+        msync and are committed by the next sync.
+
+        Pages are only tracked once a flusher runs or sync has been called,
+        so the first sync of a database without a flusher flushes the whole
+        file.
+
+        Returns the number of pages synced.
+        """
+        if self.readonly:
+            return 0
+        if not self.track_dirty:
+            with self.lock:
+                self.track_dirty = True
+            self.flush()
+            return (len(self.mfile) + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        start = time.time()
+        with self.lock:
+            self.flush_idx()
+            with self.dirty_lock:
+                pages, self.dirty = self.dirty, set()
+                self.dirty_ops = 0
+            mfile = self.mfile
+        if not pages:
+            return 0
+
+        pages = numpy.array(sorted(pages), dtype=numpy.int64)
+        breaks = numpy.flatnonzero(numpy.diff(pages) != 1)
+        firsts = pages[numpy.r_[0, breaks + 1]].tolist()
+        lasts = pages[numpy.r_[breaks, len(pages) - 1]].tolist()
+        for first, last in zip(firsts, lasts):
+            offset = first * mmap.PAGESIZE
+            mfile.flush(offset, min((last + 1) * mmap.PAGESIZE, len(mfile)) - offset)
+
+        elapsed = time.time() - start
+        with self.dirty_lock:
+            self.sync_count += 1
+            self.sync_pages += len(pages)
+            self.sync_ranges += len(firsts)
+            self.sync_last_seconds = elapsed
+            self.sync_max_seconds = max(self.sync_max_seconds, elapsed)
+            self.sync_total_seconds += elapsed
+        if self.hooks:
+            self._emit('sync', elapsed, {'pages': len(pages), 'ranges': len(firsts)})
+        return len(pages)
+
+    def sync_stats(self):
+        """
+        Returns the number of syncs, pages and page ranges synced and the
+        latency of the syncs, with the pages waiting for the next one
+        """
+        return {
+            'syncs': self.sync_count,
+            'pages': self.sync_pages,
+            'ranges': self.sync_ranges,
+            'last_seconds': self.sync_last_seconds,
+            'max_seconds': self.sync_max_seconds,
+            'mean_seconds': self.sync_total_seconds / self.sync_count if self.sync_count else 0.0,
+            'dirty_pages': len(self.dirty),
+        }
+
+    def close(self):
+        """
+        Stops the background flusher and flushes. Raises the last error of
+        the flusher, if any.
+        """
+        error = None
+        if self.flusher is not None:
+            self.flusher.stop()
+            error = self.flusher.error
+            self.flusher = None
+        self.flush()
+        if error is not None:
+            raise error
 
     def __exit__(self, type, value, traceback):
         self.flush()
 
 
     def create(self, key):
-        new_size = self.last_pos+self.m
-        self.resize(self.last_pos+self.m)
-        obj = {}
-        obj['offset'] = self.last_pos
-        obj['mmap'] = hll.MmapSlice(self.mfile, self.m, offset=obj['offset'])
-        obj['hll'] = hll.HyperLogLog(self.error_rate, obj['mmap'], bitcount_arr=self.bitcount_arr)
-        self.idx[key] = obj
-        self.last_pos = obj['offset'] + self.m
-        return obj['hll']
+        return self.create_many([key])[0]
+
+    def create_many(self, keys):
+        with self.lock:
+            return [self._hll(slot) for slot in self._create_slots(keys, self.block_size)]
+
+    def _create_slots(self, keys, length):
+        """
+        Creates empty blocks of length bytes for keys and returns their slots
+        """
+        self._check_writable()
+        with self.lock:
+            # a JSON index is converted, and the version set, by flush_idx
+            if keys and length != self.block_size and self.version >= 2:
+                self.version = FORMAT_VERSION
+            # reuse free blocks first, and allocate space for the rest of the
+            # keys with a single resize
+            reuse = self.free.get(length, [])
+            offset = self.allocate(length*max(0, len(keys) - len(reuse)))
+            slots = []
+            for key in keys:
+                if reuse:
+                    block = reuse.pop()
+                    self.free_used.append(block)
+                    numpy.frombuffer(self.mref.mmap, dtype=numpy.uint8, count=length, offset=block)[:] = 0
+                    self._mark_dirty(block, length)
+                else:
+                    block = offset
+                    offset += length
+                slot = self._get(key)
+                if slot is None:
+                    slot = self._add_slot(key, block, 0, length)
+                    self.counters['keys_created'] += 1
+                else:
+                    self.freed.append((self.offsets[slot], self.lengths[slot]))
+                    self.offsets[slot] = block
+                    self.lengths[slot] = length
+                    self.invalidate(key)
+                self.pending.append(key)
+                slots.append(slot)
+            return slots
+
+    def _alloc_block(self, length):
+        # the offset of a free block of length bytes, or of new space
+        offsets = self.free.get(length)
+        if offsets:
+            self.free_used.append(offsets[-1])
+            return offsets.pop()
+        return self.allocate(length)
+
+    def _create_missing(self, keys, sparse=None):
+        """
+        Creates the keys which don't exist yet and returns them. They are
+        sparse if sparse, or by default if the database is sparse.
+        """
+        if sparse is None:
+            sparse = self.sparse
+        # with few registers a sparse block would be as big as a dense one
+        sparse = sparse and self.m // SPARSE_DIVISOR > SPARSE_MIN_ENTRIES
+        with self.lock:
+            keys = [k for k in keys if self._get(k) is None]
+            self._create_slots(keys, 4 * (SPARSE_MIN_ENTRIES + 1) if sparse else self.block_size)
+            return keys
+
+    def _is_sparse(self, slot):
+        return self.lengths[slot] != self.block_size
+
+    def _sparse_entries(self, slot):
+        # the (index << 8 | value) entries of the sparse block of slot
+        view = numpy.frombuffer(self.mref.mmap, dtype='<u4', count=self.lengths[slot] // 4, offset=self.offsets[slot])
+        return view[1:1+int(view[0])]
+
+    def _registers(self, slot):
+        """
+        Returns the registers of slot as a uint8 array. It is a view of the
+        mmap for a dense block of one byte registers and a new array
+        otherwise.
+        """
+        if not self._is_sparse(slot):
+            return self._hll(slot).registers()
+        entries = self._sparse_entries(slot)
+        M = numpy.zeros(self.m, dtype=numpy.uint8)
+        M[entries >> 8] = entries & 0xff
+        return M
+
+    def registers(self, key):
+        """
+        Returns the registers of key as a numpy uint8 array, or None if the
+        key doesn't exist. Sparse blocks are decoded. The array must not be
+        modified.
+        """
+        slot = self._get(key)
+        if slot is None:
+            return None
+        return self._registers(slot)
+
+    def _store_sparse(self, key, slot, M):
+        """
+        Writes the registers M to the sparse block of slot. The block moves
+        to a bigger one if M doesn't fit, or to a dense one if more than
+        m / SPARSE_DIVISOR registers are set. Call with the lock held.
+        """
+        j = numpy.flatnonzero(M)
+        if len(j) > self.m // SPARSE_DIVISOR:
+            self._promote(key, slot, M)
+            return
+        self._write_sparse(key, slot, (j << 8) | M[j])
+
+    def _write_sparse(self, key, slot, entries):
+        """
+        Writes the sorted entries to the sparse block of slot, moving it to
+        a bigger block if they don't fit. Call with the lock held.
+        """
+        capacity = self.lengths[slot] // 4 - 1
+        if len(entries) > capacity:
+            while len(entries) > capacity:
+                capacity = capacity * 2 + 1
+            offset = self._alloc_block(4 * (capacity + 1))
+        else:
+            offset = self.offsets[slot]
+
+        view = numpy.frombuffer(self.mref.mmap, dtype='<u4', count=capacity + 1, offset=offset)
+        view[1:1+len(entries)] = entries
+        view[0] = len(entries)
+        if offset != self.offsets[slot]:
+            self.freed.append((self.offsets[slot], self.lengths[slot]))
+            self.offsets[slot] = offset
+            self.lengths[slot] = 4 * (capacity + 1)
+            self.pending.append(key)
+
+    def _raise_sparse(self, key, slot, j, rho):
+        """
+        Raises the registers at indexes j of the sparse block of slot to rho
+        where rho is larger, updating the sorted entries in place and only
+        decoding the registers if the block is promoted. Returns the number
+        of registers raised. Call with the lock held.
+        """
+        if len(j) > 1:
+            # the largest rho of each register index
+            order = numpy.lexsort((rho, j))
+            j, rho = j[order], rho[order]
+            last = numpy.ones(len(j), dtype=bool)
+            last[:-1] = j[1:] != j[:-1]
+            j, rho = j[last], rho[last]
+        new_entries = (j.astype(numpy.uint32) << 8) | rho
+
+        # entries are sorted by index, so the first one not below j << 8 is
+        # the entry of j if there is one
+        entries = self._sparse_entries(slot)
+        pos = numpy.searchsorted(entries, new_entries & ~numpy.uint32(0xff))
+        found = pos < len(entries)
+        found[found] = (entries[pos[found]] >> 8) == j[found]
+
+        # registers which are already set are raised in place
+        at = pos[found]
+        raised = new_entries[found] > entries[at]
+        entries[at[raised]] = new_entries[found][raised]
+
+        added = ~found
+        count = len(entries) + int(numpy.count_nonzero(added))
+        if count == len(entries):
+            return int(numpy.count_nonzero(raised))
+        if count > self.m // SPARSE_DIVISOR:
+            M = self._registers(slot)
+            M[j[added]] = rho[added]
+            self._promote(key, slot, M)
+        else:
+            self._write_sparse(key, slot, numpy.insert(entries, pos[added], new_entries[added]))
+        return int(numpy.count_nonzero(raised)) + count - len(entries)
+
+    def _raise_sparse_one(self, key, slot, j, rho):
+        # _raise_sparse for a single register, without building arrays
+        entries = self._sparse_entries(slot)
+        pos = int(entries.searchsorted(j << 8))
+        if pos < len(entries) and entries[pos] >> 8 == j:
+            if rho <= entries[pos] & 0xff:
+                return 0
+            entries[pos] = j << 8 | rho
+        elif len(entries) >= self.m // SPARSE_DIVISOR:
+            M = self._registers(slot)
+            M[j] = rho
+            self._promote(key, slot, M)
+        elif len(entries) < self.lengths[slot] // 4 - 1:
+            # shift the entries after pos along within the block
+            n = len(entries)
+            block = numpy.frombuffer(self.mref.mmap, dtype='<u4', count=n + 2, offset=self.offsets[slot])
+            block[2+pos:2+n] = block[1+pos:1+n].copy()
+            block[1+pos] = j << 8 | rho
+            block[0] = n + 1
+        else:
+            self._write_sparse(key, slot, numpy.insert(entries, pos, j << 8 | rho))
+        return 1
+
+    def _promote(self, key, slot, M=None):
+        """
+        Moves the sparse block of slot to a new dense block, with the
+        registers M if given. Call with the lock held.
+        """
+        if M is None:
+            M = self._registers(slot)
+        self.freed.append((self.offsets[slot], self.lengths[slot]))
+        self.offsets[slot] = self._alloc_block(self.block_size)
+        self.lengths[slot] = self.block_size
+        self._hll(slot)._set_registers(M)
+        self.pending.append(key)
+
+    def _dense(self, key, slot):
+        # the slot of key after promoting it to a dense block
+        if self._is_sparse(slot):
+            with self.lock:
+                if self._is_sparse(slot):
+                    self._promote(key, slot)
+        return slot
+
+    def delete(self, key):
+        """
+        Deletes key and returns True, or False if it doesn't exist. Its
+        block goes on the free list and is reused by keys created after the
+        next flush.
+        """
+        self._check_writable()
+        with self.lock:
+            slot = self._get(key)
+            if slot is None:
+                return False
+            with self._stripe(key):
+                if self.records[slot]:
+                    self._idx_remove(self.records[slot])
+                    self.idx_count -= 1
+                self.freed.append((self.offsets[slot], self.lengths[slot]))
+                self.records[slot] = 0
+                del self.idx[key]
+                self.free_slots.append(slot)
+                self.counters['keys_deleted'] += 1
+            with self.cache_lock:
+                self.handed_out.discard(key)
+            self.invalidate(key)
+            return True
+
+    def delete_prefix(self, prefix):
+        """
+        Deletes all keys starting with prefix and returns the number deleted
+        """
+        self._check_writable()
+        prefix = self._key_bytes(prefix)
+        with self.lock:
+            keys = [key for key in self.keys() if self._key_bytes(key).startswith(prefix)]
+            for key in keys:
+                self.delete(key)
+            return len(keys)
+
+    def compact(self):
+        """
+        Rewrites the live blocks contiguously into a new file next to this
+        one, in file order and COMPACT_CHUNK_KEYS keys at a time, and
+        renames it over this file. The space left behind by deleted keys,
+        moved blocks and old indexes is dropped. HyperLogLogs handed out
+        before are no longer valid. The database must have been opened from
+        a file on disk.
+
+        Returns a dict with the file size before and after.
+        """
+        self._check_writable()
+        path = getattr(self.fobj, 'name', None)
+        if not isinstance(path, basestring) or not os.path.exists(path):
+            raise ValueError("compact needs a database opened from a file on disk")
+
+        stripes = MultiLock(self.stripes if self.thread_safe else [])
+        with self.lock, stripes:
+            self.flush()
+            start = time.time()
+            stats = {'keys': 0, 'old_size': self.file_size, 'new_size': 0}
+
+            tmp_path = path + '.compact'
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            new = HyperLogLogDB(file_path=tmp_path, error_rate=self.error_rate, hash_id=self.hash_id, cache_size=0,
+                                growth_factor=self.growth_factor, growth_step=self.growth_step, sparse=self.sparse,
+                                packed=self.layout == hll.LAYOUT_PACKED)
+
+            keys = sorted(self.keys(), key=lambda k: self.offsets[self._get(k)])
+            new.grow_idx(len(keys))
+            src = numpy.frombuffer(self.mref.mmap, dtype=numpy.uint8)
+            with self._scan():
+                for first in xrange(0, len(keys), COMPACT_CHUNK_KEYS):
+                    by_length = collections.defaultdict(list)
+                    for key in keys[first:first+COMPACT_CHUNK_KEYS]:
+                        by_length[self.lengths[self._get(key)]].append(key)
+                    for length, chunk in by_length.iteritems():
+                        slots = new._create_slots(chunk, length)
+                        dst = numpy.frombuffer(new.mref.mmap, dtype=numpy.uint8)
+                        for key, slot in zip(chunk, slots):
+                            offset = self.offsets[self._get(key)]
+                            dst[new.offsets[slot]:new.offsets[slot]+length] = src[offset:offset+length]
+                        del dst
+            stats['keys'] = len(keys)
+            del src
+
+            new.flush()
+            new.fobj.truncate(new.last_pos)
+            new.mfile.close()
+            new.fobj.close()
+            stats['new_size'] = new.last_pos
+
+            os.rename(tmp_path, path)
+            if self.owns_fobj:
+                self.fobj.close()
+            self.fobj = open(path, 'r+b')
+            self.owns_fobj = True
+            self._open_compacted(new)
+            self._timed('compact', start, keys=stats['keys'])
+            return stats
+
+    def _open_compacted(self, new):
+        """
+        Maps the file written by compact and points each slot at the block
+        and record new wrote for its key. The slot numbers and the MmapRef
+        stay the same, so writers waiting for a lock with a slot number and
+        counts running without one carry on against the new file.
+        """
+        self.fobj.seek(0, os.SEEK_END)
+        self.file_size = self.fobj.tell()
+        self.mfile = self._map()
+        self.mref.mmap = self.mfile
+        self.read_header()
+        self.f_idx = hll.MmapSlice(self.mref, self.idx_length, offset=self.idx_offset)
+        header = self.idx_header_struct.unpack(self.f_idx.read(self.idx_header_struct.size))
+        self.idx_capacity, self.idx_count, self.free_offset, self.free_capacity, free_count = header
+        self._read_free_list(free_count)
+        self.pending = []
+
+        for key, new_slot in new.idx.iteritems():
+            slot = self.idx[key]
+            self.offsets[slot] = new.offsets[new_slot]
+            self.lengths[slot] = new.lengths[new_slot]
+            self.records[slot] = new.records[new_slot]
+        with self.dirty_lock:
+            self.dirty = set()
+            self.dirty_ops = 0
+        # a count which read a slot while it moved must not be cached, and
+        # the HyperLogLogs handed out before are no longer valid
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.count_cache.clear()
+            self.handed_out.clear()
 
     def get_hll(self, key):
-        if key not in self.idx:
+        slot = self._get(key)
+        if slot is None:
             return None
         else:
-            return self.idx[key]['hll']
+            if self.readonly and self._is_sparse(slot):
+                # a copy, since the block can't be promoted
+                M = self._registers(slot)
+                if self.layout == hll.LAYOUT_PACKED:
+                    M = hll.pack_registers(M)
+                return self.hll_template._with_data(hll.MmapSlice(bytearray(M.tobytes()), self.block_size))
+            if self.readonly:
+                return self._hll(slot)
+            # the caller may modify the registers directly
+            with self.cache_lock:
+                self.handed_out.add(key)
+            self.invalidate(key)
+            slot = self._dense(key, slot)
+            self._touch(slot)
+            return self._hll(slot)
+
+    def _check_compatible(self, others):
+        """
+        Raises a ValueError if any of others (HyperLogLogDBs or HyperLogLogs)
+        uses a different precision or hash function than this database
+        """
+        for other in others:
+            if other.m != self.m:
+                raise ValueError('Counters precisions should be equal')
+            if other.hash_id != self.hash_id:
+                raise ValueError('Counters hash functions should be equal')
+
+    def merge(self, others, chunk_bytes=MERGE_CHUNK_BYTES, progress=None):
+        """
+        Merges others into this database in chunks of keys. The block
+        offsets of all keys are gathered up front and missing keys are
+        created in one allocation. For each chunk the target blocks are
+        stacked into one array and each source's blocks are folded in with a
+        single numpy.maximum. Keys which are new and only in one source are
+        copied block to block. Packed blocks are unpacked for the merge, so
+        databases with different layouts can be merged.
 
-    def merge(self, others):
+        progress is called with (keys done, total keys) after each chunk.
+
+        Returns a dict of stats, including the peak bytes of register data
+        held by the merge, which is at most 3 * chunk_bytes.
+        """
+        self._check_writable()
         if not isinstance(others, list):
             others = [others]
 
-        # get a list of all keys in other
-        all_other_keys = set()
-        for other in others:
-            all_other_keys.update(other.idx.keys())
+        self._check_compatible(others)
+
+        # key -> list of (source number, slot in the source)
+        sources = {}
+        for i, other in enumerate(others):
+            blocks = isinstance(other, HyperLogLogDB)
+            for key in other.keys():
+                sources.setdefault(key, []).append((i, other._get(key) if blocks else None))
+
+        def sparse_source(i, slot):
+            return slot is not None and others[i]._is_sparse(slot)
+
+        m = self.m
+        size = self.block_size
+        packed = self.layout == hll.LAYOUT_PACKED
+        start_time = time.time()
+        stats = {'keys': len(sources), 'new_keys': 0, 'copied': 0, 'merged': 0, 'peak_bytes': 0}
+        with self.lock:
+            # keys which are only in sparse blocks are created sparse
+            missing = [key for key in sources if self._get(key) is None]
+            sparse_keys = set(key for key in missing
+                              if self.sparse and all(sparse_source(i, slot) for i, slot in sources[key]))
+            self._create_missing([key for key in missing if key in sparse_keys], sparse=True)
+            self._create_missing([key for key in missing if key not in sparse_keys], sparse=False)
+            new_keys = set(missing)
+            stats['new_keys'] = len(new_keys)
+
+            # walk the target in file order
+            targets = sorted((self.offsets[self._get(key)], key) for key in sources)
+
+            bufs = [numpy.frombuffer(o.mref.mmap, dtype=numpy.uint8) if isinstance(o, HyperLogLogDB) else None
+                    for o in others]
+
+            def raw_block(i, slot):
+                # the bytes of a dense source block in the layout of the
+                # target, or None
+                other = others[i]
+                if slot is None or other._is_sparse(slot) or other.layout != self.layout:
+                    return None
+                offset = other.offsets[slot]
+                return bufs[i][offset:offset+size]
+
+            def block(i, slot, key):
+                if slot is None:
+                    return others[i].registers(key)
+                if others[i]._is_sparse(slot):
+                    return others[i]._registers(slot)
+                offset = others[i].offsets[slot]
+                raw = bufs[i][offset:offset+others[i].block_size]
+                return hll.unpack_registers(raw) if others[i].layout == hll.LAYOUT_PACKED else raw
+
+            rows = max(1, chunk_bytes // m)
+            stripes = MultiLock(self.stripes if self.thread_safe else [])
+            for start in xrange(0, len(targets), rows):
+                dst = numpy.frombuffer(self.mref.mmap, dtype=numpy.uint8)
+                with stripes:
+                    merged = []
+                    for offset, key in targets[start:start+rows]:
+                        blocks = sources[key]
+                        slot = self._get(key)
+                        if key in new_keys and len(blocks) == 1:
+                            stats['copied'] += 1
+                        else:
+                            stats['merged'] += 1
 
-        for k in all_other_keys:
-            self.update(k, filter(lambda o: o, map(lambda other: other.get_hll(k), others)))
+                        if self._is_sparse(slot):
+                            # sparse targets are merged one by one, and may
+                            # move or be promoted
+                            M = self._registers(slot)
+                            for i, src_slot in blocks:
+                                numpy.maximum(M, block(i, src_slot, key), out=M)
+                            self._store_sparse(key, slot, M)
+                        elif key in new_keys and len(blocks) == 1:
+                            raw = raw_block(blocks[0][0], blocks[0][1])
+                            if raw is not None:
+                                dst[offset:offset+size] = raw
+                            else:
+                                self._hll(slot)._set_registers(block(blocks[0][0], blocks[0][1], key))
+                        else:
+                            merged.append((offset, key))
+
+                    if merged:
+                        acc = numpy.empty((len(merged), size), dtype=numpy.uint8)
+                        by_source = collections.defaultdict(list)
+                        for r, (offset, key) in enumerate(merged):
+                            acc[r] = dst[offset:offset+size]
+                            for i, src_slot in sources[key]:
+                                by_source[i].append((r, src_slot, key))
+                        if packed:
+                            acc = hll.unpack_registers(acc)
+
+                        for i, blocks in by_source.iteritems():
+                            tmp = numpy.empty((len(blocks), m), dtype=numpy.uint8)
+                            for n, (r, src_slot, key) in enumerate(blocks):
+                                tmp[n] = block(i, src_slot, key)
+                            sel = numpy.array([b[0] for b in blocks])
+                            numpy.maximum(acc[sel], tmp, out=tmp)
+                            acc[sel] = tmp
+                            # acc, tmp and the acc[sel] temporary
+                            stats['peak_bytes'] = max(stats['peak_bytes'], acc.nbytes + 2*tmp.nbytes)
+
+                        if packed:
+                            acc = hll.pack_registers(acc)
+                        for r, (offset, key) in enumerate(merged):
+                            dst[offset:offset+size] = acc[r]
+
+                    for offset, key in targets[start:start+rows]:
+                        self._touch(self._get(key))
+
+                if progress is not None:
+                    progress(min(start + rows, len(targets)), len(targets))
+
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.count_cache.clear()
+
+        self._timed('merge', start_time, keys=len(sources))
+        return stats
 
     def update(self, key, others):
+        self._check_writable()
         if not isinstance(others, list):
             others = [others]
 
-        if key not in self.idx and len(others) == 1:
-            self.create(key)
-            self.copy_hll(others[0], self.idx[key]['hll'])
-        elif key not in self.idx:
-            self.create(key)
-            self.idx[key]['hll'].update(others)
-        else:
-            self.idx[key]['hll'].update(others)
+        self._check_compatible(others)
+
+        created = self._create_missing([key], sparse=False)
+        slot = self._dense(key, self._get(key))
+        with self._stripe(key):
+            if created and len(others) == 1:
+                self._copy_registers(others[0], self._hll(slot))
+            else:
+                self._hll(slot).update(others)
+        self._touch(slot)
+        self.invalidate(key)
 
     def copy_hll(self, from_hll, to_hll):
-        to_hll.M.write(from_hll.M.read(self.m))
+        self._check_compatible([from_hll, to_hll])
+        self._copy_registers(from_hll, to_hll)
+        if isinstance(to_hll.M, hll.MmapSlice) and to_hll.M._data is self.mref:
+            self._mark_dirty(to_hll.M.offset, to_hll.M.length)
+        # there is no cheap way back from to_hll to its key
+        with self.cache_lock:
+            self.count_cache.clear()
+
+    def _copy_registers(self, from_hll, to_hll):
+        if from_hll.packed == to_hll.packed:
+            to_hll.M.view()[:] = from_hll.M.view()
+        else:
+            to_hll._set_registers(from_hll.registers())
+
+    def _get_or_create(self, key):
+        # the slot of key, which is created if it doesn't exist
+        slot = self._get(key)
+        if slot is None:
+            self._create_missing([key])
+            slot = self._get(key)
+        return slot
 
     def add(self, key, val):
-        if key not in self.idx:
-            self.create(key)
-        self.idx[key]['hll'].add(val)
+        self._check_writable()
+        slot = self.idx.get(key)
+        if slot is None:
+            slot = self._get_or_create(key)
+        j, rho = self.hll_template._index_rho(val)
+        changed = None
+        if self._is_sparse(slot):
+            with self.lock:
+                # the block may have been promoted before the lock was taken
+                if self._is_sparse(slot):
+                    changed = self._raise_sparse_one(key, slot, j, rho)
+        if changed is None:
+            # the register is compared and written in the mmap directly
+            with self._stripe(key):
+                data = self.mref.mmap
+                if self.layout == hll.LAYOUT_PACKED:
+                    changed = hll.raise_packed(data, self.offsets[slot], j, min(rho, hll.PACKED_MAX_RHO))
+                else:
+                    pos = self.offsets[slot] + j
+                    changed = rho > ord(data[pos])
+                    if changed:
+                        data[pos] = chr(rho)
+        counters = self.counters
+        counters['values_added'] += 1
+        if changed:
+            counters['registers_changed'] += 1
+            if self.track_dirty:
+                self._touch(slot)
+            self.invalidate(key)
+
+    def add_many(self, key, values):
+        self._check_writable()
+        self._get_or_create(key)
+        values = list(values)
+        if not values:
+            return
+        j, rho = self._hash(values)
+        self._add_hashed(key, j, rho)
+
+    def _hash(self, values):
+        # _get_index_rho for this database, timed for the hooks
+        self.counters['values_added'] += len(values)
+        if not self.hooks:
+            return hll.HyperLogLog._get_index_rho(values, self.hll_template.b, self.hash_id)
+        start = time.time()
+        j, rho = hll.HyperLogLog._get_index_rho(values, self.hll_template.b, self.hash_id)
+        self._emit('hash', time.time() - start, {'values': len(values)})
+        return j, rho
+
+    def _add_hashed(self, key, j, rho):
+        # applies values already hashed by HyperLogLog._get_index_rho
+        slot = self._get_or_create(key)
+        changed = None
+        if self._is_sparse(slot):
+            with self.lock:
+                # the block may have been promoted before the lock was taken
+                if self._is_sparse(slot):
+                    changed = self._raise_sparse(key, slot, j, rho)
+        if changed is None:
+            with self._stripe(key):
+                changed = self._hll(slot)._update_registers(j, rho)
+        if changed:
+            self.counters['registers_changed'] += changed
+            self._touch(slot)
+            self.invalidate(key)
+
+    def _add_registers(self, key, M):
+        # raises the registers of key to those of the uint8 array M
+        self._check_writable()
+        slot = self._get_or_create(key)
+        if self._is_sparse(slot):
+            with self.lock:
+                if self._is_sparse(slot):
+                    current = self._registers(slot)
+                    numpy.maximum(current, M, out=current)
+                    self._store_sparse(key, slot, current)
+                    M = None
+        if M is not None:
+            with self._stripe(key):
+                h = self._hll(slot)
+                current = h.registers()
+                numpy.maximum(current, M, out=current)
+                if h.packed:
+                    h._set_registers(current)
+        self._touch(slot)
+        self.invalidate(key)
+
+    def add_pairs(self, pairs, values=None):
+        """
+        Adds a batch of (key, value) pairs, or two parallel sequences of keys
+        and values. Missing keys are created in one allocation pass and the
+        values are hashed together, then applied to each key's registers.
+
+        Returns a dict of stats for the batch.
+        """
+        self._check_writable()
+        if values is None:
+            pairs = list(pairs)
+            keys = [p[0] for p in pairs]
+            values = [p[1] for p in pairs]
+        else:
+            keys = list(pairs)
+            values = list(values)
+            if len(keys) != len(values):
+                raise ValueError("keys and values must be the same length")
+
+        stats = {'keys': 0, 'new_keys': 0, 'values': len(values)}
+        if not values:
+            return stats
+
+        # number the distinct keys in order of first appearance
+        slots = {}
+        codes = numpy.fromiter((slots.setdefault(k, len(slots)) for k in keys), dtype=numpy.int64, count=len(keys))
+        ordered_keys = sorted(slots, key=slots.get)
+
+        new_keys = self._create_missing(ordered_keys)
+        stats['keys'] = len(ordered_keys)
+        stats['new_keys'] = len(new_keys)
+
+        j, rho = self._hash(values)
+
+        # group the values by key
+        order = numpy.argsort(codes, kind='mergesort')
+        bounds = numpy.searchsorted(codes[order], numpy.arange(len(ordered_keys)+1))
+        for code, key in enumerate(ordered_keys):
+            sel = order[bounds[code]:bounds[code+1]]
+            self._add_hashed(key, j[sel], rho[sel])
+
+        return stats
 
     def count(self, key):
-        if key not in self.idx:
+        with self.cache_lock:
+            try:
+                estimate = self.count_cache.pop(key)
+                self.cache_hits += 1
+                # re-insert to mark as most recently used
+                self.count_cache[key] = estimate
+                return estimate
+            except KeyError:
+                self.cache_misses += 1
+                generation = self.cache_generation
+
+        slot = self._get(key)
+        if slot is None:
             return 0
-        else:
-            return len(self.idx[key]['hll'])
+        estimate = int(self.hll_template._estimate(self._registers(slot)))
+        if not self.cache_size:
+            return estimate
+
+        with self.cache_lock:
+            # don't cache an estimate which a concurrent update made stale
+            if generation == self.cache_generation and key not in self.handed_out:
+                if len(self.count_cache) >= self.cache_size:
+                    self.count_cache.popitem(last=False)
+                self.count_cache[key] = estimate
+        return estimate
+
+    def count_union(self, keys):
+        """
+        Returns the estimated cardinality of the union of the HLLs of keys,
+        without creating a key. Keys which don't exist are skipped.
+        """
+        M = None
+        for key in keys:
+            slot = self._get(key)
+            if slot is None:
+                continue
+            view = self._registers(slot)
+            if M is None:
+                M = view.copy()
+            else:
+                numpy.maximum(M, view, out=M)
+        if M is None:
+            return 0
+        return int(self.hll_template._estimate(M))
+
+    def count_unions(self, unions):
+        """
+        Returns a list with the estimate of count_union for each list of keys
+        in unions. The registers of each distinct key are read once and
+        shared by all of the unions which include it, and repeated unions are
+        only computed once.
+        """
+        rows = {}
+        for keys in unions:
+            for key in keys:
+                if key not in rows and self._get(key) is not None:
+                    rows[key] = len(rows)
+
+        stack = numpy.empty((len(rows), self.m), dtype=numpy.uint8)
+        for key, r in rows.iteritems():
+            stack[r] = self._registers(self._get(key))
+
+        estimates = []
+        done = {}
+        for keys in unions:
+            sel = tuple(sorted(set(rows[k] for k in keys if k in rows)))
+            if sel not in done:
+                if sel:
+                    done[sel] = int(self.hll_template._estimate(numpy.maximum.reduce(stack[list(sel)], axis=0)))
+                else:
+                    done[sel] = 0
+            estimates.append(done[sel])
+        return estimates
+
+    def _pair_counts(self, pairs):
+        # the estimates of a, b and their union for each (a, b) in pairs
+        unions = []
+        for a, b in pairs:
+            unions.extend(([a], [b], [a, b]))
+        counts = self.count_unions(unions)
+        return [counts[i:i+3] for i in xrange(0, len(counts), 3)]
+
+    def estimate_intersection(self, a, b):
+        """
+        Returns the estimated cardinality of the intersection of the HLLs of
+        keys a and b, by inclusion-exclusion
+        """
+        return self.estimate_intersections([(a, b)])[0]
+
+    def estimate_intersections(self, pairs):
+        """
+        Returns estimate_intersection for each (a, b) in pairs. The estimate
+        of each distinct key is only computed once.
+        """
+        return [max(0, count_a + count_b - count_union) for count_a, count_b, count_union in self._pair_counts(pairs)]
+
+    def estimate_difference(self, a, b):
+        """
+        Returns the estimated cardinality of the values in the HLL of key a
+        which are not in the HLL of key b
+        """
+        return self.estimate_differences([(a, b)])[0]
+
+    def estimate_differences(self, pairs):
+        """
+        Returns estimate_difference for each (a, b) in pairs. The estimate
+        of each distinct key is only computed once.
+        """
+        return [max(0, count_union - count_b) for count_a, count_b, count_union in self._pair_counts(pairs)]
+
+    def export(self, stream, keys=None):
+        """
+        Writes keys, or all keys, and their registers to the file like object
+        stream in the format of the export module, one key at a time. Keys
+        which don't exist are skipped. Returns the number of keys written.
+        """
+        scan = keys is None
+        if scan:
+            # read all of the blocks in file order
+            keys = sorted(self.keys(), key=lambda k: self.offsets[self._get(k)])
+
+        def records():
+            for key in keys:
+                M = self.registers(key)
+                if M is not None:
+                    yield self._key_bytes(key), M
+
+        if not scan:
+            return export.write_stream(stream, self.m, self.hash_id, records())
+        with self._scan():
+            return export.write_stream(stream, self.m, self.hash_id, records())
+
+    def import_(self, stream, batch_keys=IMPORT_BATCH_KEYS):
+        """
+        Reads a stream written by export and merges the registers of each key
+        into this database. The keys are read batch_keys at a time, the
+        missing keys of a batch are created with one allocation and the index
+        is flushed once at the end.
+
+        Returns a dict with the number of keys read and created.
+        """
+        self._check_writable()
+        m, hash_id = export.read_header(stream)
+        if m != self.m:
+            raise ValueError('Counters precisions should be equal')
+        if hash_id != self.hash_id:
+            raise ValueError('Counters hash functions should be equal')
+
+        stats = {'keys': 0, 'new_keys': 0}
+        records = export.read_records(stream, m)
+        with self.lock:
+            while True:
+                batch = list(itertools.islice(records, batch_keys))
+                if not batch:
+                    break
+                stats['keys'] += len(batch)
+                stats['new_keys'] += self._import_batch(batch)
+            self.flush_idx()
+        return stats
+
+    def _import_batch(self, batch):
+        # merges a list of (key, registers) pairs and returns the number of
+        # keys created
+        with self.lock:
+            created = self._create_missing([key for key, M in batch])
+            for key, M in batch:
+                self._add_registers(key, M)
+            return len(created)
+
+    def invalidate(self, key):
+        """
+        Drops the cached count for key
+        """
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.count_cache.pop(key, None)
+
+    def cache_stats(self):
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self.count_cache),
+            'max_size': self.cache_size,
+        }
+
+    def stats(self):
+        """
+        Returns a dict of the STATS counters since the database was opened,
+        with the cache_stats, sync_stats and the page faults of the process.
+        Counters updated outside the locks may miss a few updates when
+        threads write at the same time.
+        """
+        stats = dict(self.counters)
+        stats['cache'] = self.cache_stats()
+        stats['sync'] = self.sync_stats()
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            stats['page_faults'] = {'major': usage.ru_majflt, 'minor': usage.ru_minflt}
+        return stats
+
+    def add_hook(self, hook):
+        """
+        Calls hook(event, seconds, info) after each resize, flush,
+        index_flush, sync, merge and compact, and after hashing each batch
+        of values ('hash'). info is a dict of the amounts of the event, like
+        bytes, keys, pages or values. Hashing is only timed while there are
+        hooks.
+        """
+        self.hooks = self.hooks + (hook,)
+
+    def remove_hook(self, hook):
+        self.hooks = tuple(h for h in self.hooks if h is not hook)
+
+    def _emit(self, event, seconds, info):
+        for hook in self.hooks:
+            hook(event, seconds, info)
+
+    def _timed(self, event, start, **info):
+        # counts an event which began at start and passes it to the hooks
+        seconds = time.time() - start
+        counters = self.counters
+        counters[event + '_count'] += 1
+        counters[event + '_seconds'] += seconds
+        for name, value in info.iteritems():
+            counters[event + '_' + name] += value
+        if self.hooks:
+            self._emit(event, seconds, info)
 
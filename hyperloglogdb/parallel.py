@@ -0,0 +1,147 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Parallel ingest of (key, value) pairs with a pool of processes. The pairs
+are partitioned by a hash of the key, so each key is only seen by one
+worker. Every worker builds its own temporary HyperLogLogDB and the shards
+are merged into the target database at the end.
+"""
+
+import os
+import zlib
+import Queue
+import tempfile
+import multiprocessing
+
+from hlldb import HyperLogLogDB
+
+
+def shard_of(key, shards):
+    """
+    Returns the shard number for key. This is stable across processes and
+    runs, unlike hash().
+    """
+    return (zlib.crc32(HyperLogLogDB._key_bytes(key)) & 0xffffffff) % shards
+
+
+def _ingest_worker(path, error_rate, hash_id, sparse, queue, errors):
+    try:
+        db = HyperLogLogDB(file_path=path, error_rate=error_rate, hash_id=hash_id, cache_size=0, sparse=sparse)
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            db.add_pairs(batch[0], batch[1])
+        db.flush()
+    except Exception, e:
+        # the parent raises it, the exit code is only a fallback
+        errors.put(e)
+        raise
+
+
+def _raise_worker_error(proc, errors):
+    try:
+        error = errors.get(timeout=1)
+    except Queue.Empty:
+        raise RuntimeError("ingest worker exited with code %s" % proc.exitcode)
+    raise error
+
+
+def _put(queue, item, proc, errors):
+    """
+    Puts item on the queue of the worker proc, raising the error of the
+    worker if it dies instead of waiting for room forever
+    """
+    while True:
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Queue.Full:
+            if not proc.is_alive():
+                _raise_worker_error(proc, errors)
+
+
+def parallel_ingest(db, source, workers=None, batch_size=50000, tmp_dir=None):
+    """
+    Adds the (key, value) pairs from the iterable source to the
+    HyperLogLogDB db using workers processes (default: one per CPU). The
+    registers of every key end up the same as with serial ingest.
+
+    Returns a dict of stats.
+    """
+    workers = workers or multiprocessing.cpu_count()
+
+    paths = []
+    for i in range(workers):
+        fd, path = tempfile.mkstemp(suffix='.hlldb', dir=tmp_dir)
+        os.close(fd)
+        os.remove(path)
+        paths.append(path)
+
+    queues = [multiprocessing.Queue(maxsize=4) for i in range(workers)]
+    errors = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_ingest_worker, args=(path, db.error_rate, db.hash_id, db.sparse, queue, errors))
+             for path, queue in zip(paths, queues)]
+
+    stats = {'workers': workers, 'values': 0, 'keys': 0}
+    try:
+        for p in procs:
+            p.daemon = True
+            p.start()
+
+        shards = {}
+        buffers = [([], []) for i in range(workers)]
+        for key, value in source:
+            n = shards.get(key)
+            if n is None:
+                n = shards[key] = shard_of(key, workers)
+            keys, values = buffers[n]
+            keys.append(key)
+            values.append(value)
+            if len(keys) >= batch_size:
+                _put(queues[n], buffers[n], procs[n], errors)
+                buffers[n] = ([], [])
+            stats['values'] += 1
+
+        for n, queue in enumerate(queues):
+            if buffers[n][0]:
+                _put(queue, buffers[n], procs[n], errors)
+            _put(queue, None, procs[n], errors)
+        for p in procs:
+            p.join()
+        for p in procs:
+            if p.exitcode != 0:
+                _raise_worker_error(p, errors)
+
+        stats['keys'] = len(shards)
+        # every key lives in exactly one shard, so each key in a shard is
+        # either a plain copy into the target or a merge with what's there
+        for path in paths:
+            shard = HyperLogLogDB(file_path=path, cache_size=0)
+            db.merge(shard)
+            shard.mfile.close()
+            shard.fobj.close()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return stats
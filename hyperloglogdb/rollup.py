@@ -0,0 +1,212 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+Time bucketed rollups on top of a HyperLogLogDB. Values are added to the
+finest bucket of a key, and the coarser buckets (e.g. days and months) are
+unions of the buckets below them. Range queries are answered from the
+fewest buckets which cover the range.
+"""
+
+import datetime
+import calendar
+import numpy
+
+import hll
+
+# bucket formats of the supported levels, finest first
+LEVELS = (
+    ('hour', '%Y%m%d%H'),
+    ('day', '%Y%m%d'),
+    ('month', '%Y%m'),
+)
+LEVEL_FORMATS = dict(LEVELS)
+
+
+def to_datetime(t):
+    """
+    Returns t as a naive UTC datetime. t is a datetime or a unix timestamp.
+    """
+    if isinstance(t, datetime.datetime):
+        return t
+    return datetime.datetime.utcfromtimestamp(t)
+
+
+def bucket_start(t, level):
+    """
+    Returns the start of the bucket of the given level containing t
+    """
+    t = to_datetime(t)
+    if level == 'hour':
+        return t.replace(minute=0, second=0, microsecond=0)
+    elif level == 'day':
+        return t.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif level == 'month':
+        return t.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError("Unknown level %r" % level)
+
+
+def bucket_end(start, level):
+    """
+    Returns the start of the bucket following the one starting at start
+    """
+    if level == 'hour':
+        return start + datetime.timedelta(hours=1)
+    elif level == 'day':
+        return start + datetime.timedelta(days=1)
+    elif level == 'month':
+        days = calendar.monthrange(start.year, start.month)[1]
+        return start + datetime.timedelta(days=days)
+    raise ValueError("Unknown level %r" % level)
+
+
+class RollupDB(object):
+
+    def __init__(self, db, levels=('hour', 'day', 'month'), incremental=False, key_format='%s:%s'):
+        """
+        Keeps time bucketed HLLs in db under the keys key_format % (key,
+        bucket), e.g. 'customer1:2013011509' for an hour bucket. levels are
+        the bucket levels to keep, finest first.
+
+        Values are only added to the finest bucket. With incremental=True
+        every coarser bucket is updated along with it. Otherwise a coarser
+        bucket is materialized from the buckets below it the first time it
+        is queried, and from then on updated along with them.
+
+        Buckets must only be written through the RollupDB, or coarser
+        buckets which were already materialized will miss the updates.
+        """
+        for level in levels:
+            if level not in LEVEL_FORMATS:
+                raise ValueError("Unknown level %r" % level)
+        names = [name for name, fmt in LEVELS]
+        if list(levels) != sorted(levels, key=names.index):
+            raise ValueError("levels must be ordered finest first")
+
+        self.db = db
+        self.levels = list(levels)
+        self.incremental = incremental
+        self.key_format = key_format
+
+    def bucket_key(self, key, t, level):
+        """
+        Returns the database key of the bucket of the given level containing t
+        """
+        return self.key_format % (key, to_datetime(t).strftime(LEVEL_FORMATS[level]))
+
+    def add(self, key, t, val):
+        self.add_many(key, t, [val])
+
+    def add_many(self, key, t, values):
+        """
+        Adds values to the buckets of key containing the time t, a datetime
+        or unix timestamp. The values are hashed once for all levels.
+        """
+        values = list(values)
+        if not values:
+            return
+        db = self.db
+        j, rho = hll.HyperLogLog._get_index_rho(values, db.hll_template.b, db.hash_id)
+        # hold the lock so a bucket can't be materialized halfway through
+        with db.lock:
+            db._add_hashed(self.bucket_key(key, t, self.levels[0]), j, rho)
+            for level in self.levels[1:]:
+                bucket = self.bucket_key(key, t, level)
+                if self.incremental or db._get(bucket) is not None:
+                    db._add_hashed(bucket, j, rho)
+
+    def _materialize(self, key, start, level):
+        """
+        Makes sure the bucket of level starting at start exists if any
+        bucket below it has data. Returns its key, or None if it is empty.
+        """
+        db = self.db
+        bucket = self.bucket_key(key, start, level)
+        if db._get(bucket) is not None:
+            return bucket
+        if level == self.levels[0]:
+            return None
+
+        with db.lock:
+            if db._get(bucket) is not None:
+                return bucket
+            child = self.levels[self.levels.index(level) - 1]
+            end = bucket_end(start, level)
+            children = []
+            t = start
+            while t < end:
+                child_bucket = self._materialize(key, t, child)
+                if child_bucket is not None:
+                    children.append(db.registers(child_bucket))
+                t = bucket_end(t, child)
+            if not children:
+                return None
+            db._add_registers(bucket, numpy.maximum.reduce(children))
+            return bucket
+
+    def cover(self, start, end):
+        """
+        Returns the fewest (level, bucket start) pairs exactly covering the
+        time range [start, end). start and end are rounded down to the
+        finest level.
+        """
+        finest = self.levels[0]
+        t = bucket_start(start, finest)
+        end = bucket_start(end, finest)
+        buckets = []
+        while t < end:
+            for level in reversed(self.levels):
+                if bucket_start(t, level) == t and bucket_end(t, level) <= end:
+                    buckets.append((level, t))
+                    t = bucket_end(t, level)
+                    break
+        return buckets
+
+    def range_keys(self, key, start, end):
+        """
+        Returns the database keys of the buckets of key covering [start,
+        end), materializing coarser buckets as needed. Empty buckets are
+        left out.
+        """
+        keys = []
+        for level, t in self.cover(start, end):
+            bucket = self._materialize(key, t, level)
+            if bucket is not None:
+                keys.append(bucket)
+        return keys
+
+    def count(self, key, t, level):
+        """
+        Returns the estimated cardinality of the bucket of key of the given
+        level containing t
+        """
+        bucket = self._materialize(key, bucket_start(t, level), level)
+        return self.db.count(bucket) if bucket is not None else 0
+
+    def count_range(self, key, start, end):
+        """
+        Returns the estimated cardinality of key over [start, end)
+        """
+        return self.count_ranges([(key, start, end)])[0]
+
+    def count_ranges(self, queries):
+        """
+        Returns the estimates for a list of (key, start, end) queries. The
+        buckets shared by several queries are only read once.
+        """
+        unions = [self.range_keys(key, start, end) for key, start, end in queries]
+        return self.db.count_unions(unions)
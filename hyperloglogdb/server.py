@@ -0,0 +1,346 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+
+----
+
+A TCP server over one HyperLogLogDB speaking a subset of the Redis
+protocol, so several processes can share one database:
+
+    PFADD key [element ...]
+    PFCOUNT key [key ...]
+    PFMERGE destkey sourcekey [sourcekey ...]
+    DEL key [key ...]
+    PING
+
+Commands are read as RESP arrays or as inline commands. The server runs a
+single threaded asyncore event loop. Every pass of the loop reads the
+commands which have arrived on all connections, including pipelined ones,
+and runs them in order. Runs of PFADDs are coalesced: their values are
+hashed together and the registers of each key are written once.
+
+    python -m hyperloglogdb.server --file my_hlldb.db --port 6380
+"""
+
+import asyncore
+import socket
+import optparse
+import numpy
+
+from hlldb import HyperLogLogDB
+
+# bytes read from a connection at a time
+READ_SIZE = 64 * 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Incomplete(Exception):
+    pass
+
+
+def _read_line(buf, pos):
+    # the line starting at pos and the position after it
+    end = buf.find('\r\n', pos)
+    if end < 0:
+        raise Incomplete()
+    return buf[pos:end], end + 2
+
+
+def _parse_command(buf, pos):
+    """
+    Parses the command starting at pos and returns its arguments and the
+    position after it. Raises Incomplete if it hasn't fully arrived.
+    """
+    if buf[pos] != '*':
+        # inline command
+        end = buf.find('\n', pos)
+        if end < 0:
+            raise Incomplete()
+        return buf[pos:end].split(), end + 1
+
+    line, pos = _read_line(buf, pos)
+    try:
+        count = int(line[1:])
+    except ValueError:
+        raise ProtocolError("invalid multibulk length")
+
+    args = []
+    for i in xrange(count):
+        if pos >= len(buf):
+            raise Incomplete()
+        if buf[pos] != '$':
+            raise ProtocolError("expected '$', got '%s'" % buf[pos])
+        line, pos = _read_line(buf, pos)
+        try:
+            size = int(line[1:])
+        except ValueError:
+            raise ProtocolError("invalid bulk length")
+        if size < 0:
+            raise ProtocolError("invalid bulk length")
+        if pos + size + 2 > len(buf):
+            raise Incomplete()
+        args.append(buf[pos:pos+size])
+        pos += size + 2
+    return args, pos
+
+
+def parse_commands(buf):
+    """
+    Parses the complete commands at the start of buf. Returns a list of
+    argument lists and the number of bytes used.
+    """
+    commands = []
+    pos = 0
+    while pos < len(buf):
+        try:
+            args, pos = _parse_command(buf, pos)
+        except Incomplete:
+            break
+        if args:
+            commands.append(args)
+    return commands, pos
+
+
+def encode_command(*args):
+    # a command as a RESP array of bulk strings
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        arg = str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+def integer(n):
+    return ':%d\r\n' % n
+
+
+def error(message):
+    return '-ERR %s\r\n' % message
+
+
+OK = '+OK\r\n'
+PONG = '+PONG\r\n'
+
+
+class Connection(asyncore.dispatcher):
+    """
+    A client connection. Complete commands are queued on the server and the
+    replies are buffered until the socket is writable.
+    """
+
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = []
+        self.closing = False
+
+    def reply(self, data):
+        if self.connected:
+            self.outbuf.append(data)
+
+    def handle_read(self):
+        data = self.recv(READ_SIZE)
+        if not data or self.closing:
+            return
+        self.inbuf += data
+        try:
+            commands, used = parse_commands(self.inbuf)
+        except ProtocolError, e:
+            self.reply('-ERR Protocol error: %s\r\n' % e)
+            self.closing = True
+            return
+        self.inbuf = self.inbuf[used:]
+        self.server.queue.extend((self, args) for args in commands)
+
+    def writable(self):
+        return bool(self.outbuf) or self.closing
+
+    def handle_write(self):
+        data = ''.join(self.outbuf)
+        sent = self.send(data)
+        self.outbuf = [data[sent:]] if sent < len(data) else []
+        if not self.outbuf and self.closing:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+
+class HyperLogLogServer(asyncore.dispatcher):
+
+    def __init__(self, db, host='127.0.0.1', port=6380):
+        """
+        Serves db on host and port. Use port 0 to pick a free port, which
+        is then in self.port.
+        """
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.db = db
+        self.queue = []
+        # set here rather than in serve_forever, so a shutdown before the
+        # loop starts isn't lost
+        self.running = True
+        self.stats = {'commands': 0, 'pfadd_batches': 0}
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.port = self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Connection(self, sock)
+
+    def serve_forever(self, timeout=0.1):
+        """
+        Runs the event loop until shutdown is called, then flushes the
+        database
+        """
+        try:
+            while self.running:
+                asyncore.loop(timeout=timeout, map=self.map, count=1)
+                self.process()
+        finally:
+            for conn in self.map.values():
+                conn.close()
+            self.db.flush()
+
+    def shutdown(self):
+        self.running = False
+
+    def process(self):
+        """
+        Runs the queued commands in order. Consecutive PFADDs are applied
+        together, before any other command runs.
+        """
+        queue, self.queue = self.queue, []
+        self.stats['commands'] += len(queue)
+        adds = []
+        for conn, args in queue:
+            name = args[0].upper()
+            if name == 'PFADD' and len(args) >= 2:
+                adds.append((conn, args))
+                continue
+            if adds:
+                self.run_pfadd(adds)
+                adds = []
+            # an error in one command is only reported to its client
+            try:
+                conn.reply(self.execute(name, args))
+            except Exception, e:
+                conn.reply(error(e))
+        if adds:
+            self.run_pfadd(adds)
+
+    def run_pfadd(self, adds):
+        # replies with the error to every command of a batch which failed
+        try:
+            self.pfadd(adds)
+        except Exception, e:
+            for conn, args in adds:
+                conn.reply(error(e))
+
+    def execute(self, name, args):
+        # runs a single command other than PFADD and returns the reply
+        db = self.db
+        if name == 'PING':
+            return PONG
+        if name == 'PFCOUNT' and len(args) >= 2:
+            if len(args) == 2:
+                return integer(db.count(args[1]))
+            return integer(db.count_union(args[1:]))
+        if name == 'PFMERGE' and len(args) >= 2:
+            registers = [M for M in (db.registers(key) for key in args[2:]) if M is not None]
+            if registers:
+                db._add_registers(args[1], numpy.maximum.reduce(registers))
+            else:
+                db._create_missing([args[1]])
+            return OK
+        if name == 'DEL' and len(args) >= 2:
+            return integer(sum(db.delete(key) for key in args[1:]))
+        if name in ('PFADD', 'PFCOUNT', 'PFMERGE', 'DEL'):
+            return error("wrong number of arguments for '%s' command" % name.lower())
+        return error("unknown command '%s'" % args[0])
+
+    def pfadd(self, adds):
+        """
+        Applies a list of (connection, PFADD arguments) together. All of the
+        values are hashed in one call, and the registers of each key are
+        raised in memory command by command, so each reply says whether that
+        command changed the key, then written back once.
+        """
+        db = self.db
+        self.stats['pfadd_batches'] += 1
+
+        values = []
+        bounds = [0]
+        by_key = {}
+        for n, (conn, args) in enumerate(adds):
+            values.extend(args[2:])
+            bounds.append(len(values))
+            by_key.setdefault(args[1], []).append(n)
+
+        created = set(db._create_missing(list(by_key)))
+        if values:
+            j, rho = db._hash(values)
+
+        replies = [0] * len(adds)
+        for key, commands in by_key.iteritems():
+            M = db.registers(key).copy()
+            changed = False
+            for n in commands:
+                start, end = bounds[n], bounds[n+1]
+                if start < end and (rho[start:end] > M[j[start:end]]).any():
+                    numpy.maximum.at(M, j[start:end], rho[start:end])
+                    replies[n] = 1
+                    changed = True
+            if key in created:
+                replies[commands[0]] = 1
+            if changed:
+                db._add_registers(key, M)
+
+        for (conn, args), r in zip(adds, replies):
+            conn.reply(integer(r))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--file', help='the database file, created if it does not exist')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=6380)
+    parser.add_option('--error-rate', type='float', default=0.01)
+    parser.add_option('--sparse', action='store_true', default=False)
+    options, args = parser.parse_args()
+    if not options.file:
+        parser.error('--file is required')
+
+    db = HyperLogLogDB(file_path=options.file, error_rate=options.error_rate, sparse=options.sparse)
+    server = HyperLogLogServer(db, options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import threading
+import itertools
+import numpy
+
+import hll
+import export
+from hlldb import HyperLogLogDB, IMPORT_BATCH_KEYS
+from parallel import shard_of
+
+
+def _run_parallel(fn, args_list):
+    """
+    Calls fn with each tuple of args in args_list, one thread per call.
+    The first exception raised by a call is re-raised.
+    """
+    errors = []
+
+    def run(args):
+        try:
+            fn(*args)
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(args,)) for args in args_list]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+class ShardedHyperLogLogDB(object):
+    meta_file = 'shards.json'
+    shard_file = 'shard-%04d.hlldb'
+
+    def __init__(self, path, shards=16, error_rate=0.01, hash_id=hll.HASH_SHA1, **kwargs):
+        """
+        Spreads the keys over shards HyperLogLogDB files in the directory
+        path, by the crc32 of the key. Each shard is opened the first time
+        one of its keys is used. Other keyword arguments are passed on to
+        HyperLogLogDB for every shard.
+
+        The number of shards, error_rate and hash_id are stored in
+        shards.json in the directory, and are read from there when an
+        existing database is opened. With readonly=True the database must
+        already exist.
+        """
+        meta_path = os.path.join(path, self.meta_file)
+        if kwargs.get('readonly') and not os.path.exists(meta_path):
+            raise ValueError("No sharded database to open read-only in %s" % path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+
+        if os.path.exists(meta_path):
+            with open(meta_path, 'rb') as f:
+                meta = json.load(f)
+            shards, error_rate, hash_id = meta['shards'], meta['error_rate'], meta['hash_id']
+        else:
+            if hash_id not in hll.HASHES:
+                raise ValueError("Unknown hash_id %r" % hash_id)
+            with open(meta_path, 'wb') as f:
+                json.dump({'shards': shards, 'error_rate': error_rate, 'hash_id': hash_id}, f)
+
+        self.shards = shards
+        self.error_rate = error_rate
+        self.hash_id = hash_id
+        self.m = hll.HyperLogLog._get_size(error_rate)
+        self.hll_template = hll.HyperLogLog(error_rate, hll.MmapSlice(None, self.m), hash_id=hash_id)
+        self.kwargs = kwargs
+
+        self.lock = threading.Lock()
+        self.dbs = [None] * shards
+
+    def _shard_path(self, n):
+        return os.path.join(self.path, self.shard_file % n)
+
+    def shard(self, n):
+        """
+        Returns the HyperLogLogDB for shard n, opening it if needed
+        """
+        db = self.dbs[n]
+        if db is None:
+            with self.lock:
+                db = self.dbs[n]
+                if db is None:
+                    db = HyperLogLogDB(file_path=self._shard_path(n), error_rate=self.error_rate,
+                                       hash_id=self.hash_id, **self.kwargs)
+                    self.dbs[n] = db
+        return db
+
+    def shard_for(self, key):
+        return self.shard(shard_of(key, self.shards))
+
+    def _existing_shards(self):
+        """
+        Returns the numbers of the shards which are open or have a file
+        """
+        return [n for n in range(self.shards)
+                if self.dbs[n] is not None or os.path.exists(self._shard_path(n))]
+
+    def _open_shards(self):
+        return [db for db in self.dbs if db is not None]
+
+    def flush(self):
+        _run_parallel(HyperLogLogDB.flush, [(db,) for db in self._open_shards()])
+
+    def close(self):
+        _run_parallel(HyperLogLogDB.close, [(db,) for db in self._open_shards()])
+
+    def refresh(self):
+        """
+        Refreshes all open shards of a read-only database, and returns True
+        if any of them changed. Shards created since are opened when used.
+        """
+        return any([db.refresh() for db in self._open_shards()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
+
+    def keys(self):
+        keys = []
+        for n in self._existing_shards():
+            keys.extend(self.shard(n).keys())
+        return keys
+
+    def create(self, key):
+        return self.shard_for(key).create(key)
+
+    def get_hll(self, key):
+        n = shard_of(key, self.shards)
+        if self.dbs[n] is None and not os.path.exists(self._shard_path(n)):
+            return None
+        return self.shard(n).get_hll(key)
+
+    def registers(self, key):
+        n = shard_of(key, self.shards)
+        if self.dbs[n] is None and not os.path.exists(self._shard_path(n)):
+            return None
+        return self.shard(n).registers(key)
+
+    def count(self, key):
+        n = shard_of(key, self.shards)
+        if self.dbs[n] is None and not os.path.exists(self._shard_path(n)):
+            return 0
+        return self.shard(n).count(key)
+
+    def count_union(self, keys):
+        return self.count_unions([keys])[0]
+
+    def count_unions(self, unions):
+        """
+        Returns the estimated cardinality of the union of the HLLs of each
+        list of keys in unions, reading the registers of each key once
+        """
+        views = {}
+        for keys in unions:
+            for key in keys:
+                if key not in views:
+                    views[key] = self.registers(key)
+
+        estimates = []
+        for keys in unions:
+            selected = [views[k] for k in keys if views[k] is not None]
+            if selected:
+                estimates.append(int(self.hll_template._estimate(numpy.maximum.reduce(selected))))
+            else:
+                estimates.append(0)
+        return estimates
+
+    def invalidate(self, key):
+        n = shard_of(key, self.shards)
+        if self.dbs[n] is not None:
+            self.dbs[n].invalidate(key)
+
+    def export(self, stream, keys=None):
+        """
+        Writes keys, or all keys, and their registers to stream in the
+        format of HyperLogLogDB.export
+        """
+        if keys is None:
+            keys = self.keys()
+
+        def records():
+            for key in keys:
+                M = self.registers(key)
+                if M is not None:
+                    yield HyperLogLogDB._key_bytes(key), M
+
+        return export.write_stream(stream, self.m, self.hash_id, records())
+
+    def import_(self, stream, batch_keys=IMPORT_BATCH_KEYS):
+        """
+        Reads a stream written by export into the shards owning the keys,
+        flushing the index of each shard once at the end
+        """
+        m, hash_id = export.read_header(stream)
+        if m != self.m:
+            raise ValueError('Counters precisions should be equal')
+        if hash_id != self.hash_id:
+            raise ValueError('Counters hash functions should be equal')
+
+        stats = {'keys': 0, 'new_keys': 0}
+        records = export.read_records(stream, m)
+        touched = set()
+        while True:
+            batch = list(itertools.islice(records, batch_keys))
+            if not batch:
+                break
+            stats['keys'] += len(batch)
+            by_shard = {}
+            for key, M in batch:
+                by_shard.setdefault(shard_of(key, self.shards), []).append((key, M))
+            for n, shard_batch in by_shard.iteritems():
+                stats['new_keys'] += self.shard(n)._import_batch(shard_batch)
+                touched.add(n)
+        for n in touched:
+            with self.dbs[n].lock:
+                self.dbs[n].flush_idx()
+        return stats
+
+    def delete(self, key):
+        n = shard_of(key, self.shards)
+        if self.dbs[n] is None and not os.path.exists(self._shard_path(n)):
+            return False
+        return self.shard(n).delete(key)
+
+    def delete_prefix(self, prefix):
+        return sum(self.shard(n).delete_prefix(prefix) for n in self._existing_shards())
+
+    def compact(self):
+        """
+        Compacts the shards which exist in parallel and returns the total
+        of their stats
+        """
+        dbs = [self.shard(n) for n in self._existing_shards()]
+        results = [None] * len(dbs)
+
+        def compact(i):
+            results[i] = dbs[i].compact()
+
+        _run_parallel(compact, [(i,) for i in range(len(dbs))])
+        stats = {'keys': 0, 'old_size': 0, 'new_size': 0}
+        for result in results:
+            for k, v in result.iteritems():
+                stats[k] += v
+        return stats
+
+    def add(self, key, val):
+        self.shard_for(key).add(key, val)
+
+    def add_many(self, key, values):
+        self.shard_for(key).add_many(key, values)
+
+    def add_pairs(self, pairs, values=None):
+        """
+        Adds a batch of (key, value) pairs, or two parallel sequences of keys
+        and values, with one add_pairs call per shard.
+
+        Returns a dict of stats for the batch.
+        """
+        if values is None:
+            pairs = list(pairs)
+            keys = [p[0] for p in pairs]
+            values = [p[1] for p in pairs]
+        else:
+            keys = list(pairs)
+            values = list(values)
+            if len(keys) != len(values):
+                raise ValueError("keys and values must be the same length")
+
+        batches = {}
+        for key, value in zip(keys, values):
+            shard_keys, shard_values = batches.setdefault(shard_of(key, self.shards), ([], []))
+            shard_keys.append(key)
+            shard_values.append(value)
+
+        stats = {'keys': 0, 'new_keys': 0, 'values': 0}
+        for n, (shard_keys, shard_values) in batches.iteritems():
+            for k, v in self.shard(n).add_pairs(shard_keys, shard_values).iteritems():
+                stats[k] += v
+        return stats
+
+    def update(self, key, others):
+        self.shard_for(key).update(key, others)
+
+    def merge(self, others):
+        """
+        Merges a single HyperLogLogDB or ShardedHyperLogLogDB, or a list of
+        them, into this database. ShardedHyperLogLogDBs with the same number
+        of shards are merged shard by shard in parallel.
+        """
+        if not isinstance(others, list):
+            others = [others]
+
+        for other in others:
+            if other.m != self.m:
+                raise ValueError('Counters precisions should be equal')
+            if other.hash_id != self.hash_id:
+                raise ValueError('Counters hash functions should be equal')
+
+        sharded = [o for o in others if isinstance(o, ShardedHyperLogLogDB) and o.shards == self.shards]
+        others = [o for o in others if not (isinstance(o, ShardedHyperLogLogDB) and o.shards == self.shards)]
+
+        if sharded:
+            existing = [(o, set(o._existing_shards())) for o in sharded]
+            jobs = []
+            for n in range(self.shards):
+                shard_others = [o.shard(n) for o, shards in existing if n in shards]
+                if shard_others:
+                    jobs.append((self.shard(n), shard_others))
+            _run_parallel(HyperLogLogDB.merge, jobs)
+
+        # anything else is merged key by key into the shard owning the key
+        all_other_keys = set()
+        for other in others:
+            all_other_keys.update(other.keys())
+        for k in all_other_keys:
+            self.update(k, filter(lambda o: o, map(lambda other: other.get_hll(k), others)))
@@ -0,0 +1,145 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+import random
+import string
+
+from hlldb import HyperLogLogDB
+from sharded import ShardedHyperLogLogDB
+import export
+import hll
+
+class TestExport(unittest.TestCase):
+
+    error_rate = 0.01
+    m = 16384
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_db(self, **kwargs):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        self.files = getattr(self, 'files', []) + [f]
+        return HyperLogLogDB(fileobj=f, error_rate=self.error_rate, **kwargs)
+
+    def random_values(self, count):
+        return [''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(20))
+                for i in range(count)]
+
+    def test_round_trip(self):
+        db = self.make_db()
+        for i in range(50):
+            db.add_many('test_key%d' % i, self.random_values(i * 20))
+        db.create('empty_key')
+
+        out = tempfile.TemporaryFile()
+        self.assertEqual(db.export(out), 51)
+        # mostly sparse registers compress far below the size of the blocks
+        self.assertTrue(out.tell() < 51 * self.m / 10)
+
+        out.seek(0)
+        target = self.make_db(sparse=True)
+        stats = target.import_(out)
+        self.assertEqual(stats, {'keys': 51, 'new_keys': 51})
+        self.assertEqual(sorted(target.keys()), sorted(db.keys()))
+        for key in db.keys():
+            self.assertTrue((target.registers(key) == db.registers(key)).all())
+
+        # the index is flushed, so a reopened database has the keys
+        target = HyperLogLogDB(fileobj=self.files[-1])
+        self.assertEqual(len(target.keys()), 51)
+        self.assertEqual(target.count('test_key49'), db.count('test_key49'))
+
+        # importing again merges into the existing keys
+        db.add('test_key1', 'test_val')
+        out = tempfile.TemporaryFile()
+        db.export(out, keys=['test_key1', 'missing_key'])
+        out.seek(0)
+        stats = target.import_(out, batch_keys=1)
+        self.assertEqual(stats, {'keys': 1, 'new_keys': 0})
+        self.assertEqual(target.count('test_key1'), db.count('test_key1'))
+
+    def test_stream_chunks(self):
+        db = self.make_db(packed=True)
+        for i in range(20):
+            db.add_many('test_key%d' % i, self.random_values(2000))
+
+        out = tempfile.TemporaryFile()
+        old_chunk_size = export.CHUNK_SIZE
+        export.CHUNK_SIZE = 1000
+        try:
+            db.export(out)
+            out.seek(0)
+            self.assertEqual(export.read_header(out), (self.m, hll.HASH_SHA1))
+            records = list(export.read_records(out, self.m))
+        finally:
+            export.CHUNK_SIZE = old_chunk_size
+        self.assertEqual(len(records), 20)
+        for key, M in records:
+            self.assertTrue((M == db.registers(key)).all())
+
+    def test_errors(self):
+        db = self.make_db()
+        db.add('test_key', 'test_val')
+        out = tempfile.TemporaryFile()
+        db.export(out)
+
+        out.seek(0)
+        self.assertRaises(ValueError, self.make_db(hash_id=hll.HASH_MIX64).import_, out)
+        out.seek(0)
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        self.assertRaises(ValueError, HyperLogLogDB(fileobj=f, error_rate=0.05).import_, out)
+
+        out.seek(0)
+        data = out.read()
+        truncated = tempfile.TemporaryFile()
+        truncated.write(data[:-10])
+        truncated.seek(0)
+        self.assertRaises(ValueError, self.make_db().import_, truncated)
+
+        bad = tempfile.TemporaryFile()
+        bad.write('XXXX' + data[4:])
+        bad.seek(0)
+        self.assertRaises(ValueError, self.make_db().import_, bad)
+
+    def test_sharded(self):
+        db = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db1'), shards=4, error_rate=self.error_rate)
+        for i in range(30):
+            db.add_many('test_key%d' % i, self.random_values(i))
+
+        out = tempfile.TemporaryFile()
+        self.assertEqual(db.export(out), 30)
+        out.seek(0)
+        target = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db2'), shards=3, error_rate=self.error_rate)
+        self.assertEqual(target.import_(out, batch_keys=7), {'keys': 30, 'new_keys': 30})
+        for i in range(30):
+            self.assertEqual(target.count('test_key%d' % i), db.count('test_key%d' % i))
+
+        # a sharded export can be read into a single database
+        out.seek(0)
+        single = self.make_db()
+        single.import_(out)
+        self.assertEqual(single.count_union(single.keys()), db.count_union(db.keys()))
+
+unittest.main()
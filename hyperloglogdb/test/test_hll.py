@@ -20,8 +20,10 @@ import random
 import string
 import mmap
 import tempfile
+import numpy
 
 from hll import HyperLogLog, MmapSlice
+import hll as hll_module
 
 class TestMmapSlice(unittest.TestCase):
     def test_eq(self):
@@ -59,6 +61,26 @@ class TestMmapSlice(unittest.TestCase):
         self.assertNotEqual(mslice1, mslice2)
         self.assertNotEqual(mslice1, test3)
 
+    def test_view(self):
+        f1 = tempfile.NamedTemporaryFile('r+b')
+        f1.write(''.join('\x00' for i in range(40)))
+        f1.flush()
+        mfile1 = mmap.mmap(f1.fileno(),0)
+        mslice1 = MmapSlice(mfile1, 20, 10)
+
+        view = mslice1.view()
+        self.assertEqual(len(view), 20)
+        view[0] = 65
+        view[19] = 66
+        self.assertEqual(mfile1[10], 'A')
+        self.assertEqual(mfile1[29], 'B')
+        self.assertEqual(mslice1.read(3), 'A\x00\x00')
+        self.assertEqual(mslice1.count('\x00'), 18)
+
+        mslice1.write('CD')
+        self.assertEqual(mfile1[10:12], 'CD')
+        self.assertEqual(mfile1.tell(), 0)
+
     def test_hll(self):
         m = 16384
         f1 = tempfile.NamedTemporaryFile('r+b')
@@ -189,5 +211,87 @@ class TestHLL(unittest.TestCase):
 
         self.assertAlmostEqual(self.test_set_size*3, len(hll1), delta=self.test_set_size*3*self.error_rate)
 
+    def test_add_many(self):
+        f = tempfile.TemporaryFile()
+        m = 16384
+        flen = (m*2) + mmap.PAGESIZE - (m*2) % mmap.PAGESIZE
+
+        f.write(''.join(['\x00' for i in range(flen)]))
+        fmap = mmap.mmap(f.fileno(), m*2)
+
+        hll1 = HyperLogLog(self.error_rate, MmapSlice(fmap, m, 0))
+        hll2 = HyperLogLog(self.error_rate, MmapSlice(fmap, m, m))
+
+        for v in self.test_data1:
+            hll1.add(v)
+        hll2.add_many(self.test_data1)
+        hll2.add_many([])
+
+        self.assertEqual(hll1.M.read(m), hll2.M.read(m))
+        self.assertEqual(len(hll1), len(hll2))
+
+    def test_mix64(self):
+        values = ['', 'a', 'a\x00', 'abcdefgh', 'abcdefghi', 'x' * 100] + list(self.test_data1)
+        hashes = hll_module._mix64_array(values)
+        for h, v in zip(hashes, values):
+            self.assertEqual(int(h), hll_module._mix64(v))
+        self.assertNotEqual(hll_module._mix64('a'), hll_module._mix64('a\x00'))
+
+    def test_mix64_hll(self):
+        f = tempfile.TemporaryFile()
+        m = 16384
+        flen = (m*3) + mmap.PAGESIZE - (m*3) % mmap.PAGESIZE
+
+        f.write(''.join(['\x00' for i in range(flen)]))
+        fmap = mmap.mmap(f.fileno(), m*3)
+
+        hll1 = HyperLogLog(self.error_rate, MmapSlice(fmap, m, 0), hash_id=hll_module.HASH_MIX64)
+        hll2 = HyperLogLog(self.error_rate, MmapSlice(fmap, m, m), hash_id=hll_module.HASH_MIX64)
+        hll3 = HyperLogLog(self.error_rate, MmapSlice(fmap, m, m*2))
+
+        for v in self.test_data1:
+            hll1.add(v)
+        hll2.add_many(self.test_data1)
+
+        self.assertEqual(hll1.M.read(m), hll2.M.read(m))
+        self.assertAlmostEqual(self.test_set_size, len(hll1), delta=self.test_set_size*self.error_rate*3)
+        self.assertRaises(ValueError, hll3.update, hll1)
+        self.assertRaises(ValueError, HyperLogLog, self.error_rate, MmapSlice(fmap, m, 0), hash_id=99)
+
+    def test_packed(self):
+        M = numpy.random.randint(0, 64, 64).astype(numpy.uint8)
+        P = hll_module.pack_registers(M)
+        self.assertEqual(len(P), hll_module.packed_size(64))
+        self.assertTrue((hll_module.unpack_registers(P) == M).all())
+        rows = numpy.vstack([M, M[::-1]])
+        self.assertTrue((hll_module.unpack_registers(hll_module.pack_registers(rows)) == rows).all())
+
+        f = tempfile.TemporaryFile()
+        m = 16384
+        size = hll_module.packed_size(m)
+        flen = (m + size*2) + mmap.PAGESIZE - (m + size*2) % mmap.PAGESIZE
+
+        f.write(''.join(['\x00' for i in range(flen)]))
+        fmap = mmap.mmap(f.fileno(), m + size*2)
+
+        hll1 = HyperLogLog(self.error_rate, MmapSlice(fmap, m, 0))
+        hll2 = HyperLogLog(self.error_rate, MmapSlice(fmap, size, m), packed=True)
+        hll3 = HyperLogLog(self.error_rate, MmapSlice(fmap, size, m + size), packed=True)
+
+        for v in self.test_data1:
+            hll1.add(v)
+            hll2.add(v)
+        hll3.add_many(self.test_data1)
+
+        self.assertTrue((hll2.registers() == hll1.registers()).all())
+        self.assertEqual(hll2.M.read(size), hll3.M.read(size))
+        self.assertEqual(len(hll1), len(hll2))
+
+        hll3.add_many(self.test_data2)
+        hll2.update(hll3)
+        hll1.update(hll3)
+        self.assertTrue((hll2.registers() == hll1.registers()).all())
+        self.assertFalse(hll2.add(list(self.test_data2)[0]))
+
 unittest.main()
 
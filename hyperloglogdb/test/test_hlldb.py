@@ -24,8 +24,11 @@ import math
 import struct
 import os
 import json
+import threading
+import time
 
 from hlldb import HyperLogLogDB
+import hlldb
 import hll
 
 class TestHLL(unittest.TestCase):
@@ -59,19 +62,21 @@ class TestHLL(unittest.TestCase):
         filename = f.name
         test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
         self.assertEqual(test.idx_offset, test.header_struct.size)
-        size_of_empty_index = 2
+        size_of_empty_index = 64 + hlldb.INDEX_CAPACITY * 16
         self.assertEqual(test.last_pos, test.header_struct.size+size_of_empty_index)
         test.flush()
         test = None
         f.close()
 
         f = open(filename, 'r+b')
-        header_struct = struct.Struct('LLLfL')
+        header_struct = struct.Struct('LLLfHHL')
         f.seek(0)
         data = f.read(mmap.PAGESIZE)
         data = header_struct.unpack_from(data)
-        idx_offset, idx_length, last_pos, error_rate, m = data
+        idx_offset, idx_length, last_pos, error_rate, version, hash_id, m = data
         self.assertAlmostEqual(error_rate, self.error_rate)
+        self.assertEqual(version, hlldb.FORMAT_VERSION)
+        self.assertEqual(hash_id, hll.HASH_SHA1)
         self.assertEqual(idx_length, size_of_empty_index)
         self.assertEqual(last_pos, header_struct.size+size_of_empty_index)
         f.close()
@@ -103,8 +108,127 @@ class TestHLL(unittest.TestCase):
         data = f.read(header_struct.size)
         f.seek(0)
 
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, hash_id=hll.HASH_MIX64)
+        self.assertEqual(test.idx_offset, idx_offset)
+        self.assertEqual(test.version, 0)
+        self.assertEqual(test.hash_id, hll.HASH_SHA1)
+
+        test.add('test_key', 'test_val')
+        test.flush()
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        self.assertEqual(test.version, hlldb.FORMAT_VERSION)
+        self.assertEqual(test.count('test_key'), 1)
+
+    def test_json_index_migration(self):
+        header_struct = struct.Struct('LLLfL')
+        m = 16384
+        idx_offset = header_struct.size
+        idx = json.dumps({'test_key': idx_offset, 'test_key2': idx_offset + m})
+        last_pos = idx_offset + m * 2 + len(idx)
+
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        f.write(''.join(['\x00' for i in range(last_pos)]))
+        f.seek(0)
+        f.write(header_struct.pack(idx_offset + m * 2, len(idx), last_pos, self.error_rate, m))
+        f.seek(idx_offset + m * 2)
+        f.write(idx)
+        f.flush()
+
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        self.assertEqual(test.count('test_key'), 0)
+        test.add('test_key', 'test_val')
+        test.add('test_key2', 'test_val')
+        test.add('test_key2', 'test_val2')
+        test.add('test_key3', 'test_val3')
+        self.assertEqual(test.get_hll('test_key').M.offset, idx_offset)
+        test.flush()
+
         test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        self.assertEqual(test.version, hlldb.FORMAT_VERSION)
+        self.assertEqual(sorted(test.idx.keys()), ['test_key', 'test_key2', 'test_key3'])
+        self.assertEqual(test.get_hll('test_key').M.offset, idx_offset)
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.count('test_key2'), 2)
+        self.assertEqual(test.count('test_key3'), 1)
+
+    def test_json_index_migration_sparse(self):
+        header_struct = struct.Struct('LLLfL')
+        m = 16384
+        idx_offset = header_struct.size
+        idx = json.dumps({'test_key': idx_offset})
+        last_pos = idx_offset + m + len(idx)
+
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        f.write(''.join(['\x00' for i in range(last_pos)]))
+        f.seek(0)
+        f.write(header_struct.pack(idx_offset + m, len(idx), last_pos, self.error_rate, m))
+        f.seek(idx_offset + m)
+        f.write(idx)
+        f.flush()
+
+        # creating a sparse block mustn't skip the conversion of the index
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, sparse=True)
+        test.add('test_key', 'test_val')
+        test.add('new_key', 'test_val')
+        test.flush()
+
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        self.assertEqual(test.version, hlldb.FORMAT_VERSION)
+        self.assertEqual(sorted(test.keys()), ['new_key', 'test_key'])
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.count('new_key'), 1)
+
+    def test_incremental_index(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        test.add('test_key', 'test_val')
+        test.flush()
+        idx_offset = test.idx_offset
+        last_pos = test.last_pos
+
+        # nothing new to write
+        test.flush()
+        self.assertEqual(test.last_pos, last_pos)
+
+        # only the new block and its key record are appended
+        test.add('test_key2', 'test_val')
+        test.flush()
         self.assertEqual(test.idx_offset, idx_offset)
+        # (up to 7 bytes of alignment before each of the two allocations)
+        appended = self.m + test.record_struct.size + len('test_key2')
+        self.assertTrue(appended <= test.last_pos - last_pos <= appended + 14)
+
+        # the table moves when it is over half full
+        for i in range(hlldb.INDEX_CAPACITY):
+            test.create('key%d' % i)
+        test.flush()
+        self.assertEqual(test.idx_capacity, hlldb.INDEX_CAPACITY * 4)
+        self.assertNotEqual(test.idx_offset, idx_offset)
+
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        self.assertEqual(len(test.idx), hlldb.INDEX_CAPACITY + 2)
+        self.assertEqual(test.idx_count, hlldb.INDEX_CAPACITY + 2)
+        self.assertEqual(test.count('test_key2'), 1)
+
+    def test_hash_id(self):
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        test1 = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate, hash_id=hll.HASH_MIX64)
+        test1.add_many('test_key', self.test_data1)
+        test1.add('test_key2', 'test_val')
+        test1.flush()
+
+        test1 = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate)
+        self.assertEqual(test1.hash_id, hll.HASH_MIX64)
+        self.assertEqual(test1.count('test_key2'), 1)
+        self.assertAlmostEqual(test1.count('test_key'), len(self.test_data1), delta=len(self.test_data1)*self.error_rate*3)
+
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test2 = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        test2.add('test_key', 'test_val')
+        self.assertRaises(ValueError, test2.merge, test1)
+        self.assertRaises(ValueError, test2.update, 'test_key3', test1.get_hll('test_key'))
+        self.assertEqual(test2.get_hll('test_key3'), None)
+        self.assertRaises(ValueError, HyperLogLogDB, fileobj=tempfile.NamedTemporaryFile(mode='r+b'), hash_id=99)
 
 
     def test_hll_counting(self):
@@ -135,6 +259,92 @@ class TestHLL(unittest.TestCase):
         self.assertEqual(test.count('test_key'), 1)
         self.assertEqual(test.count('test_key2'), 2)
 
+    def test_add_many(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        test.add_many('test_key', self.test_data1)
+        for v in self.test_data1:
+            test.add('test_key2', v)
+        self.assertEqual(test.count('test_key'), test.count('test_key2'))
+        self.assertEqual(test.get_hll('test_key').M.read(self.m), test.get_hll('test_key2').M.read(self.m))
+
+    def test_add_pairs(self):
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        test1 = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate)
+        test1.add('test_key', 'test_val')
+
+        pairs = [('test_key%d' % (i % 3), v) for i, v in enumerate(self.test_data1)]
+        pairs.append(('test_key', 'test_val2'))
+        stats = test1.add_pairs(pairs)
+        self.assertEqual(stats, {'keys': 4, 'new_keys': 3, 'values': len(pairs)})
+
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test2 = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        test2.add('test_key', 'test_val')
+        test2.add_pairs([k for k, v in pairs], [v for k, v in pairs])
+        for k, v in pairs:
+            test2.add(k + '_serial', v)
+
+        self.assertEqual(test1.count('test_key'), 2)
+        for k in ['test_key', 'test_key0', 'test_key1', 'test_key2']:
+            self.assertEqual(test1.get_hll(k).M.read(self.m), test2.get_hll(k).M.read(self.m))
+        for k in ['test_key0', 'test_key1', 'test_key2']:
+            self.assertEqual(test2.get_hll(k).M.read(self.m), test2.get_hll(k + '_serial').M.read(self.m))
+
+        self.assertEqual(test1.add_pairs([]), {'keys': 0, 'new_keys': 0, 'values': 0})
+        self.assertRaises(ValueError, test1.add_pairs, ['a', 'b'], ['c'])
+
+    def test_count_cache(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, cache_size=2)
+        test.add('test_key', 'test_val')
+        test.add('test_key2', 'test_val2')
+        test.add('test_key3', 'test_val3')
+
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.cache_stats(), {'hits': 1, 'misses': 1, 'size': 1, 'max_size': 2})
+
+        # adding a value which doesn't raise a register keeps the cache
+        test.add('test_key', 'test_val')
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.cache_hits, 2)
+
+        test.add('test_key', 'test_val2')
+        self.assertEqual(test.count('test_key'), 2)
+        self.assertEqual(test.cache_misses, 2)
+
+        test.add_many('test_key', ['test_val3'])
+        test.add_pairs([('test_key2', 'test_val3')])
+        test.update('test_key3', test.get_hll('test_key'))
+        self.assertEqual(test.count('test_key'), 3)
+        self.assertEqual(test.count('test_key2'), 2)
+        self.assertEqual(test.count('test_key3'), 3)
+        self.assertEqual(test.cache_stats()['size'], 2)
+        self.assertTrue('test_key' not in test.count_cache)
+
+        test.copy_hll(test.get_hll('test_key'), test.get_hll('test_key2'))
+        self.assertEqual(test.count('test_key2'), 3)
+
+        # keys handed out by get_hll can change behind the cache's back
+        test.add('test_key4', 'test_val')
+        h = test.get_hll('test_key4')
+        self.assertEqual(test.count('test_key4'), 1)
+        for i in range(100):
+            h.add('test_val%d' % i)
+        self.assertEqual(test.count('test_key4'), int(h.length()))
+        self.assertTrue('test_key4' not in test.count_cache)
+        test.delete('test_key4')
+        test.add('test_key4', 'test_val')
+        test.count('test_key4')
+        self.assertTrue('test_key4' in test.count_cache)
+
+        test = HyperLogLogDB(fileobj=tempfile.NamedTemporaryFile(mode='r+b'), cache_size=0)
+        test.add('test_key', 'test_val')
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.count('test_key'), 1)
+        self.assertEqual(test.cache_stats()['size'], 0)
+
     def test_loading_hll(self):
         f = tempfile.NamedTemporaryFile(mode='r+b')
         test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
@@ -149,6 +359,146 @@ class TestHLL(unittest.TestCase):
         self.assertEqual(test.count('test_key'), 1)
         self.assertEqual(test.count('test_key2'), 2)
 
+    def test_lazy_loading(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        for i in range(100):
+            test.add('test_key%d' % i, 'test_val')
+        test.add('test_key1', 'test_val2')
+        test.flush()
+
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, lazy=True)
+        self.assertEqual(len(test.idx), 0)
+        self.assertEqual(test.count('test_key1'), 2)
+        self.assertEqual(test.count('test_key2'), 1)
+        self.assertEqual(test.count('missing_key'), 0)
+        self.assertEqual(test.get_hll('missing_key'), None)
+        self.assertEqual(sorted(test.idx.keys()), ['test_key1', 'test_key2'])
+
+        test.add('test_key3', 'test_val2')
+        test.add('new_key', 'test_val')
+        self.assertEqual(len(test.keys()), 101)
+
+        # re-creating an existing key reuses its record
+        test.create('test_key4')
+        test.flush()
+        self.assertEqual(test.idx_count, 101)
+
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, lazy=True)
+        self.assertEqual(test.count('test_key3'), 2)
+        self.assertEqual(test.count('test_key4'), 0)
+        self.assertEqual(test.count('new_key'), 1)
+
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test2 = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        test2.merge(test)
+        self.assertEqual(len(test2.keys()), 101)
+        self.assertEqual(test2.count('test_key1'), 2)
+
+    def test_compact_index(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        test.add('test_key', 'test_val')
+        test.add('test_key2', 'test_val')
+        self.assertEqual(test.idx, {'test_key': 0, 'test_key2': 1})
+        self.assertEqual(test.offsets[1] - test.offsets[0], self.m)
+
+        # handles are created on demand and share the registers
+        hll1 = test.get_hll('test_key')
+        hll2 = test.get_hll('test_key')
+        self.assertFalse(hll1 is hll2)
+        self.assertFalse(hasattr(hll1, '__dict__'))
+        hll1.add('test_val2')
+        self.assertEqual(len(hll2), 2)
+
+        # resizing the file doesn't need to touch the handles
+        test.create_many(['key%d' % i for i in range(1000)])
+        self.assertEqual(test.count('test_key'), 2)
+        self.assertEqual(len(test.get_hll('key999')), 0)
+
+    def test_resize(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, growth_step=mmap.PAGESIZE)
+        hll1 = test.create('test_key')
+
+        sizes = set()
+        for i in range(500):
+            test.create('key%d' % i)
+            sizes.add(test.file_size)
+        self.assertTrue(len(sizes) <= int(math.log(500, 2)) + 2)
+        self.assertEqual(test.file_size % mmap.PAGESIZE, 0)
+        self.assertEqual(os.fstat(f.fileno()).st_size, test.file_size)
+
+        # slices follow the new mmap
+        self.assertTrue(hll1.M.data is test.mfile)
+        hll1.add('test_val')
+        self.assertEqual(test.count('test_key'), 1)
+
+        # fixed steps only grow the file as far as needed
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, growth_factor=1, growth_step=mmap.PAGESIZE)
+        for i in range(50):
+            test.create('key%d' % i)
+            self.assertTrue(test.file_size < test.last_pos + mmap.PAGESIZE)
+
+    def test_expected_keys(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, expected_keys=1000)
+        self.assertTrue(test.idx_capacity >= 2000)
+        file_size = test.file_size
+        idx_offset = test.idx_offset
+
+        test.create_many(['key%d' % i for i in range(1000)])
+        test.flush()
+        self.assertEqual(test.file_size, file_size)
+        self.assertEqual(test.idx_offset, idx_offset)
+
+    def test_threaded_ingest(self):
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        test1 = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate, thread_safe=True, growth_step=mmap.PAGESIZE)
+        values = sorted(self.test_data1)
+        errors = []
+
+        def worker(n):
+            try:
+                for i, v in enumerate(values):
+                    key = 'key%d' % ((i + n) % 20)
+                    if i % 3 == 0:
+                        test1.add(key, v)
+                    elif i % 3 == 1:
+                        test1.add_many(key, [v, v + 'x'])
+                    else:
+                        test1.add_pairs([(key, v), ('shared', v)])
+                    if i % 50 == 0:
+                        test1.count(key)
+                    if i % 200 == 0:
+                        test1.flush()
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test2 = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        for n in range(8):
+            for i, v in enumerate(values):
+                key = 'key%d' % ((i + n) % 20)
+                test2.add(key, v)
+                if i % 3 == 1:
+                    test2.add(key, v + 'x')
+                elif i % 3 == 2:
+                    test2.add('shared', v)
+
+        self.assertEqual(sorted(test1.keys()), sorted(test2.keys()))
+        for key in test2.keys():
+            self.assertEqual(test1.get_hll(key).M.read(self.m), test2.get_hll(key).M.read(self.m))
+            self.assertEqual(test1.count(key), test2.count(key))
+
     def test_merging_hll(self):
         f1 = tempfile.NamedTemporaryFile(mode='r+b')
         test1 = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate)
@@ -207,6 +557,518 @@ class TestHLL(unittest.TestCase):
 
         self.assertEqual(test1.count('test_key'), test2.count('test_key'))
 
+    def test_count_union(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        test.add_many('test_key1', self.test_data1)
+        test.add_many('test_key2', self.test_data2)
+        test.add_many('test_key3', self.test_data1)
+        test.add_many('test_all', list(self.test_data1) + list(self.test_data2))
+        test.flush()
+        last_pos, keys = test.last_pos, sorted(test.keys())
+
+        self.assertEqual(test.count_union(['test_key1', 'test_key2']), test.count('test_all'))
+        self.assertEqual(test.count_union(['test_key1', 'test_key3']), test.count('test_key1'))
+        self.assertEqual(test.count_union(['test_key1', 'missing']), test.count('test_key1'))
+        self.assertEqual(test.count_union(['missing']), 0)
+        self.assertEqual(test.count_union([]), 0)
+
+        unions = [['test_key1', 'test_key2'], ['test_key2', 'test_key1', 'missing'], ['test_key2'], ['missing'],
+                  ['test_key1', 'test_key2', 'test_key3']]
+        self.assertEqual(test.count_unions(unions), [test.count_union(u) for u in unions])
+        self.assertEqual(test.count_unions([]), [])
+
+        # nothing was written
+        self.assertEqual(test.last_pos, last_pos)
+        self.assertEqual(sorted(test.keys()), keys)
+        self.assertEqual(test.pending, [])
+
+    def test_estimate_intersection(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        data1 = list(self.test_data1)
+        data2 = list(self.test_data2)
+        test.add_many('test_key1', data1)
+        test.add_many('test_key2', data1[:500] + data2)
+        test.add_many('test_key3', data2)
+        last_pos = test.last_pos
+
+        overlap = test.estimate_intersection('test_key1', 'test_key2')
+        self.assertAlmostEqual(overlap, 500, delta=len(data1)*self.error_rate*3)
+        self.assertEqual(overlap, test.count('test_key1') + test.count('test_key2') -
+                         test.count_union(['test_key1', 'test_key2']))
+        self.assertAlmostEqual(test.estimate_difference('test_key1', 'test_key2'), 500, delta=len(data1)*self.error_rate*3)
+        self.assertEqual(test.estimate_intersection('test_key1', 'test_key1'), test.count('test_key1'))
+        self.assertEqual(test.estimate_difference('test_key1', 'test_key1'), 0)
+        self.assertEqual(test.estimate_intersection('test_key1', 'missing'), 0)
+        self.assertEqual(test.estimate_difference('test_key1', 'missing'), test.count('test_key1'))
+        self.assertEqual(test.estimate_difference('missing', 'test_key1'), 0)
+
+        pairs = [('test_key1', 'test_key2'), ('test_key2', 'test_key3'), ('test_key1', 'test_key3'), ('test_key3', 'missing')]
+        self.assertEqual(test.estimate_intersections(pairs), [test.estimate_intersection(a, b) for a, b in pairs])
+        self.assertEqual(test.estimate_differences(pairs), [test.estimate_difference(a, b) for a, b in pairs])
+        self.assertEqual(test.estimate_intersections([]), [])
+        self.assertEqual(test.last_pos, last_pos)
+
+    def test_sparse(self):
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate, sparse=True)
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        dense = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        data = list(self.test_data1)
+
+        for i in range(200):
+            pairs = [('test_key%d' % i, v) for v in data[i % 10:i % 10 + 10]]
+            test.add_pairs(pairs)
+            dense.add_pairs(pairs)
+        test.add('test_key0', 'test_val')
+        dense.add('test_key0', 'test_val')
+        # outgrows the first block but stays sparse
+        test.add_many('test_key1', data[:100])
+        dense.add_many('test_key1', data[:100])
+        # promoted to a dense block
+        test.add_many('test_key2', data + list(self.test_data2))
+        dense.add_many('test_key2', data + list(self.test_data2))
+
+        # single adds update the entries in place, through moving to bigger
+        # blocks and up to the promotion
+        values = data[:100] + data[:100] + data[100:500]
+        for v in values:
+            test.add('test_key4', v)
+            dense.add('test_key4', v)
+        self.assertTrue(test._is_sparse(test._get('test_key4')))
+        self.assertTrue((test.registers('test_key4') == dense.registers('test_key4')).all())
+        for v in data[500:] + list(self.test_data2)[:500]:
+            test.add('test_key4', v)
+            dense.add('test_key4', v)
+        self.assertFalse(test._is_sparse(test._get('test_key4')))
+
+        slot = test._get('test_key0')
+        self.assertEqual(test.lengths[slot], 4 * (hlldb.SPARSE_MIN_ENTRIES + 1))
+        self.assertTrue(hlldb.SPARSE_MIN_ENTRIES < test.lengths[test._get('test_key1')] < self.m)
+        self.assertEqual(test.lengths[test._get('test_key2')], self.m)
+        self.assertTrue(test.last_pos * 10 < dense.last_pos)
+
+        def check(test):
+            for key in dense.keys():
+                self.assertTrue((test.registers(key) == dense.registers(key)).all())
+                self.assertEqual(test.count(key), dense.count(key))
+            self.assertEqual(test.count_union(['test_key1', 'test_key2', 'test_key3']),
+                             dense.count_union(['test_key1', 'test_key2', 'test_key3']))
+        check(test)
+
+        test.flush()
+        self.assertEqual(test.version, hlldb.FORMAT_VERSION)
+        check(HyperLogLogDB(fileobj=f1))
+        check(HyperLogLogDB(fileobj=f1, lazy=True))
+
+        # handing out the registers promotes the key
+        self.assertEqual(test.get_hll('test_key3').M.read(self.m), dense.get_hll('test_key3').M.read(self.m))
+        self.assertEqual(test.lengths[test._get('test_key3')], self.m)
+        test.update('test_key4', dense.get_hll('test_key5'))
+        dense.update('test_key4', dense.get_hll('test_key5'))
+        self.assertEqual(test.lengths[test._get('test_key4')], self.m)
+        check(test)
+
+        # merging keeps keys which are only in sparse blocks sparse
+        f3 = tempfile.NamedTemporaryFile(mode='r+b')
+        merged = HyperLogLogDB(fileobj=f3, error_rate=self.error_rate, sparse=True)
+        merged.add('test_key5', 'test_val')
+        merged.add('other_key', 'test_val')
+        merged.merge(test)
+        dense.add('test_key5', 'test_val')
+        dense.add('other_key', 'test_val')
+        self.assertTrue(merged.lengths[merged._get('test_key5')] < self.m)
+        self.assertTrue(merged.lengths[merged._get('test_key6')] < self.m)
+        self.assertEqual(merged.lengths[merged._get('test_key2')], self.m)
+        check(merged)
+
+        f4 = tempfile.NamedTemporaryFile(mode='r+b')
+        merged = HyperLogLogDB(fileobj=f4, error_rate=self.error_rate)
+        merged.add('test_key5', 'test_val')
+        merged.add('other_key', 'test_val')
+        merged.merge(test)
+        self.assertEqual(merged.lengths[merged._get('test_key6')], self.m)
+        check(merged)
+
+    def test_packed(self):
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate, packed=True)
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        dense = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        data = list(self.test_data1)
+
+        for db in (dense, test):
+            for v in data[:100]:
+                db.add('test_key1', v)
+            db.add_many('test_key2', data)
+            db.add_pairs([('test_key%d' % (i % 5), v) for i, v in enumerate(self.test_data2)])
+            db.update('test_key6', dense.get_hll('test_key2'))
+
+        size = hll.packed_size(self.m)
+        self.assertEqual(test.block_size, size)
+        self.assertEqual(test.get_hll('test_key1').M.length, size)
+        self.assertTrue(test.last_pos < dense.last_pos)
+
+        def check(test):
+            for key in dense.keys():
+                self.assertTrue((test.registers(key) == dense.registers(key)).all())
+                self.assertEqual(test.count(key), dense.count(key))
+        check(test)
+
+        test.flush()
+        test = HyperLogLogDB(fileobj=f1, error_rate=0.1)
+        self.assertEqual(test.layout, hll.LAYOUT_PACKED)
+        check(test)
+
+        # merging converts between the layouts
+        f3 = tempfile.NamedTemporaryFile(mode='r+b')
+        merged = HyperLogLogDB(fileobj=f3, error_rate=self.error_rate)
+        merged.add('test_key1', 'test_val')
+        merged.merge(test)
+        test.add('test_key1', 'test_val')
+        dense.add('test_key1', 'test_val')
+        check(merged)
+
+        f4 = tempfile.NamedTemporaryFile(mode='r+b')
+        merged = HyperLogLogDB(fileobj=f4, error_rate=self.error_rate, packed=True, sparse=True)
+        merged.add('test_key2', 'test_val')
+        merged.merge([test, dense])
+        test.add('test_key2', 'test_val')
+        dense.add('test_key2', 'test_val')
+        check(merged)
+
+        test.copy_hll(dense.get_hll('test_key2'), test.get_hll('test_key3'))
+        dense.copy_hll(dense.get_hll('test_key2'), dense.get_hll('test_key3'))
+        check(test)
+
+    def test_delete(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        for i in range(300):
+            test.add('test_key%d' % i, 'test_val')
+            test.add('other_key%d' % i, 'test_val')
+        test.flush()
+        self.assertTrue(test.delete('test_key0'))
+        self.assertFalse(test.delete('test_key0'))
+        self.assertFalse(test.delete('missing_key'))
+        self.assertEqual(test.count('test_key0'), 0)
+        self.assertEqual(test.delete_prefix('test_key1'), 111)
+
+        # keys created before the flush don't reuse the blocks
+        last_pos = test.last_pos
+        test.add('new_key', 'test_val')
+        self.assertEqual(test.delete_prefix('new_key'), 1)
+        self.assertTrue(test.last_pos > last_pos)
+        test.flush()
+
+        last_pos = test.last_pos
+        test.create_many(['new_key%d' % i for i in range(100)])
+        self.assertEqual(test.last_pos, last_pos)
+        self.assertEqual(test.count('new_key5'), 0)
+        test.add('new_key5', 'test_val')
+        self.assertEqual(len(test.offsets), 600)
+        test.flush()
+
+        def check(test):
+            self.assertEqual(len(test.keys()), 588)
+            self.assertEqual(test.idx_count, 588)
+            for i in range(300):
+                self.assertEqual(test.count('other_key%d' % i), 1)
+                self.assertEqual(test.count('test_key%d' % i), 0 if str(i).startswith('1') or i == 0 else 1)
+            self.assertEqual(test.count('new_key5'), 1)
+        check(test)
+        check(HyperLogLogDB(fileobj=f))
+
+        # the free list is stored in the file
+        test = HyperLogLogDB(fileobj=f, lazy=True)
+        self.assertEqual(sum(len(v) for v in test.free.values()), 13)
+        self.assertEqual(test.delete_prefix('other_key'), 300)
+        self.assertEqual(test.count('other_key1'), 0)
+        test.flush()
+        last_pos = test.last_pos
+        test.create_many(['new_key%d' % i for i in range(100, 412)])
+        self.assertEqual(test.last_pos, last_pos)
+        test.flush()
+        check_keys = HyperLogLogDB(fileobj=f).keys()
+        self.assertEqual(len(check_keys), 600)
+        self.assertFalse('other_key1' in check_keys)
+
+        # the free list in the file stays the same as in memory when blocks
+        # are both reused and freed between flushes
+        test.delete_prefix('new_key1')
+        test.flush()
+        test.create_many(['reused_key%d' % i for i in range(50)])
+        test.delete_prefix('new_key2')
+        test.flush()
+        self.assertEqual(len(test.free_entries), sum(len(v) for v in test.free.values()))
+        reopened = HyperLogLogDB(fileobj=f)
+        self.assertEqual(sorted(reopened.free_entries), sorted(test.free_entries))
+        self.assertEqual(len(reopened.keys()), len(test.keys()))
+
+        # moved sparse blocks are reused
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate, sparse=True)
+        test.add_many('test_key1', list(self.test_data1)[:20])
+        test.flush()
+        last_pos = test.last_pos
+        test.add('test_key2', 'test_val')
+        self.assertEqual(test.last_pos, last_pos)
+
+    def test_compact(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.hlldb')
+        test = HyperLogLogDB(file_path=path, error_rate=self.error_rate, sparse=True)
+        data = list(self.test_data1)
+        for i in range(200):
+            test.add_many('test_key%d' % i, data[i:i + 5 + i % 50])
+        test.add_many('test_key1', data)
+        test.flush()
+        counts = dict((key, test.count(key)) for key in test.keys())
+        test.delete_prefix('test_key1')
+        counts = dict((key, c) for key, c in counts.items() if not key.startswith('test_key1'))
+        old_size = os.path.getsize(path)
+
+        stats = test.compact()
+        self.assertEqual(stats['keys'], len(counts))
+        self.assertEqual(stats['old_size'], old_size)
+        self.assertEqual(os.path.getsize(path), stats['new_size'])
+        self.assertTrue(stats['new_size'] < old_size / 2)
+        self.assertFalse(os.path.exists(path + '.compact'))
+        self.assertEqual(sorted(test.keys()), sorted(counts))
+        for key, count in counts.items():
+            self.assertEqual(test.count(key), count)
+
+        # the database can be used and reopened after the swap
+        test.add('test_key1', 'test_val')
+        test.add('test_key2', 'test_val2')
+        test.flush()
+        test = HyperLogLogDB(file_path=path)
+        self.assertEqual(test.count('test_key1'), 1)
+        self.assertEqual(test.count('test_key2'), counts['test_key2'] + 1)
+        self.assertEqual(len(test.keys()), len(counts) + 1)
+
+        f = tempfile.TemporaryFile()
+        self.assertRaises(ValueError, HyperLogLogDB(fileobj=os.fdopen(os.dup(f.fileno()), 'r+b')).compact)
+
+    def wait_for_sync(self, test, syncs):
+        for i in range(500):
+            if test.sync_stats()['syncs'] >= syncs:
+                return
+            time.sleep(0.01)
+        self.fail("the flusher did not sync")
+
+    def test_compact_threads(self):
+        values = [('test_key%d' % (i % 200), 'test_val%d' % i) for i in range(20000)]
+        serial = HyperLogLogDB(fileobj=tempfile.NamedTemporaryFile(mode='r+b'), error_rate=self.error_rate)
+        for key, val in values:
+            serial.add(key, val)
+
+        for sparse in (False, True):
+            path = os.path.join(tempfile.mkdtemp(), 'test.hlldb')
+            test = HyperLogLogDB(file_path=path, error_rate=self.error_rate, thread_safe=True, sparse=sparse)
+
+            def writer(n):
+                for key, val in values[n::4]:
+                    test.add(key, val)
+            threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+            for t in threads:
+                t.start()
+            # the writers carry on with the compacted file
+            for i in range(15):
+                test.compact()
+            for t in threads:
+                t.join()
+            test.flush()
+
+            for db in (test, HyperLogLogDB(file_path=path)):
+                for key in serial.keys():
+                    self.assertTrue((db.registers(key) == serial.registers(key)).all())
+
+    def test_sync(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, expected_keys=100)
+        for i in range(100):
+            test.add('test_key%d' % i, 'test_val')
+        test.flush()
+        # pages are tracked from the first sync, which syncs the whole file
+        self.assertEqual(test.sync_stats()['dirty_pages'], 0)
+        self.assertEqual(test.sync(), (test.file_size + mmap.PAGESIZE - 1) // mmap.PAGESIZE)
+        self.assertEqual(test.sync(), 0)
+
+        # only the pages of the written block and the index are synced
+        test.add_many('test_key50', self.test_data1)
+        # (blocks are not page aligned)
+        self.assertTrue(test.sync_stats()['dirty_pages'] <= self.m // mmap.PAGESIZE + 1)
+        test.create('new_key')
+        pages = test.sync()
+        self.assertTrue(self.m // mmap.PAGESIZE < pages < 3 * self.m // mmap.PAGESIZE)
+        stats = test.sync_stats()
+        self.assertEqual((stats['syncs'], stats['pages'], stats['dirty_pages']), (1, pages, 0))
+        self.assertTrue(stats['ranges'] >= 2)
+        self.assertEqual(HyperLogLogDB(fileobj=f).count('test_key50'), test.count('test_key50'))
+        self.assertTrue('new_key' in HyperLogLogDB(fileobj=f).keys())
+
+        # a sync every flush_ops writes
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, durability=hlldb.DURABILITY_OPS, flush_ops=50)
+        self.assertTrue(test.thread_safe)
+        for i, val in enumerate(self.test_data1):
+            test.add('test_key%d' % (i % 10), val)
+            if i == 60:
+                self.wait_for_sync(test, 1)
+        test.close()
+        self.assertTrue(test.sync_stats()['syncs'] >= 2)
+        self.assertEqual(HyperLogLogDB(fileobj=f).count('test_key3'), test.count('test_key3'))
+
+        # a sync every flush_interval seconds
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, durability=hlldb.DURABILITY_INTERVAL,
+                             flush_interval=0.01)
+        test.add_many('test_key', self.test_data1)
+        self.wait_for_sync(test, 1)
+        self.assertEqual(HyperLogLogDB(fileobj=f).count('test_key'), test.count('test_key'))
+        test.close()
+
+        self.assertRaises(ValueError, HyperLogLogDB, fileobj=f, durability='always')
+
+    def test_readonly(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.hlldb')
+        writer = HyperLogLogDB(file_path=path, error_rate=self.error_rate, sparse=True)
+        writer.add_many('test_key', self.test_data1)
+        writer.add('test_key2', 'test_val')
+        writer.flush()
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        reader = HyperLogLogDB(file_path=path, readonly=True)
+        lazy_reader = HyperLogLogDB(fileobj=open(path, 'rb'), readonly=True, lazy=True)
+        for test in (reader, lazy_reader):
+            self.assertEqual(sorted(test.keys()), ['test_key', 'test_key2'])
+            self.assertEqual(test.count('test_key'), writer.count('test_key'))
+            self.assertEqual(int(test.get_hll('test_key2').length()), 1)
+            self.assertEqual(int(test.get_hll('test_key').length()), writer.count('test_key'))
+            self.assertRaises(IOError, test.add, 'test_key2', 'test_val2')
+            self.assertRaises(IOError, test.add_pairs, [('test_key3', 'test_val')])
+            self.assertRaises(IOError, test.delete, 'test_key')
+            self.assertRaises(IOError, test.merge, writer)
+            test.flush()
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        # the reader sees what the writer has flushed after a refresh
+        self.assertFalse(reader.refresh())
+        for i in range(100):
+            writer.add_many('new_key%d' % i, self.test_data2)
+        writer.add('test_key2', 'test_val2')
+        writer.flush()
+        self.assertFalse('new_key99' in reader.keys())
+        self.assertTrue(reader.refresh())
+        self.assertEqual(reader.count('test_key2'), writer.count('test_key2'))
+        self.assertEqual(reader.count('new_key99'), writer.count('new_key99'))
+        self.assertEqual(len(reader.keys()), 102)
+
+        # and follows the file when compact replaces it
+        writer.delete_prefix('new_key')
+        writer.compact()
+        self.assertTrue(reader.refresh())
+        self.assertEqual(sorted(reader.keys()), ['test_key', 'test_key2'])
+        self.assertEqual(reader.count('test_key'), writer.count('test_key'))
+
+        self.assertRaises(ValueError, writer.refresh)
+        self.assertRaises(ValueError, HyperLogLogDB, fileobj=tempfile.NamedTemporaryFile(mode='r+b'), readonly=True)
+        self.assertTrue(hlldb.madvise(reader.mfile, hlldb.MADV_SEQUENTIAL, 100, 5000))
+
+    def test_stats(self):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate, growth_step=0)
+        events = []
+        hook = lambda event, seconds, info: events.append((event, info))
+        test.add_hook(hook)
+        file_size = test.file_size
+        resizes = test.stats()['resize_count']
+
+        test.add('test_key', 'test_val')
+        test.add('test_key', 'test_val')
+        test.add_many('test_key2', self.test_data1)
+        test.add_pairs([('test_key3', 'a'), ('test_key', 'b')])
+        test.delete('test_key3')
+        test.flush()
+        test.count('test_key')
+        test.count('test_key')
+
+        stats = test.stats()
+        self.assertEqual(stats['values_added'], 2 + len(self.test_data1) + 2)
+        self.assertTrue(len(self.test_data1) * 0.9 < stats['registers_changed'] < len(self.test_data1) + 4)
+        self.assertEqual((stats['keys_created'], stats['keys_deleted']), (3, 1))
+        self.assertTrue(stats['resize_count'] > resizes)
+        # the file starts as just the header
+        self.assertEqual(stats['resize_bytes'], test.file_size - test.header_struct.size)
+        self.assertEqual(stats['flush_count'], 1)
+        self.assertTrue(stats['flush_bytes'] > 2 * self.m)
+        self.assertEqual(stats['index_flush_keys'], 2)
+        self.assertEqual((stats['cache']['hits'], stats['cache']['misses']), (1, 1))
+
+        names = [event for event, info in events]
+        self.assertEqual(names.count('hash'), 2)
+        self.assertEqual(names.count('resize'), stats['resize_count'] - resizes)
+        self.assertEqual(sum(info['bytes'] for event, info in events if event == 'resize'), test.file_size - file_size)
+        self.assertEqual(names[-2:], ['index_flush', 'flush'])
+        self.assertEqual(events[-1][1], {'bytes': stats['flush_bytes']})
+
+        test.remove_hook(hook)
+        del events[:]
+        test.merge(test)
+        self.assertEqual(events, [])
+        self.assertEqual((test.stats()['merge_count'], test.stats()['merge_keys']), (1, 2))
+
+        test = HyperLogLogDB(file_path=os.path.join(tempfile.mkdtemp(), 'test.hlldb'), error_rate=self.error_rate)
+        test.add('test_key', 'test_val')
+        test.compact()
+        stats = test.stats()
+        self.assertEqual((stats['compact_count'], stats['compact_keys']), (1, 1))
+        self.assertTrue(0 <= stats['compact_seconds'] < 60)
+
+    def test_block_merge(self):
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        test1 = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate)
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test2 = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        f3 = tempfile.NamedTemporaryFile(mode='r+b')
+        test3 = HyperLogLogDB(fileobj=f3, error_rate=self.error_rate)
+        f4 = tempfile.NamedTemporaryFile(mode='r+b')
+        serial = HyperLogLogDB(fileobj=f4, error_rate=self.error_rate)
+
+        data1 = list(self.test_data1)
+        data2 = list(self.test_data2)
+        for i in range(10):
+            test1.add_many('test_key%d' % i, data1[i::10])
+            serial.add_many('test_key%d' % i, data1[i::10])
+        for i in range(5, 15):
+            test2.add_many('test_key%d' % i, data2[i::15])
+            serial.add_many('test_key%d' % i, data2[i::15])
+        test3.add('test_key0', 'test_val')
+        test3.add('test_key20', 'test_val')
+        serial.add('test_key0', 'test_val')
+        serial.add('test_key20', 'test_val')
+
+        test1.count('test_key0')
+        calls = []
+        stats = test1.merge([test2, test3], chunk_bytes=3*self.m, progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(stats['keys'], 12)
+        self.assertEqual(stats['new_keys'], 6)
+        # test_key10 to test_key14 and test_key20 are new with a single source
+        self.assertEqual(stats['copied'], 6)
+        self.assertEqual(stats['merged'], 6)
+        self.assertTrue(0 < stats['peak_bytes'] <= 3*3*self.m)
+        self.assertEqual(calls, [(3, 12), (6, 12), (9, 12), (12, 12)])
+
+        self.assertEqual(sorted(test1.keys()), sorted(serial.keys()))
+        for key in serial.keys():
+            self.assertEqual(test1.get_hll(key).M.read(self.m), serial.get_hll(key).M.read(self.m))
+        # the cached count was dropped
+        self.assertEqual(test1.cache_stats()['size'], 0)
+        self.assertEqual(test1.count('test_key0'), serial.count('test_key0'))
+
     def test_move_index(self):
         # import yappi
         # yappi.start(builtins=True)
@@ -0,0 +1,86 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import random
+import string
+import tempfile
+
+from hlldb import HyperLogLogDB
+from parallel import parallel_ingest, shard_of
+import hll
+
+class TestParallel(unittest.TestCase):
+
+    error_rate = 0.01
+    m = 16384
+
+    def random_pairs(self, keys, count):
+        return [('test_key%d' % random.randint(0, keys - 1),
+                 ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(20)))
+                for i in range(count)]
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of('test_key', 4), shard_of('test_key', 4))
+        self.assertEqual(shard_of(u'test_key', 4), shard_of('test_key', 4))
+        shards = set(shard_of('test_key%d' % i, 4) for i in range(100))
+        self.assertEqual(shards, set(range(4)))
+
+    def test_parallel_ingest(self):
+        pairs = self.random_pairs(50, 5000)
+
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        serial = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate)
+        serial.add('test_key0', 'test_val')
+        serial.add_pairs(pairs)
+
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        test.add('test_key0', 'test_val')
+        stats = parallel_ingest(test, iter(pairs), workers=3, batch_size=100)
+        self.assertEqual(stats, {'workers': 3, 'keys': len(set(k for k, v in pairs)), 'values': len(pairs)})
+
+        self.assertEqual(sorted(test.keys()), sorted(serial.keys()))
+        for key in serial.keys():
+            self.assertEqual(test.get_hll(key).M.read(self.m), serial.get_hll(key).M.read(self.m))
+
+    def test_parallel_ingest_hash_id(self):
+        pairs = self.random_pairs(10, 1000)
+
+        f1 = tempfile.NamedTemporaryFile(mode='r+b')
+        serial = HyperLogLogDB(fileobj=f1, error_rate=self.error_rate, hash_id=hll.HASH_MIX64)
+        serial.add_pairs(pairs)
+
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate, hash_id=hll.HASH_MIX64)
+        parallel_ingest(test, pairs, workers=2)
+        for key in serial.keys():
+            self.assertEqual(test.get_hll(key).M.read(self.m), serial.get_hll(key).M.read(self.m))
+
+        self.assertEqual(parallel_ingest(test, [], workers=2), {'workers': 2, 'keys': 0, 'values': 0})
+
+    def test_worker_error(self):
+        # sha1 can't hash ints; the worker's error is raised instead of
+        # waiting for it to take more batches
+        pairs = [('test_key%d' % (i % 10), i) for i in range(2000)]
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        test = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        self.assertRaises(TypeError, test.add_pairs, pairs)
+        self.assertRaises(TypeError, parallel_ingest, test, pairs, workers=2, batch_size=10)
+
+
+unittest.main()
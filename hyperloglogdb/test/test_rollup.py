@@ -0,0 +1,107 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import tempfile
+import calendar
+from datetime import datetime
+
+from hlldb import HyperLogLogDB
+from rollup import RollupDB, bucket_start, bucket_end
+
+class TestRollup(unittest.TestCase):
+
+    error_rate = 0.01
+    m = 16384
+
+    def make_rollup(self, **kwargs):
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        self.files = getattr(self, 'files', []) + [f]
+        rollup = RollupDB(HyperLogLogDB(fileobj=f, error_rate=self.error_rate), **kwargs)
+        # values 0-99 every hour on Jan 30 and Jan 31, the last two hours of
+        # Jan 29 and the first hour of Feb 1, each hour adding 10 new values
+        hours = [datetime(2013, 1, 29, 22), datetime(2013, 1, 29, 23)]
+        hours += [datetime(2013, 1, d, h) for d in (30, 31) for h in range(24)]
+        hours += [datetime(2013, 2, 1, 0)]
+        for n, t in enumerate(hours):
+            rollup.add_many('c1', t, ['v%d' % i for i in range(n*10, n*10 + 10)])
+        rollup.add('c2', datetime(2013, 1, 30, 5, 30), 'v0')
+        return rollup, hours
+
+    def test_buckets(self):
+        t = datetime(2012, 2, 3, 4, 5, 6)
+        self.assertEqual(bucket_start(t, 'hour'), datetime(2012, 2, 3, 4))
+        self.assertEqual(bucket_start(t, 'day'), datetime(2012, 2, 3))
+        self.assertEqual(bucket_start(t, 'month'), datetime(2012, 2, 1))
+        self.assertEqual(bucket_end(datetime(2012, 2, 1), 'month'), datetime(2012, 3, 1))
+        self.assertEqual(bucket_end(datetime(2012, 12, 1), 'month'), datetime(2013, 1, 1))
+        self.assertEqual(bucket_start(calendar.timegm(t.timetuple()), 'hour'), datetime(2012, 2, 3, 4))
+
+        rollup = RollupDB(None)
+        self.assertEqual(rollup.bucket_key('c1', t, 'hour'), 'c1:2012020304')
+        self.assertEqual(rollup.cover(datetime(2013, 1, 29, 22), datetime(2013, 3, 1, 1)), [
+            ('hour', datetime(2013, 1, 29, 22)),
+            ('hour', datetime(2013, 1, 29, 23)),
+            ('day', datetime(2013, 1, 30)),
+            ('day', datetime(2013, 1, 31)),
+            ('month', datetime(2013, 2, 1)),
+            ('hour', datetime(2013, 3, 1, 0)),
+        ])
+        self.assertEqual(rollup.cover(datetime(2013, 1, 1), datetime(2013, 1, 1)), [])
+        self.assertRaises(ValueError, RollupDB, None, levels=('day', 'hour'))
+        self.assertRaises(ValueError, RollupDB, None, levels=('week',))
+
+    def check_counts(self, rollup, hours):
+        db = rollup.db
+        hour_keys = [rollup.bucket_key('c1', t, 'hour') for t in hours]
+        self.assertEqual(rollup.count_range('c1', datetime(2013, 1, 1), datetime(2013, 3, 1)),
+                         db.count_union(hour_keys))
+        self.assertEqual(rollup.count('c1', datetime(2013, 1, 30, 12), 'day'), db.count_union(hour_keys[2:26]))
+        self.assertEqual(rollup.count('c1', datetime(2013, 1, 30, 12), 'hour'), db.count(hour_keys[14]))
+        self.assertEqual(rollup.count('c2', datetime(2013, 1, 15), 'month'), 1)
+        self.assertEqual(rollup.count('c3', datetime(2013, 1, 15), 'month'), 0)
+
+        queries = [('c1', datetime(2013, 1, 29, 23), datetime(2013, 2, 1, 1)),
+                   ('c1', datetime(2013, 1, 31), datetime(2013, 2, 2)),
+                   ('c2', datetime(2013, 1, 1), datetime(2014, 1, 1))]
+        self.assertEqual(rollup.count_ranges(queries), [db.count_union(hour_keys[1:]),
+                                                        db.count_union(hour_keys[26:]), 1])
+
+    def test_incremental(self):
+        rollup, hours = self.make_rollup(incremental=True)
+        self.assertTrue(rollup.db.get_hll('c1:201301') is not None)
+        self.assertTrue(rollup.db.get_hll('c1:20130130') is not None)
+        self.check_counts(rollup, hours)
+
+    def test_lazy(self):
+        rollup, hours = self.make_rollup()
+        db = rollup.db
+        self.assertEqual(db.get_hll('c1:201301'), None)
+        self.assertEqual(db.get_hll('c1:20130130'), None)
+        self.check_counts(rollup, hours)
+        self.assertTrue(db.get_hll('c1:201301') is not None)
+        self.assertTrue(db.get_hll('c1:20130130') is not None)
+
+        # materialized buckets are kept up to date
+        rollup.add_many('c1', datetime(2013, 1, 30, 5), ['new%d' % i for i in range(100)])
+        incremental, incremental_hours = self.make_rollup(incremental=True)
+        incremental.add_many('c1', datetime(2013, 1, 30, 5), ['new%d' % i for i in range(100)])
+        for key in ['c1:201301', 'c1:20130130', 'c1:2013013005']:
+            self.assertEqual(db.get_hll(key).M.read(self.m), incremental.db.get_hll(key).M.read(self.m))
+
+
+unittest.main()
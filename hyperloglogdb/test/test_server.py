@@ -0,0 +1,131 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import tempfile
+import threading
+import socket
+
+from hlldb import HyperLogLogDB
+from server import HyperLogLogServer, parse_commands, encode_command, ProtocolError
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.f = tempfile.NamedTemporaryFile(mode='r+b')
+        self.db = HyperLogLogDB(fileobj=self.f, error_rate=0.01)
+        self.server = HyperLogLogServer(self.db, port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'timeout': 0.01})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.f.close()
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.settimeout(10)
+        return sock
+
+    def send(self, sock, commands):
+        # sends the commands pipelined and returns the list of replies
+        sock.sendall(''.join(encode_command(*args) for args in commands))
+        data = ''
+        while data.count('\r\n') < len(commands):
+            data += sock.recv(4096)
+        return data.split('\r\n')[:-1]
+
+    def test_parse_commands(self):
+        buf = encode_command('PFADD', 'key', 'a b') + 'PING\r\n' + encode_command('PFCOUNT', 'key')
+        commands, used = parse_commands(buf + '*2\r\n$5\r\nPFCO')
+        self.assertEqual(commands, [['PFADD', 'key', 'a b'], ['PING'], ['PFCOUNT', 'key']])
+        self.assertEqual(used, len(buf))
+        self.assertRaises(ProtocolError, parse_commands, '*1\r\n:5\r\n')
+        self.assertRaises(ProtocolError, parse_commands, '*x\r\n')
+        self.assertRaises(ProtocolError, parse_commands, '*1\r\n$-12\r\n')
+
+    def test_commands(self):
+        sock = self.connect()
+        replies = self.send(sock, [
+            ['PING'],
+            ['PFADD', 'key1', 'a', 'b', 'c'],
+            ['PFADD', 'key1', 'a'],
+            ['PFADD', 'key2'],
+            ['PFADD', 'key2', 'c', 'd'],
+            ['PFCOUNT', 'key1'],
+            ['PFCOUNT', 'key1', 'key2'],
+            ['PFCOUNT', 'missing'],
+            ['PFMERGE', 'key3', 'key1', 'key2', 'missing'],
+            ['PFCOUNT', 'key3'],
+            ['DEL', 'key1', 'missing'],
+            ['PFCOUNT', 'key1'],
+            ['PFCOUNT'],
+            ['GET', 'key1'],
+        ])
+        self.assertEqual(replies, [
+            '+PONG', ':1', ':0', ':1', ':1', ':3', ':4', ':0', '+OK', ':4', ':1', ':0',
+            "-ERR wrong number of arguments for 'pfcount' command",
+            "-ERR unknown command 'GET'",
+        ])
+        sock.close()
+        self.assertEqual(self.db.count('key2'), 2)
+
+    def test_coalesce(self):
+        socks = [self.connect() for i in range(4)]
+        for n, sock in enumerate(socks):
+            sock.sendall(''.join(encode_command('PFADD', 'key%d' % (i % 3), 'v%d-%d' % (n, i))
+                                 for i in range(300)))
+        for sock in socks:
+            data = ''
+            while data.count('\r\n') < 300:
+                data += sock.recv(4096)
+            replies = data.split('\r\n')[:-1]
+            self.assertEqual(set(replies) - set([':0', ':1']), set())
+            self.assertTrue(replies.count(':1') > 280)
+            sock.close()
+
+        # far fewer register writes than commands
+        self.assertTrue(self.server.stats['pfadd_batches'] < 1200)
+        self.assertEqual(self.server.stats['commands'], 1200)
+        self.assertEqual(sorted(self.db.keys()), ['key0', 'key1', 'key2'])
+        self.assertTrue(abs(self.db.count_union(['key0', 'key1', 'key2']) - 1200) < 60)
+
+    def test_db_error(self):
+        # errors from the database are replied to, and the server keeps running
+        sock = self.connect()
+        self.send(sock, [['PFADD', 'key1', 'a']])
+        self.db.flush()
+        self.server.db = HyperLogLogDB(file_path=self.f.name, readonly=True)
+        replies = self.send(sock, [['PFADD', 'key1', 'b'], ['PFADD', 'key2', 'c'], ['DEL', 'key1'], ['PFCOUNT', 'key1'], ['PING']])
+        self.assertEqual([r[:4] for r in replies[:3]], ['-ERR'] * 3)
+        self.assertEqual(replies[3:], [':1', '+PONG'])
+        sock.close()
+
+    def test_protocol_error(self):
+        sock = self.connect()
+        sock.sendall('*1\r\n:5\r\n')
+        data = ''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertTrue(data.startswith('-ERR Protocol error'))
+        sock.close()
+
+unittest.main()
@@ -0,0 +1,152 @@
+"""
+This file is part of HyperLogLogDB.
+
+HyperLogLogDB is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HyperLogLogDB is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with HyperLogLogDB.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import random
+import string
+import tempfile
+import shutil
+import os
+
+from hlldb import HyperLogLogDB
+from sharded import ShardedHyperLogLogDB
+import hll
+
+class TestSharded(unittest.TestCase):
+
+    error_rate = 0.01
+    m = 16384
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def random_pairs(self, keys, count):
+        return [('test_key%d' % random.randint(0, keys - 1),
+                 ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(20)))
+                for i in range(count)]
+
+    def test_lazy_shards(self):
+        path = os.path.join(self.tmp_dir, 'db')
+        test = ShardedHyperLogLogDB(path, shards=4, error_rate=self.error_rate)
+        self.assertEqual(test.dbs, [None] * 4)
+        self.assertEqual(test.count('test_key'), 0)
+        self.assertEqual(test.get_hll('test_key'), None)
+        self.assertEqual(test.dbs, [None] * 4)
+
+        test.add('test_key', 'test_val')
+        self.assertEqual(len([db for db in test.dbs if db is not None]), 1)
+        self.assertEqual(test.count('test_key'), 1)
+        test.flush()
+
+        # the shard count and settings are read back from the directory
+        test = ShardedHyperLogLogDB(path, shards=8, error_rate=0.05, hash_id=hll.HASH_MIX64)
+        self.assertEqual(test.shards, 4)
+        self.assertEqual(test.hash_id, hll.HASH_SHA1)
+        self.assertEqual(test.m, self.m)
+        self.assertEqual(test.keys(), ['test_key'])
+        self.assertEqual(test.count('test_key'), 1)
+
+        # read-only shards pick up the writer's new keys after a refresh
+        reader = ShardedHyperLogLogDB(path, readonly=True)
+        self.assertEqual(reader.keys(), ['test_key'])
+        test.add_many('test_key2', ['test_val', 'test_val2'])
+        test.add('test_key', 'test_val2')
+        test.flush()
+        reader.refresh()
+        self.assertEqual(sorted(reader.keys()), ['test_key', 'test_key2'])
+        self.assertEqual(reader.count('test_key2'), 2)
+        self.assertRaises(IOError, reader.add, 'test_key', 'test_val3')
+        self.assertRaises(ValueError, ShardedHyperLogLogDB, os.path.join(self.tmp_dir, 'missing'), readonly=True)
+
+    def test_matches_single_file(self):
+        pairs = self.random_pairs(40, 3000)
+
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        single = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        single.add_pairs(pairs)
+
+        test = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db'), shards=4, error_rate=self.error_rate)
+        stats = test.add_pairs(pairs)
+        self.assertEqual(stats, {'keys': len(set(single.keys())), 'new_keys': len(set(single.keys())), 'values': len(pairs)})
+        test.add('test_key0', 'test_val')
+        test.add_many('test_key1', ['test_val', 'test_val2'])
+        single.add('test_key0', 'test_val')
+        single.add_many('test_key1', ['test_val', 'test_val2'])
+
+        self.assertEqual(sorted(test.keys()), sorted(single.keys()))
+        for key in single.keys():
+            self.assertEqual(test.get_hll(key).M.read(self.m), single.get_hll(key).M.read(self.m))
+            self.assertEqual(test.count(key), single.count(key))
+
+        unions = [['test_key0', 'test_key1', 'test_key2'], ['test_key3', 'missing'], ['missing']]
+        self.assertEqual(test.count_unions(unions), single.count_unions(unions))
+        self.assertEqual(test.count_union(unions[0]), single.count_union(unions[0]))
+
+    def test_merge(self):
+        pairs1 = self.random_pairs(30, 2000)
+        pairs2 = self.random_pairs(30, 2000)
+
+        test1 = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db1'), shards=4, error_rate=self.error_rate)
+        test1.add_pairs(pairs1)
+        test2 = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db2'), shards=4, error_rate=self.error_rate)
+        test2.add_pairs(pairs2)
+        test3 = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db3'), shards=3, error_rate=self.error_rate)
+        test3.add('test_key_other', 'test_val')
+
+        f = tempfile.NamedTemporaryFile(mode='r+b')
+        single = HyperLogLogDB(fileobj=f, error_rate=self.error_rate)
+        single.add_pairs(pairs1 + pairs2)
+        single.add('test_key_other', 'test_val')
+
+        test1.merge([test2, test3])
+        self.assertEqual(sorted(test1.keys()), sorted(single.keys()))
+        for key in single.keys():
+            self.assertEqual(test1.get_hll(key).M.read(self.m), single.get_hll(key).M.read(self.m))
+
+        # a plain HyperLogLogDB can take a sharded one
+        f2 = tempfile.NamedTemporaryFile(mode='r+b')
+        single2 = HyperLogLogDB(fileobj=f2, error_rate=self.error_rate)
+        single2.merge(test1)
+        for key in single.keys():
+            self.assertEqual(single2.get_hll(key).M.read(self.m), single.get_hll(key).M.read(self.m))
+
+        test4 = ShardedHyperLogLogDB(os.path.join(self.tmp_dir, 'db4'), shards=4, error_rate=0.05)
+        self.assertRaises(ValueError, test1.merge, test4)
+
+    def test_delete(self):
+        path = os.path.join(self.tmp_dir, 'db')
+        test = ShardedHyperLogLogDB(path, shards=4, error_rate=self.error_rate)
+        for i in range(40):
+            test.add('test_key%d' % i, 'test_val')
+        self.assertTrue(test.delete('test_key0'))
+        self.assertFalse(test.delete('test_key0'))
+        self.assertEqual(test.delete_prefix('test_key1'), 11)
+        self.assertEqual(len(test.keys()), 28)
+        self.assertEqual(test.count('test_key1'), 0)
+
+        stats = test.compact()
+        self.assertEqual(stats['keys'], 28)
+        self.assertTrue(stats['new_size'] < stats['old_size'])
+        self.assertEqual(test.count('test_key2'), 1)
+
+        test = ShardedHyperLogLogDB(path)
+        self.assertEqual(len(test.keys()), 28)
+
+unittest.main()